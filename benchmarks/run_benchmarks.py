@@ -0,0 +1,315 @@
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import tempfile
+import threading
+import subprocess
+from functools import partial
+from typing import Optional
+
+import defopt
+import numpy as np
+
+# End-to-end benchmarks for the DAQLogger -> OSC -> DAQViewer pipeline.
+# All inputs are synthetic (simdaq.py with a fixed seed), so two runs on the same machine are comparable.
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'daqlogger', 'python'))
+sys.path.insert(0, os.path.join(here, '..', 'daqviewer'))
+
+import simdaq
+from nidaq import AnalogInput, AngularEncoder
+from oscframe import OSCFrame
+from writer import AsyncWriter
+from osc_handler import OSCStreamer, decode_frame
+from pythonosc.osc_message import OscMessage
+from pythonosc.osc_message_builder import OscMessageBuilder
+from pythonosc.udp_client import SimpleUDPClient
+
+SAMPLE_RATE = 9000
+SAMPLE_SIZE = 1000
+
+
+def _summary(times) -> dict:
+    times = np.asarray(times) * 1e6
+    return dict(mean_us=float(times.mean()), p50_us=float(np.percentile(times, 50)),
+                p99_us=float(np.percentile(times, 99)), max_us=float(times.max()), n=len(times))
+
+
+def _sink_port() -> socket.socket:
+    # UDP socket nobody reads from, so the callbacks pay for a real sendto()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    return sock
+
+
+def bench_callbacks(n_calls: int, channel_counts=(2, 8, 32)) -> dict:
+    # Time spent in AnalogInput/AngularEncoder every-N-samples callbacks (read, ring buffer, enqueue, OSC)
+    results = {}
+    sink = _sink_port()
+    client = SimpleUDPClient('127.0.0.1', sink.getsockname()[1])
+    with tempfile.TemporaryDirectory() as tmp:
+        for task_callback in ['read_buffer', 'save_buffer', 'osc_buffer']:
+            for n_channels in channel_counts:
+                results['ai_{}_{}ch'.format(task_callback, n_channels)] = _time_task(
+                    AnalogInput(['Dev1/ai{}'.format(i) for i in range(n_channels)], -5, 5, backend='simulated'),
+                    task_callback, client, os.path.join(tmp, 'ai.bin'), n_calls, n_channels)
+            results['ci_{}'.format(task_callback)] = _time_task(
+                AngularEncoder('Dev1/ctr0', backend='simulated'),
+                task_callback, client, os.path.join(tmp, 'ci.bin'), n_calls, None)
+    sink.close()
+    return results
+
+
+def _time_task(task, task_callback, client, path, n_calls, n_channels) -> dict:
+    writer = AsyncWriter()
+    with open(path, 'wb') as outfile:
+        if n_channels is None:
+            task.set_datastream(SAMPLE_RATE, '', SAMPLE_SIZE, task_callback=task_callback,
+                                outfile=writer.stream(outfile))
+            callback = partial(getattr(task, '_' + task_callback), n_samples=SAMPLE_SIZE)
+        else:
+            task.set_datastream(SAMPLE_RATE, '', sample_size=SAMPLE_SIZE, task_callback=task_callback,
+                                outfile=writer.stream(outfile))
+            callback = partial(getattr(task, '_' + task_callback), n_channels=n_channels, n_samples=SAMPLE_SIZE)
+        task.client = client
+        task.osc_address = ['/ch{}'.format(i) for i in range(n_channels or 1)]
+
+        times = []
+        def timed(*args):
+            t = time.perf_counter()
+            callback(*args)
+            times.append(time.perf_counter() - t)
+        task.task.register_every_n_samples_acquired_into_buffer_event(SAMPLE_SIZE, timed)
+        writer.start()
+        task.task.start(realtime=False)
+        for _ in range(n_calls):
+            task.task.step()
+        task.close()
+        writer.close()
+    result = _summary(times)
+    result['samples_per_s'] = SAMPLE_SIZE * (n_channels or 1) / (result['mean_us'] * 1e-6)
+    return result
+
+
+def bench_osc_codec(n_messages: int) -> dict:
+    # Encode/decode cost of one chunk of one channel: binary frames vs. the former float-list messages
+    samples = np.random.default_rng(0).normal(size=SAMPLE_SIZE)
+    results = {}
+    for name, dtype in [('float32', np.float32), ('int16', np.int16), ('float64', np.float64)]:
+        frame = OSCFrame('/ai0', 0, SAMPLE_SIZE, SAMPLE_RATE, dtype=dtype, gain=1e-3)
+        values = samples * 1e3 if dtype is np.int16 else samples
+        t = time.perf_counter()
+        for i in range(n_messages):
+            frame.pack(values, i * SAMPLE_SIZE)
+        encode = time.perf_counter() - t
+        dgram = bytes(frame.dgram)
+        t = time.perf_counter()
+        for _ in range(n_messages):
+            decode_frame(OscMessage(dgram).params[0])
+        decode = time.perf_counter() - t
+        results['frame_' + name] = _codec_result(n_messages, encode, decode)
+
+    n_legacy = max(1, n_messages // 20)
+    values = samples.tolist()
+    t = time.perf_counter()
+    for _ in range(n_legacy):
+        builder = OscMessageBuilder(address='/ai0')
+        for v in values:
+            builder.add_arg(v)
+        dgram = builder.build().dgram
+    encode = time.perf_counter() - t
+    t = time.perf_counter()
+    for _ in range(n_legacy):
+        np.asarray(OscMessage(dgram).params)
+    decode = time.perf_counter() - t
+    results['legacy_float_list'] = _codec_result(n_legacy, encode, decode)
+    return results
+
+
+def _codec_result(n, encode, decode) -> dict:
+    return dict(encode_us=encode / n * 1e6, decode_us=decode / n * 1e6,
+                encode_msgs_per_s=n / encode, decode_msgs_per_s=n / decode,
+                encode_samples_per_s=n * SAMPLE_SIZE / encode, decode_samples_per_s=n * SAMPLE_SIZE / decode)
+
+
+class _CountingConnector:
+    # Stands in for the viewer's DataConnectors. The sender puts its perf_counter() in the
+    # first sample of every frame, which gives the send-to-handler latency.
+
+    def __init__(self):
+        self.samples = 0
+        self.messages = 0
+        self.latency = []
+
+    def cb_append_chunk(self, y, x):
+        self.latency.append(time.perf_counter() - y[0])
+        self.samples += len(y)
+        self.messages += 1
+
+    def cb_append_data_point(self, y, x):
+        self.samples += 1
+        self.messages += 1
+
+
+def bench_ingest(duration: float, rates=(1000, 2000, 5000, 10000, 20000, 50000), n_channels: int = 8) -> dict:
+    # Highest message rate OSCStreamer handles without losing packets, for both server types
+    return {server_type: _ingest(server_type, duration, rates, n_channels)
+            for server_type in ('batched', 'threading')}
+
+
+def _ingest(server_type: str, duration: float, rates, n_channels: int) -> dict:
+    sock = _sink_port()
+    port = sock.getsockname()[1]
+    sock.close()
+    config = dict(IPAddress='127.0.0.1', Port=port,
+                  Inputs={'ch{}'.format(i): dict(Label='ch{}'.format(i)) for i in range(n_channels)})
+    connectors = {key: _CountingConnector() for key in config['Inputs']}
+    streamer = OSCStreamer(config=config, multidata_connector=connectors, server_type=server_type)
+    thread = threading.Thread(target=streamer.run, daemon=True)
+    thread.start()
+
+    client = SimpleUDPClient('127.0.0.1', port)
+    frames = [OSCFrame('/ch{}'.format(i), i, SAMPLE_SIZE, SAMPLE_RATE, dtype=np.float64) for i in range(n_channels)]
+    samples = np.zeros(SAMPLE_SIZE)
+    steps = []
+    for rate in rates:
+        for c in connectors.values():
+            c.messages = c.samples = 0
+            c.latency = []
+        n_messages = int(rate * duration)
+        t_start = time.perf_counter()
+        for k in range(n_messages):
+            deadline = t_start + k / rate
+            while time.perf_counter() < deadline:
+                pass
+            samples[0] = time.perf_counter()
+            client.send(frames[k % n_channels].pack(samples, k * SAMPLE_SIZE))
+        time.sleep(0.5) # let the server drain
+        received = sum(c.messages for c in connectors.values())
+        latency = [t for c in connectors.values() for t in c.latency]
+        step = dict(rate=rate, sent=n_messages, received=received,
+                    loss=1 - received / n_messages,
+                    samples_per_s=received * SAMPLE_SIZE / duration)
+        if latency:
+            step['latency'] = _summary(latency)
+        steps.append(step)
+    streamer.kill()
+    lossless = [s['rate'] for s in steps if s['loss'] <= 1e-3]
+    return dict(steps=steps, n_channels=n_channels, max_lossless_msgs_per_s=max(lossless) if lossless else 0)
+
+
+def bench_viewer(n_frames: int, channel_counts=(2, 8, 32, 64), sample_rates=(1000, 9000, 30000),
+                 layouts=('grid', 'stacked')) -> dict:
+    # Viewer frame time (staging and draining one chunk per channel + repaint) vs. channel count,
+    # sample rate and layout (ViewerTab or StackedViewerTab)
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    try:
+        from PyQt5.QtWidgets import QApplication, QWidget
+        from gui_viewer import ViewerTab
+        from stacked_viewer import StackedViewerTab
+    except ImportError as e:
+        return dict(skipped=str(e))
+
+    app = QApplication.instance() or QApplication(sys.argv)
+    tab_class = dict(grid=ViewerTab, stacked=StackedViewerTab)
+    results = {}
+    for layout in layouts:
+        for sample_rate in sample_rates:
+            for n_channels in channel_counts:
+                config = dict(DAQSampleRate=sample_rate, DAQBufferSize=sample_rate // 9, Xrange_sec=10,
+                              Inputs={'ch{}'.format(i): dict(Label='ch{}'.format(i)) for i in range(n_channels)})
+                parent = QWidget()
+                parent.resize(1600, 60 * min(n_channels, 16))
+                vt = tab_class[layout](parent, config)
+                vt.stager.stop() # frames are driven below
+                parent.show()
+                app.processEvents()
+                chunk = config['DAQBufferSize']
+                t = np.arange(chunk) / sample_rate
+                y = np.sin(2 * np.pi * t)
+                times = []
+                for k in range(n_frames):
+                    t0 = time.perf_counter()
+                    for channel in vt.stager.channels.values():
+                        channel.cb_append_chunk(y, t + k * chunk / sample_rate)
+                    vt.stager.drain()
+                    if layout == 'stacked':
+                        vt.refresh()
+                    app.processEvents()
+                    parent.repaint()
+                    times.append(time.perf_counter() - t0)
+                results['{}_{}Hz_{}ch'.format(layout, sample_rate, n_channels)] = _summary(times)
+                parent.close()
+                parent.deleteLater()
+                app.processEvents()
+    return results
+
+
+def _environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=here,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return dict(commit=commit, time=time.strftime('%Y-%m-%dT%H:%M:%S'), python=platform.python_version(),
+                numpy=np.__version__, platform=platform.platform(), processor=platform.processor())
+
+
+def _flatten(d: dict, prefix: str = '') -> dict:
+    out = {}
+    for k, v in d.items():
+        key = '{}.{}'.format(prefix, k) if prefix else k
+        if isinstance(v, dict):
+            out.update(_flatten(v, key))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[key] = v
+    return out
+
+
+def compare(baseline: dict, report: dict) -> None:
+    old = _flatten(baseline['results'])
+    new = _flatten(report['results'])
+    print('{:<60} {:>14} {:>14} {:>8}'.format('metric', baseline['environment']['commit'] or 'baseline',
+                                             report['environment']['commit'] or 'current', 'change'))
+    for key in sorted(set(old) & set(new)):
+        change = (new[key] - old[key]) / old[key] * 100 if old[key] else float('nan')
+        print('{:<60} {:>14.4g} {:>14.4g} {:>7.1f}%'.format(key, old[key], new[key], change))
+
+
+def main(*, output: str = 'benchmark.json', baseline: Optional[str] = None, quick: bool = False,
+         only: Optional[str] = None):
+    """
+    Run the DAQLogger/DAQViewer benchmarks and write a JSON report
+
+    :param output: where to write the report
+    :param baseline: earlier report to compare against
+    :param quick: fewer iterations, for a smoke test
+    :param only: run a single benchmark: callbacks, osc_codec, ingest or viewer
+    """
+    simdaq.set_seed(0)
+    scale = 0.1 if quick else 1.0
+    benchmarks = dict(callbacks=lambda: bench_callbacks(int(500 * scale)),
+                      osc_codec=lambda: bench_osc_codec(int(20000 * scale)),
+                      ingest=lambda: bench_ingest(1.0 * scale),
+                      viewer=lambda: bench_viewer(int(200 * scale)))
+    results = {}
+    for name, run in benchmarks.items():
+        if only is not None and name != only:
+            continue
+        print('Running {} benchmark...'.format(name))
+        results[name] = run()
+    report = dict(environment=_environment(), results=results)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Report written to {}'.format(output))
+
+    if baseline is not None:
+        with open(baseline) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    defopt.run(main)
@@ -0,0 +1,289 @@
+import bz2
+import lzma
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from recording import write_header, read_header, _ScaledView
+
+# Chunked, compressed variant of the DAQLogger recording (see recording.py)
+#   [0, HEADER_SIZE)  the usual header; meta['compression'] holds codec, level, filters and chunk size
+#   chunks            CHUNK_HEADER (magic, first sample, n_samples, compressed size) + payload, back to back
+#   index             INDEX_MAGIC, n_chunks, then (first_sample, n_samples, offset, nbytes) per chunk
+#   trailer           offset of the index + END_MAGIC
+# The index and trailer are written on close. Without them (crash, power loss) the reader
+# rebuilds the index by walking the chunk headers, so every complete chunk stays readable.
+# Before compression a chunk is stored channel-major; 'delta' replaces each sample by its
+# difference to the previous one (on the integer bit pattern, so it is lossless for floats
+# too) and 'shuffle' groups the bytes by significance, which both help slowly varying lines.
+CHUNK_MAGIC = b'DQZC'
+INDEX_MAGIC = b'DQZI'
+END_MAGIC = b'DQZE'
+CHUNK_HEADER = struct.Struct('<4sQII')
+INDEX_HEADER = struct.Struct('<4sQ')
+TRAILER = struct.Struct('<Q4s')
+INDEX_DTYPE = np.dtype([('first_sample', '<u8'), ('n_samples', '<u4'), ('offset', '<u8'), ('nbytes', '<u4')])
+
+CODECS = dict(zlib=(lambda data, level: zlib.compress(data, level), zlib.decompress),
+              lzma=(lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+              bz2=(lambda data, level: bz2.compress(data, max(level, 1)), bz2.decompress))
+
+
+def _int_view(dtype:np.dtype) -> np.dtype:
+    return np.dtype('<i{}'.format(dtype.itemsize))
+
+
+def encode_chunk(samples:np.ndarray, codec:str='zlib', level:int=1, delta:bool=True, shuffle:bool=True) -> bytes:
+    # samples: (n_samples, n_channels)
+    data = np.ascontiguousarray(samples.T)
+    if delta:
+        ints = data.view(_int_view(data.dtype))
+        diff = np.empty_like(ints)
+        diff[:, :1] = ints[:, :1]
+        np.subtract(ints[:, 1:], ints[:, :-1], out=diff[:, 1:])
+        data = diff
+    raw = data.view(np.uint8).reshape(data.shape + (data.dtype.itemsize,))
+    if shuffle:
+        raw = raw.transpose(0, 2, 1)
+    return CODECS[codec][0](np.ascontiguousarray(raw).tobytes(), level)
+
+
+def decode_chunk(payload:bytes, n_samples:int, n_channels:int, dtype, codec:str='zlib',
+                 delta:bool=True, shuffle:bool=True) -> np.ndarray:
+    dtype = np.dtype(dtype)
+    raw = np.frombuffer(CODECS[codec][1](payload), dtype=np.uint8)
+    if shuffle:
+        raw = raw.reshape(n_channels, dtype.itemsize, n_samples).transpose(0, 2, 1)
+    else:
+        raw = raw.reshape(n_channels, n_samples, dtype.itemsize)
+    data = np.ascontiguousarray(raw).view(_int_view(dtype)).reshape(n_channels, n_samples)
+    if delta:
+        data = np.cumsum(data, axis=1, dtype=data.dtype) # wraps around exactly like the subtraction
+    return data.view(dtype).T
+
+
+class ChunkedWriter:
+    # File-like sink for AsyncWriter: buffers incoming (n, n_channels) blocks into fixed-size
+    # chunks and compresses each full chunk on the writer thread. flush() only flushes
+    # complete chunks; the partial one is written by close().
+
+    def __init__(self, outfile, chunk_samples:int=9000, codec:str='zlib', level:int=1,
+                 delta:bool=True, shuffle:bool=True):
+        if codec not in CODECS:
+            raise ValueError('Unknown codec {}, use one of {}'.format(codec, sorted(CODECS)))
+        self.outfile = outfile
+        self.chunk_samples = chunk_samples
+        self.codec = codec
+        self.level = level
+        self.delta = delta
+        self.shuffle = shuffle
+        self._chunk = None # allocated on the first write, when the dtype and channel count are known
+        self._fill = 0
+        self._first_sample = 0
+        self._index = []
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+
+    def write_header(self, meta:dict):
+        meta = dict(meta, compression=dict(codec=self.codec, level=self.level, delta=self.delta,
+                                           shuffle=self.shuffle, chunk_samples=self.chunk_samples))
+        write_header(self.outfile, meta)
+
+    def write(self, data:np.ndarray):
+        data = np.asarray(data)
+        if data.ndim == 1:
+            data = data[:, np.newaxis]
+        if self._chunk is None:
+            self._chunk = np.empty((self.chunk_samples, data.shape[1]), dtype=data.dtype)
+        while len(data):
+            n = min(len(data), self.chunk_samples - self._fill)
+            self._chunk[self._fill:self._fill + n] = data[:n]
+            self._fill += n
+            data = data[n:]
+            if self._fill == self.chunk_samples:
+                self._write_chunk()
+
+    def writelines(self, chunks):
+        for data in chunks:
+            self.write(data)
+
+    def _write_chunk(self):
+        if self._fill == 0:
+            return
+        payload = encode_chunk(self._chunk[:self._fill], self.codec, self.level, self.delta, self.shuffle)
+        self._append(payload, self._fill, self._chunk[:self._fill].nbytes)
+        self._fill = 0
+
+    def write_encoded(self, payload:bytes, n_samples:int, raw_bytes:int):
+        # Append a chunk compressed elsewhere, e.g. by encode_chunk() in a worker process,
+        # with this writer's codec and filters. Cannot be mixed with a partial chunk from write().
+        if self._fill:
+            raise ValueError('write_encoded() after a partial write()')
+        self._append(payload, n_samples, raw_bytes)
+
+    def _append(self, payload:bytes, n_samples:int, raw_bytes:int):
+        offset = self.outfile.tell()
+        self.outfile.write(CHUNK_HEADER.pack(CHUNK_MAGIC, self._first_sample, n_samples, len(payload)))
+        self.outfile.write(payload)
+        self._index.append((self._first_sample, n_samples, offset, len(payload)))
+        self.raw_bytes += raw_bytes
+        self.compressed_bytes += CHUNK_HEADER.size + len(payload)
+        self._first_sample += n_samples
+
+    @classmethod
+    def reopen(cls, path, n_chunks:int=None):
+        # Continue writing a chunked recording, e.g. one that was not closed. Keeps its first
+        # n_chunks complete chunks (all by default); anything after them, index included, is cut off.
+        meta = read_header(path)
+        settings = meta['compression']
+        outfile = open(path, 'r+b')
+        index = _read_index(outfile, meta['data_offset'])[:n_chunks]
+        end = int(index['offset'][-1]) + CHUNK_HEADER.size + int(index['nbytes'][-1]) if len(index) else meta['data_offset']
+        outfile.truncate(end)
+        outfile.seek(end)
+        writer = cls(outfile, settings['chunk_samples'], settings['codec'], settings['level'],
+                     settings['delta'], settings['shuffle'])
+        writer._index = [tuple(entry) for entry in index.tolist()]
+        writer._first_sample = int(index['n_samples'].sum())
+        writer.raw_bytes = writer._first_sample * meta['n_channels'] * np.dtype(meta['dtype']).itemsize
+        writer.compressed_bytes = int(index['nbytes'].sum()) + CHUNK_HEADER.size * len(index)
+        return writer
+
+    @property
+    def ratio(self) -> float:
+        return self.raw_bytes / self.compressed_bytes if self.compressed_bytes else 1.0
+
+    def flush(self):
+        self.outfile.flush()
+
+    def fileno(self):
+        return self.outfile.fileno()
+
+    def close(self):
+        if self.outfile.closed:
+            return
+        self._write_chunk()
+        index = np.array(self._index, dtype=INDEX_DTYPE)
+        index_offset = self.outfile.tell()
+        self.outfile.write(INDEX_HEADER.pack(INDEX_MAGIC, len(index)))
+        self.outfile.write(index.tobytes())
+        self.outfile.write(TRAILER.pack(index_offset, END_MAGIC))
+        self.outfile.close()
+
+    @property
+    def closed(self):
+        return self.outfile.closed
+
+
+def _read_index(f, data_offset:int) -> np.ndarray:
+    size = f.seek(0, os.SEEK_END)
+    if size >= data_offset + TRAILER.size:
+        f.seek(size - TRAILER.size)
+        index_offset, magic = TRAILER.unpack(f.read(TRAILER.size))
+        if magic == END_MAGIC:
+            f.seek(index_offset)
+            magic, n_chunks = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+            if magic == INDEX_MAGIC:
+                return np.frombuffer(f.read(n_chunks * INDEX_DTYPE.itemsize), dtype=INDEX_DTYPE)
+    # No index: the recording was not closed, walk the chunks
+    entries = []
+    offset = data_offset
+    while offset + CHUNK_HEADER.size <= size:
+        f.seek(offset)
+        magic, first_sample, n_samples, nbytes = CHUNK_HEADER.unpack(f.read(CHUNK_HEADER.size))
+        if magic != CHUNK_MAGIC or offset + CHUNK_HEADER.size + nbytes > size:
+            break
+        entries.append((first_sample, n_samples, offset, nbytes))
+        offset += CHUNK_HEADER.size + nbytes
+    return np.array(entries, dtype=INDEX_DTYPE)
+
+
+class ChunkedRecording:
+    # Read-only (n_samples, n_channels) view of a chunked recording. Slicing decompresses
+    # only the chunks overlapping the requested samples; the last chunk is kept decoded
+    # so that sequential reads decompress every chunk once.
+
+    def __init__(self, path, meta:dict=None):
+        self.path = path
+        self.meta = read_header(path) if meta is None else meta
+        self.compression = self.meta['compression']
+        self.dtype = np.dtype(self.meta['dtype'])
+        self._file = open(path, 'rb')
+        self.index = _read_index(self._file, self.meta['data_offset'])
+        self._starts = self.index['first_sample'].astype(np.int64)
+        n_samples = int(self._starts[-1] + self.index['n_samples'][-1]) if len(self.index) else 0
+        self.shape = (n_samples, self.meta['n_channels'])
+        self._cached = (None, None)
+
+    @property
+    def sample_rate(self):
+        return self.meta['sample_rate']
+
+    @property
+    def channel_names(self):
+        return self.meta['channel_names']
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def scaled(self):
+        if 'scaling_coeffs' not in self.meta:
+            return self
+        return _ScaledView(self)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _chunk(self, k:int) -> np.ndarray:
+        if self._cached[0] != k:
+            entry = self.index[k]
+            self._file.seek(int(entry['offset']) + CHUNK_HEADER.size)
+            payload = self._file.read(int(entry['nbytes']))
+            self._cached = (k, decode_chunk(payload, int(entry['n_samples']), self.shape[1], self.dtype,
+                                            self.compression['codec'], self.compression['delta'],
+                                            self.compression['shuffle']))
+        return self._cached[1]
+
+    def read(self, i0:int, i1:int) -> np.ndarray:
+        # Samples [i0, i1) of all channels
+        i0 = max(0, i0)
+        i1 = min(len(self), i1)
+        out = np.empty((max(0, i1 - i0), self.shape[1]), dtype=self.dtype)
+        if i1 <= i0:
+            return out
+        k0 = int(np.searchsorted(self._starts, i0, side='right')) - 1
+        k1 = int(np.searchsorted(self._starts, i1, side='left'))
+        for k in range(k0, k1):
+            start = int(self._starts[k])
+            chunk = self._chunk(k)
+            a = max(i0, start)
+            b = min(i1, start + len(chunk))
+            out[a - i0:b - i0] = chunk[a - start:b - start]
+        return out
+
+    def time_range(self, t0:float, t1:float) -> np.ndarray:
+        # Samples between t0 and t1 seconds from the start of the recording
+        return self.read(int(np.floor(t0 * self.sample_rate)), int(np.ceil(t1 * self.sample_rate)))
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        if isinstance(rows, (int, np.integer)):
+            rows = int(rows) + len(self) if rows < 0 else int(rows)
+            if not 0 <= rows < len(self):
+                raise IndexError('sample index {} is out of range'.format(rows))
+            return self.read(rows, rows + 1)[0, cols]
+        start, stop, step = rows.indices(len(self))
+        if step < 0:
+            return self.read(stop + 1, start + 1)[::-1][::-step, cols]
+        return self.read(start, stop)[::step, cols]
+
+    def __array__(self, dtype=None):
+        data = self.read(0, len(self))
+        return data if dtype is None else data.astype(dtype)
+
+    def close(self):
+        self._file.close()
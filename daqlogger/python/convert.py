@@ -0,0 +1,329 @@
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import List, Optional
+
+import defopt
+import numpy as np
+
+from chunkstore import ChunkedWriter, encode_chunk
+from recording import open_recording, read_header
+
+# Convert DAQLogger recordings to .npy or to the chunked store (chunkstore.py), block by block
+# in worker processes, optionally decimated, with per-channel summary statistics of the full-rate
+# data. Memory use is bounded by block size x workers whatever the length of the recording.
+# Every finished block is appended to <output>.progress; a run that was interrupted continues
+# from there, as long as the source file and the conversion parameters are unchanged.
+
+STATS_FIELDS = ('count', 'mean', 'm2', 'min', 'max') # per channel, NaN samples are left out
+
+# Per worker process: open recordings and .npy outputs, reused by the blocks of the same file
+_sources = {}
+_outputs = {}
+
+
+def block_stats(data:np.ndarray) -> np.ndarray:
+    # (len(STATS_FIELDS), n_channels) of one block
+    data = np.asarray(data, dtype=np.float64)
+    finite = ~np.isnan(data)
+    count = finite.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(finite, data, 0).sum(axis=0) / count
+        m2 = np.where(finite, data - mean, 0) ** 2
+    empty = count == 0
+    lo = np.where(finite, data, np.inf).min(axis=0, initial=np.inf)
+    hi = np.where(finite, data, -np.inf).max(axis=0, initial=-np.inf)
+    return np.array([count, np.where(empty, 0, mean), m2.sum(axis=0),
+                     np.where(empty, np.nan, lo), np.where(empty, np.nan, hi)])
+
+
+def merge_stats(a:np.ndarray, b:np.ndarray) -> np.ndarray:
+    # Pairwise combination of block statistics (Chan et al.), exact in any order
+    na, nb = a[0], b[0]
+    n = na + nb
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = b[1] - a[1]
+        mean = np.where(n > 0, a[1] + delta * nb / n, 0)
+        m2 = a[2] + b[2] + np.where(n > 0, delta ** 2 * na * nb / n, 0)
+    return np.array([n, mean, m2, np.fmin(a[3], b[3]), np.fmax(a[4], b[4])])
+
+
+def decimate_block(data:np.ndarray, factor:int, method:str='mean') -> np.ndarray:
+    # One output sample per `factor` input samples; a short last group gives one more
+    if factor == 1:
+        return data
+    if method == 'first':
+        return data[::factor]
+    starts = np.arange(0, len(data), factor)
+    counts = np.diff(np.append(starts, len(data)))[:, np.newaxis]
+    return np.add.reduceat(np.asarray(data, dtype=np.float64), starts, axis=0) / counts
+
+
+def output_dtype(meta:dict, raw:bool, decimate:int, method:str) -> np.dtype:
+    if decimate > 1 and method == 'mean':
+        return np.dtype(np.float64)
+    if raw or 'scaling_coeffs' not in meta:
+        return np.dtype(meta['dtype'])
+    return np.dtype(np.float64)
+
+
+def output_meta(meta:dict, raw:bool, decimate:int, method:str, source:str) -> dict:
+    meta = {key: value for key, value in meta.items() if key not in ('data_offset', 'compression')}
+    meta['dtype'] = output_dtype(meta, raw, decimate, method).str
+    if not raw:
+        meta.pop('scaling_coeffs', None)
+    if decimate > 1:
+        meta.update(sample_rate=meta['sample_rate'] / decimate, decimation=dict(factor=decimate, method=method))
+    meta['converted_from'] = os.path.basename(source)
+    return meta
+
+
+def _open(path:str, params:dict):
+    # Headerless (legacy) recordings are read with the layout given for them
+    return open_recording(path, **(params['headerless'] or {}))
+
+
+def _convert_block(task:tuple):
+    # Runs in a worker process. npy blocks are written in place; chunked ones are returned
+    # compressed, to be appended in order by the parent.
+    path, out_path, k, i0, i1, params = task
+    rec = _sources.get(path)
+    if rec is None:
+        rec = _sources[path] = _open(path, params)
+    data = np.asarray(rec[i0:i1] if params['raw'] else rec.scaled[i0:i1])
+    stats = block_stats(data)
+    out = decimate_block(data, params['decimate'], params['method'])
+    out = out.astype(output_dtype(rec.meta, params['raw'], params['decimate'], params['method']), copy=False)
+
+    if params['format'] == 'npy':
+        array = _outputs.get(out_path)
+        if array is None:
+            array = _outputs[out_path] = np.lib.format.open_memmap(out_path, mode='r+')
+        o0 = i0 // params['decimate']
+        array[o0:o0 + len(out)] = out
+        array.flush()
+        return path, k, stats, None
+
+    chunk = params['chunk_samples']
+    payloads = [(encode_chunk(out[j:j + chunk], params['codec'], params['level']), len(out[j:j + chunk]),
+                 out[j:j + chunk].nbytes) for j in range(0, len(out), chunk)]
+    return path, k, stats, payloads
+
+
+class Conversion:
+    # One recording: its blocks, output and progress log. Lives in the parent process.
+
+    def __init__(self, path:str, out_dir:str, params:dict, overwrite:bool=False):
+        self.path = path
+        self.params = params
+        name = os.path.splitext(os.path.basename(path))[0]
+        ext = '.npy' if params['format'] == 'npy' else '.bin'
+        self.out_path = os.path.join(out_dir, name + ext)
+        self.stats_path = os.path.join(out_dir, name + '.stats.json')
+        self.progress_path = self.out_path + '.progress'
+
+        rec = _open(path, params)
+        self.meta = rec.meta
+        self.n_samples = len(rec)
+        if hasattr(rec, 'close'):
+            rec.close()
+        block = params['block_samples']
+        self.blocks = [(k, i0, min(i0 + block, self.n_samples))
+                       for k, i0 in enumerate(range(0, self.n_samples, block))]
+        stat = os.stat(path)
+        self.job = dict(params, source=os.path.abspath(path), size=stat.st_size, mtime=stat.st_mtime)
+
+        self.done = {} # block -> stats
+        self.chunks = {} # block -> chunks written (chunked format)
+        self.finished = os.path.exists(self.out_path) and not os.path.exists(self.progress_path)
+        if self.finished and overwrite:
+            os.remove(self.out_path)
+            self.finished = False
+        if not self.finished:
+            self._load_progress()
+
+    def _load_progress(self):
+        try:
+            with open(self.progress_path) as f:
+                lines = f.read().split('\n')
+        except OSError:
+            lines = []
+        if lines and lines[0] and json.loads(lines[0]) == self.job and os.path.exists(self.out_path):
+            for line in lines[1:]:
+                try:
+                    entry = json.loads(line)
+                except ValueError: # cut off by the interruption
+                    break
+                self.done[entry['block']] = np.array(entry['stats'], dtype=np.float64)
+                self.chunks[entry['block']] = entry.get('chunks', 0)
+        else:
+            self.done.clear()
+            if os.path.exists(self.out_path):
+                os.remove(self.out_path)
+            with open(self.progress_path, 'w') as f:
+                f.write(json.dumps(self.job) + '\n')
+        if len(self.done):
+            print('{}: resuming, {} of {} blocks already converted'.format(
+                os.path.basename(self.path), len(self.done), len(self.blocks)))
+        self._open_output()
+        self._progress = open(self.progress_path, 'a')
+
+    def _open_output(self):
+        params = self.params
+        meta = output_meta(self.meta, params['raw'], params['decimate'], params['method'], self.path)
+        if params['format'] == 'npy':
+            if not os.path.exists(self.out_path):
+                n_out = -(-self.n_samples // params['decimate'])
+                np.lib.format.open_memmap(self.out_path, mode='w+', dtype=np.dtype(meta['dtype']),
+                                          shape=(n_out, meta['n_channels'])).flush()
+            with open(os.path.splitext(self.out_path)[0] + '.json', 'w') as f:
+                json.dump(meta, f, indent=2)
+            self.writer = None
+            return
+        # Chunks are appended in block order, so only the blocks before the first missing one count
+        self._next = 0
+        while self._next in self.done:
+            self._next += 1
+        for k in list(self.done):
+            if k >= self._next:
+                del self.done[k]
+        if os.path.exists(self.out_path):
+            self.writer = ChunkedWriter.reopen(self.out_path, sum(self.chunks[k] for k in range(self._next)))
+        else:
+            self.writer = ChunkedWriter(open(self.out_path, 'wb'), params['chunk_samples'],
+                                        params['codec'], params['level'])
+            self.writer.write_header(meta)
+        self._pending = {} # finished out of order
+
+    def tasks(self):
+        for k, i0, i1 in self.blocks:
+            if k not in self.done:
+                yield (self.path, self.out_path, k, i0, i1, self.params)
+
+    def add(self, k:int, stats:np.ndarray, payloads:list):
+        if self.writer is None:
+            self._log(k, stats, 0)
+            return
+        self._pending[k] = (stats, payloads)
+        while self._next in self._pending:
+            stats, payloads = self._pending.pop(self._next)
+            for payload, n_samples, raw_bytes in payloads:
+                self.writer.write_encoded(payload, n_samples, raw_bytes)
+            self.writer.flush()
+            self._log(self._next, stats, len(payloads))
+            self._next += 1
+
+    def _log(self, k:int, stats:np.ndarray, n_chunks:int):
+        # Only once the block's data is on disk
+        self.done[k] = stats
+        self._progress.write(json.dumps(dict(block=k, chunks=n_chunks, stats=stats.tolist())) + '\n')
+        self._progress.flush()
+
+    def finish(self):
+        if self.writer is not None:
+            self.writer.close()
+        self._progress.close()
+        total = np.array([[0], [0], [0], [np.nan], [np.nan]]) * np.ones(self.meta['n_channels'])
+        for k in sorted(self.done):
+            total = merge_stats(total, self.done[k])
+        count, mean, m2, lo, hi = total
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.sqrt(m2 / (count - 1))
+        units = 'raw' if self.params['raw'] and 'scaling_coeffs' in self.meta else self.meta.get('units', 'V')
+        summary = {name: dict(count=int(count[i]), mean=mean[i] if count[i] else None,
+                              std=std[i] if count[i] > 1 else None,
+                              min=lo[i] if count[i] else None, max=hi[i] if count[i] else None, units=units)
+                   for i, name in enumerate(self.meta['channel_names'])}
+        with open(self.stats_path, 'w') as f:
+            json.dump(summary, f, indent=2)
+        os.remove(self.progress_path)
+        self.finished = True
+
+
+def convert(paths:list, out_dir:str='.', fmt:str='npy', block_sec:float=10.0, decimate:int=1,
+            method:str='mean', raw:bool=False, codec:str='zlib', level:int=1, workers:int=0,
+            overwrite:bool=False, n_channels:int=None, sample_rate:float=None, dtype:str='float64') -> list:
+    # n_channels/sample_rate/dtype: layout of the legacy recordings without a header, which are skipped if not given
+    if fmt not in ('npy', 'chunked'):
+        raise ValueError('Unknown format {}, use npy or chunked'.format(fmt))
+    if method not in ('mean', 'first'):
+        raise ValueError('Unknown decimation method {}, use mean or first'.format(method))
+    os.makedirs(out_dir, exist_ok=True)
+    conversions = []
+    for path in paths:
+        meta = read_header(path)
+        headerless = None
+        if meta is None:
+            if n_channels is None or sample_rate is None:
+                print('{}: no header, skipped (give --n-channels and --sample-rate to convert it)'.format(path))
+                continue
+            headerless = dict(n_channels=n_channels, sample_rate=sample_rate, dtype=np.dtype(dtype).str)
+            meta = open_recording(path, **headerless).meta
+        elif meta.get('events'):
+            print('{}: not a sample recording, skipped'.format(path))
+            continue
+        # Blocks are a whole number of decimation groups, so groups never straddle two workers
+        block = max(decimate, int(round(block_sec * meta['sample_rate'] / decimate)) * decimate)
+        params = dict(format=fmt, block_samples=block, decimate=decimate, method=method, raw=raw,
+                      codec=codec, level=level, chunk_samples=max(1, int(round(meta['sample_rate'] / decimate))),
+                      headerless=headerless)
+        conversion = Conversion(path, out_dir, params, overwrite)
+        if conversion.finished:
+            print('{}: already converted to {}, skipped'.format(path, conversion.out_path))
+            continue
+        conversions.append(conversion)
+
+    by_path = {conversion.path: conversion for conversion in conversions}
+    tasks = (task for conversion in conversions for task in conversion.tasks())
+    n_workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(n_workers) as pool:
+        # A bounded number of blocks in flight keeps memory flat for recordings of any length
+        running = set()
+        for task in tasks:
+            running.add(pool.submit(_convert_block, task))
+            if len(running) >= 2 * n_workers:
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                _collect(finished, by_path)
+        _collect(wait(running).done, by_path)
+
+    for conversion in conversions:
+        conversion.finish()
+        print('{} -> {} ({} blocks), stats in {}'.format(conversion.path, conversion.out_path,
+                                                         len(conversion.blocks), conversion.stats_path))
+    return [conversion.out_path for conversion in conversions]
+
+
+def _collect(futures, by_path:dict):
+    for future in futures:
+        path, k, stats, payloads = future.result()
+        by_path[path].add(k, stats, payloads)
+
+
+def main(recordings:List[str], *, output:str='.', format:str='npy', block_sec:float=10.0, decimate:int=1,
+         decimate_method:str='mean', raw:bool=False, codec:str='zlib', level:int=1, workers:int=0,
+         overwrite:bool=False, n_channels:Optional[int]=None, sample_rate:Optional[float]=None,
+         dtype:str='float64'):
+    """
+    Convert DAQLogger recordings to .npy or the chunked format, with summary statistics
+
+    :param recordings: .bin files written by DAQLogger, plain or chunked (event files are skipped)
+    :param output: directory for the converted files, <name>.npy (plus <name>.json metadata) or <name>.bin, and <name>.stats.json
+    :param format: npy or chunked
+    :param block_sec: seconds of data per block handed to a worker
+    :param decimate: keep one sample in N
+    :param decimate_method: mean of each group of N samples, or the first one
+    :param raw: keep raw ADC codes instead of converting them to volts
+    :param codec: compression of the chunked format, zlib, lzma or bz2
+    :param level: compression level
+    :param workers: worker processes, 0 for one per CPU
+    :param overwrite: convert again recordings whose output already exists
+    :param n_channels: number of channels of the legacy recordings without a header (skipped if not given)
+    :param sample_rate: sample rate of the legacy recordings without a header
+    :param dtype: sample type of the legacy recordings without a header
+    """
+    convert(recordings, output, format, block_sec, decimate, decimate_method, raw, codec, level, workers, overwrite,
+            n_channels, sample_rate, dtype)
+
+
+if __name__ == '__main__':
+    defopt.run(main)
@@ -1,13 +1,27 @@
+import json
+import time
+import threading
 import numpy as np
 from pathlib import Path
 from nidaq import AnalogInput, AngularEncoder
+from writer import AsyncWriter
+from recording import make_metadata, write_header
+from chunkstore import ChunkedWriter
+from events import EVENT_DTYPE
+from multidevice import AlignedMerger, split_channels, clock_terminals
 from pythonosc.udp_client import SimpleUDPClient
 
 class DAQLogger():
     # Inspired from
     # https://github.com/SWC-Advanced-Microscopy/SimplePyScanner
     # - Rob Campbell
-    # Output: binary file with the data formatted as np.float64
+    # Output: binary file with a self-describing header (see recording.py) followed by
+    # the data formatted as np.float64 (np.int16 ADC codes if raw=True), shape (n_samples, n_channels)
+    # AI channels on other cards are given with their device, e.g. ['ai0', 'ai1', 'Dev3/ai0']: every card
+    # gets its own task slaved to dev_name's sample clock and start trigger, and the samples of all
+    # cards are merged into the rows of the one AI recording (see multidevice.py). Rows hold the cards one
+    # after the other, dev_name first: ['ai0', 'Dev3/ai0', 'ai1'] is recorded, named and sent in the
+    # order ['ai0', 'ai1', 'Dev3/ai0'], together with its osc_address_ai and ai_thresholds.
 
     def __init__(self, dev_name:str = 'Dev2', ai_channels:list = [], 
                  voltage_range:float = 5, ci_channels = 'ctr0', 
@@ -16,15 +30,32 @@ class DAQLogger():
                  save_file_location_ci:str = '',
                  use_osc = True, osc_ip = "127.0.0.1", osc_port = "8888",
                  osc_address_ai = [], osc_address_ci = [],
+                 history_sec = 10, raw = False,
+                 writer_queue_size = 64, flush_interval = 1.0, fsync = False,
+                 backend = 'nidaqmx', sim_signals = None,
+                 stats_interval = 1.0, stats_address = '/stats',
+                 compression = None, compression_level = 1, compress_delta = True, compress_shuffle = True,
+                 ai_thresholds = None, hysteresis = 0.2, save_file_location_events:str = '',
                  autoconnect=True):
-        self.task_AIs = None
+        self.task_AIs = None # AI task of the card driving the clock
+        self.device_AIs = [] # AI task of every card, task_AIs first
+        self.merger_ai = None
         self.task_CIs = None
         self.dev_name = dev_name
+        self.devices = [dev_name]
         self.ai_channels = ai_channels
         self.voltage_range = voltage_range
         self.ci_channels = ci_channels
         self.sample_rate = sample_rate
         self.sample_size = sample_size
+        self.raw = raw # store unscaled int16 AI samples plus scaling coefficients (4x smaller files)
+        # Disk writes happen on a background thread; the callbacks only enqueue ring buffer views,
+        # so the ring buffer has to outlive every chunk that can be waiting in the writer
+        self.writer = AsyncWriter(max_queue=writer_queue_size, flush_interval=flush_interval, fsync=fsync)
+        self.history_size = max(int(history_sec * sample_rate), # samples kept in each task's ring buffer
+                                (self.writer.max_in_flight + 1) * sample_size)
+        self.backend = backend # 'nidaqmx' or 'simulated' (see simdaq.py)
+        self.sim_signals = dict(sim_signals or {}) # e.g. {'ai0': dict(kind='ttl', period=2.0)}, this logger's tasks only
         self.source_clock_ai = '' # This uses /ai/SampleClock
         self.source_clock_ci = '/{}/PFI0'.format(self.dev_name)
 
@@ -33,13 +64,36 @@ class DAQLogger():
         self.osc_port = osc_port
         self.osc_address_ai = osc_address_ai
         self.osc_address_ci = osc_address_ci
+        self.stats_interval = stats_interval # seconds between /stats OSC messages, None to disable
+        self.stats_address = stats_address
+        self._stats_stop = threading.Event()
+        self._stats_thread = None
+
+        # None for plain .bin files, or 'zlib', 'lzma', 'bz2' for 1 s chunks compressed on the
+        # writer thread (see chunkstore.py); delta/shuffle filters help slowly varying lines
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compress_delta = compress_delta
+        self.compress_shuffle = compress_shuffle
+
+        # Threshold crossings of the AI lines (one value in V, or one per channel with None to skip),
+        # sent as /<ai address>/event and saved to save_file_location_events (see events.py)
+        self.ai_thresholds = ai_thresholds
+        self.hysteresis = hysteresis
 
         self.save_file_location_ai = Path(save_file_location_ai)
         self.save_file_location_ci = Path(save_file_location_ci)
+        self.save_file_location_events = Path(save_file_location_events)
+        self.outFile_ai = None
+        self.outFile_ci = None
+        self.outFile_events = None
+        self._headers_written = False
         if save_file_location_ai != '':
-            self.outFile_ai = open(self.save_file_location_ai, 'wb')
+            self.outFile_ai = self._open_output(self.save_file_location_ai)
         if save_file_location_ci != '':
-            self.outFile_ci = open(self.save_file_location_ci, 'wb')
+            self.outFile_ci = self._open_output(self.save_file_location_ci)
+        if save_file_location_events != '':
+            self.outFile_events = open(self.save_file_location_events, 'wb')
 
         if autoconnect:
             if self.use_osc:
@@ -48,6 +102,14 @@ class DAQLogger():
             else:
                 self.set_up_tasks('read_buffer')              
 
+    def _open_output(self, path):
+        outfile = open(path, 'wb')
+        if self.compression is None:
+            return outfile
+        return ChunkedWriter(outfile, chunk_samples=int(self.sample_rate), codec=self.compression,
+                             level=self.compression_level, delta=self.compress_delta,
+                             shuffle=self.compress_shuffle)
+
     def set_up_osc(self):
         self.client = SimpleUDPClient(self.osc_ip, int(self.osc_port))  # Create and assign client
 
@@ -55,61 +117,205 @@ class DAQLogger():
         self.task_callback = task_callback
 
         if len(self.ai_channels) >0:
-            ai_channels_full = ['{}/{}'.format(self.dev_name, aiX) for aiX in self.ai_channels]
-            self.task_AIs = AnalogInput(ai_channels_full, 
-                                         min_value=-1*self.voltage_range, max_value=self.voltage_range)
-            self.task_AIs.set_datastream(self.sample_rate,
-                                          self.source_clock_ai,
-                                          self.source_clock_ci,
-                                          self.sample_size,
-                                          task_callback=task_callback,
-                                          outfile=self.outFile_ai)
-            if self.use_osc:
-                self.task_AIs.client = self.client
-                self.task_AIs.osc_address = self.osc_address_ai
+            devices, order = split_channels(self.ai_channels, self.dev_name)
+            if order != list(range(len(order))):
+                # Cards mixed out of order: put names, addresses and thresholds in the column order
+                # of the recorded rows, so that the header and every task see the channels they hold
+                self.ai_channels = [self.ai_channels[i] for i in order]
+                if isinstance(self.osc_address_ai, (list, tuple)) and len(self.osc_address_ai) == len(order):
+                    self.osc_address_ai = [self.osc_address_ai[i] for i in order]
+                if isinstance(self.ai_thresholds, (list, tuple)) and len(self.ai_thresholds) == len(order):
+                    self.ai_thresholds = [self.ai_thresholds[i] for i in order]
+            self.devices = list(devices)
+            sample_clock, start_trigger = clock_terminals(self.devices[0])
+            widths = [len(names) for names in devices.values()]
+            if len(devices) > 1 and self.outFile_ai is not None:
+                # Cards deliver their chunks independently; rows are written once all cards have them
+                self.merger_ai = AlignedMerger(self.outFile_ai, widths, dtype=np.int16 if self.raw else np.float64,
+                                               capacity=self.history_size)
+            offset = 0
+            for i, (device, names) in enumerate(devices.items()):
+                channels = slice(offset, offset + len(names))
+                thresholds = self.ai_thresholds
+                if isinstance(thresholds, (list, tuple)):
+                    thresholds = thresholds[channels]
+                task = AnalogInput(['{}/{}'.format(device, aiX) for aiX in names], 
+                                   min_value=-1*self.voltage_range, max_value=self.voltage_range,
+                                   threshold=thresholds, hysteresis=self.hysteresis,
+                                   raw=self.raw, backend=self.backend, sim_signals=self.sim_signals)
+                task.channel_offset = offset
+                outfile = self.outFile_ai if self.merger_ai is None else self.merger_ai.port(i)
+                task.set_datastream(self.sample_rate,
+                                    self.source_clock_ai if i == 0 else sample_clock,
+                                    self.source_clock_ci if i == 0 else None,
+                                    self.sample_size,
+                                    task_callback=task_callback,
+                                    outfile=self._queued(outfile),
+                                    history_size=self.history_size,
+                                    event_file=self._queued(self.outFile_events),
+                                    start_trigger=None if i == 0 else start_trigger)
+                if self.use_osc:
+                    task.client = self.client
+                    task.osc_address = self.osc_address_ai[channels]
+                self.device_AIs.append(task)
+                offset += len(names)
+            self.task_AIs = self.device_AIs[0]
 
         if self.ci_channels != '':
             if len(self.ai_channels) == 0:
                 raise NotImplementedError('DAQLogger cannot record events when only counter inputs are set!')
             else:
                 pass
-            self.task_CIs = AngularEncoder('{}/{}'.format(self.dev_name, self.ci_channels))
+            self.task_CIs = AngularEncoder('{}/{}'.format(self.dev_name, self.ci_channels), backend=self.backend,
+                                           sim_signals=self.sim_signals)
             self.task_CIs.set_datastream(self.sample_rate,
                                           self.source_clock_ci,
                                           self.sample_size,
                                           task_callback=task_callback,
-                                          outfile=self.outFile_ci)
+                                          outfile=self._queued(self.outFile_ci),
+                                          history_size=self.history_size)
             if self.use_osc:
                 self.task_CIs.client = self.client
                 self.task_CIs.osc_address = self.osc_address_ci
 
+    def _write_headers(self):
+        start_time = time.time()
+        if self.outFile_ai is not None:
+            extra = dict(scaling_coeffs=self._scaling_coeffs()) if self.raw else {}
+            if len(self.device_AIs) > 1:
+                extra['devices'] = self.devices
+            self._write_header(self.outFile_ai, make_metadata(self.ai_channels, self.sample_rate,
+                                                        dtype=np.int16 if self.raw else np.float64,
+                                                        start_time=start_time, device=self.dev_name,
+                                                        units='V', voltage_range=self.voltage_range,
+                                                        osc_address=self.osc_address_ai, **extra))
+        if self.outFile_ci is not None:
+            self._write_header(self.outFile_ci, make_metadata([self.ci_channels], self.sample_rate,
+                                                        start_time=start_time, device=self.dev_name,
+                                                        units='deg', osc_address=self.osc_address_ci))
+        if self.outFile_events is not None:
+            write_header(self.outFile_events, make_metadata(self.ai_channels, self.sample_rate, dtype=EVENT_DTYPE,
+                                                            start_time=start_time, device=self.dev_name,
+                                                            events=True, fields=EVENT_DTYPE.descr,
+                                                            thresholds=self.ai_thresholds,
+                                                            hysteresis=self.hysteresis,
+                                                            osc_address=self.osc_address_ai))
+        self._headers_written = True
+
+    def _scaling_coeffs(self):
+        # Per-channel coefficients of all cards, padded to the same polynomial order
+        coeffs = [c for task in self.device_AIs for c in task.scaling_coeffs]
+        order = max(len(c) for c in coeffs)
+        return [c + [0.0] * (order - len(c)) for c in coeffs]
+
+    def _tasks(self):
+        # (name, task) of every task: 'AI' for the card driving the clock, 'AI:<device>' for the others, 'CI'
+        tasks = [('AI' if i == 0 else 'AI:{}'.format(self.devices[i]), task) for i, task in enumerate(self.device_AIs)]
+        if self.task_CIs is not None:
+            tasks.append(('CI', self.task_CIs))
+        return tasks
+
+    def _write_header(self, outfile, meta):
+        if isinstance(outfile, ChunkedWriter):
+            outfile.write_header(meta) # adds the compression settings
+        else:
+            write_header(outfile, meta)
+
+    def _queued(self, outfile):
+        return self.writer.stream(outfile) if outfile is not None else None
+
     def send_oscmsg(self, address, msg):
         self.client.send_message(address, msg) 
 
+    def get_stats(self) -> dict:
+        # Acquisition health of each task (see health.py) and of the disk writer
+        stats = {}
+        for name, task in self._tasks():
+            if task.stats is not None:
+                stats[name] = task.stats.snapshot()
+        if len(self.device_AIs) > 1:
+            stats['sync'] = self.get_sync_stats()
+        stats['writer'] = dict(queue=self.writer.queue.qsize(), max_queue=self.writer.max_queue,
+                               high_water_mark=self.writer.high_water_mark, stalls=self.writer.stalls,
+                               bytes_written=self.writer.bytes_written,
+                               chunks_written=self.writer.chunks_written,
+                               error=None if self.writer.error is None else str(self.writer.error))
+        return stats
+
+    def get_sync_stats(self) -> dict:
+        # Sample-count agreement of the cards. With a shared clock they read the same number of
+        # samples, give or take the one chunk whose callback has not run yet on some card.
+        read = [task.stats.samples_read for task in self.device_AIs]
+        sync = dict(devices=self.devices, samples_read=read, read_skew=max(read) - min(read))
+        if self.merger_ai is not None:
+            sync.update(self.merger_ai.snapshot())
+        sync['skew_suspected'] = (sync['read_skew'] > self.sample_size
+                                  or sync.get('padded_samples', 0) > 0 or sync.get('dropped_samples', 0) > 0)
+        return sync
+
+    def _publish_stats(self):
+        # Runs on its own thread so that the callbacks never pay for JSON encoding
+        while not self._stats_stop.wait(self.stats_interval):
+            try:
+                self.client.send_message(self.stats_address, json.dumps(self.get_stats()))
+            except OSError as e:
+                print('Could not publish stats: {}'.format(e))
+
     def start_acquisition(self):
         print('Stating the task!')
+        if not self._headers_written:
+            # Written before the writer thread owns the files
+            self._write_headers()
+        self.writer.start()
+        # Cards slaved to the shared clock are armed first; starting task_AIs triggers them all
+        for name, task in self._tasks()[1:len(self.device_AIs)]:
+            task.start()
+            self._print_task_status('start', name)
         if self.task_AIs is not None:
             self.task_AIs.start()
             self._print_task_status('start', 'AI')
         if self.task_CIs is not None:
             self.task_CIs.start()
             self._print_task_status('start', 'CI')
+        if self.use_osc and self.stats_interval:
+            self._stats_stop.clear()
+            self._stats_thread = threading.Thread(target=self._publish_stats, name='DAQLoggerStats', daemon=True)
+            self._stats_thread.start()
 
     def stop_acquisition(self):
         print('Stopping the task...')
-        if self.task_AIs is not None:
-            self.task_AIs.stop()
-            self._print_task_status('stop', 'AI')
-        if self.task_CIs is not None:
-            self.task_CIs.stop()
-            self._print_task_status('stop', 'CI')
+        if self._stats_thread is not None:
+            self._stats_stop.set()
+            self._stats_thread.join()
+            self._stats_thread = None
+        for name, task in self._tasks():
+            task.stop()
+            self._print_task_status('stop', name)
+        self.writer.drain()
+        if len(self.device_AIs) > 1:
+            sync = self.get_sync_stats()
+            print('Devices {}: samples read {}, max skew {} samples{}'.format(
+                ', '.join(sync['devices']), sync['samples_read'], sync.get('max_skew', sync['read_skew']),
+                ' - SKEW BETWEEN DEVICES' if sync['skew_suspected'] else ''))
+        print('Writer queue high-water mark: {}/{} chunks ({} stalls)'.format(
+            self.writer.high_water_mark, self.writer.max_queue, self.writer.stalls))
 
     def close_tasks(self):
         print('Closing the task...')
-        if self.task_AIs is not None:
-            self.task_AIs.close()
-        if self.task_CIs is not None:
-            self.task_CIs.close()
+        for _, task in self._tasks():
+            task.close()
+        self.writer.close()
+        if self.merger_ai is not None:
+            self.merger_ai.finish()
+            if self.merger_ai.trimmed_samples:
+                print('Left out the last {} samples, not delivered by every device before stop'.format(
+                    self.merger_ai.trimmed_samples))
+        for outfile in (self.outFile_ai, self.outFile_ci, self.outFile_events):
+            if outfile is not None:
+                outfile.close()
+                if isinstance(outfile, ChunkedWriter):
+                    print('Compressed {:.1f} MB to {:.1f} MB ({:.1f}x)'.format(
+                        outfile.raw_bytes / 1e6, outfile.compressed_bytes / 1e6, outfile.ratio))
     
     def _print_task_status(self, status, channel):
         if status == 'start':
@@ -123,5 +329,8 @@ class DAQLogger():
                     pass
         elif status == 'stop':
             print('Acquisition stopped for {}'.format(channel))
+            task = dict(self._tasks())[channel]
+            if task.stats is not None:
+                print('  {}'.format(task.stats.summary()))
         elif status == 'close':
             pass
\ No newline at end of file
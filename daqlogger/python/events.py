@@ -0,0 +1,90 @@
+import numpy as np
+from pythonosc.osc_message_builder import OscMessageBuilder
+
+from recording import read_header
+
+# Threshold crossings of analog lines (licks, stimulus TTLs, ...), detected per callback chunk.
+# Event files have the usual recording header (meta['events'] is True) followed by EVENT_DTYPE records.
+EVENT_DTYPE = np.dtype([('sample', '<i8'), ('channel', '<u2'), ('rising', 'u1')])
+
+
+class ThresholdDetector:
+    # Schmitt trigger per channel, vectorized over a whole (n_channels, n_samples) chunk.
+    # A line goes high above `high` and low below `low`; in between it keeps its previous
+    # state, which is carried over from the previous chunk, so an edge split across two
+    # callbacks is reported exactly once, at the sample where it happened. A line is undecided (-1)
+    # until its first sample outside the band, and leaving that state is not an edge.
+
+    def __init__(self, high, low, channels=None, invert=None):
+        self.high = np.asarray(high, dtype=np.float64)[:, np.newaxis]
+        self.low = np.asarray(low, dtype=np.float64)[:, np.newaxis]
+        self.channels = np.arange(len(self.high)) if channels is None else np.asarray(channels, dtype=np.intp)
+        # Per channel: the line is high below `low` instead, e.g. raw codes of a negative-gain channel
+        self.invert = np.zeros((len(self.high), 1), dtype=bool) if invert is None else \
+            np.asarray(invert, dtype=bool)[:, np.newaxis]
+        self.state = np.full(len(self.high), -1, dtype=np.int8) # last state of each channel: 1 high, 0 low, -1 undecided
+
+    @classmethod
+    def from_thresholds(cls, thresholds, n_channels:int, hysteresis:float, gain=None, offset=None):
+        # thresholds: one value or one per channel (None to skip a channel), in volts.
+        # gain/offset convert them to raw ADC codes (volts = offset + gain * code) in raw mode.
+        if not isinstance(thresholds, (list, tuple)):
+            thresholds = [thresholds] * n_channels
+        channels = np.array([i for i, t in enumerate(thresholds) if t is not None], dtype=np.intp)
+        high = np.array([thresholds[i] + hysteresis / 2 for i in channels])
+        low = np.array([thresholds[i] - hysteresis / 2 for i in channels])
+        invert = None
+        if gain is not None:
+            gain = np.asarray(gain)[channels]
+            offset = np.asarray(offset)[channels]
+            high, low = (high - offset) / gain, (low - offset) / gain
+            # With a negative gain high volts are low codes: the bounds swap and so does the state
+            invert = gain < 0
+            high, low = np.maximum(high, low), np.minimum(high, low)
+        return cls(high, low, channels, invert)
+
+    def process(self, chunk:np.ndarray, first_sample:int) -> np.ndarray:
+        # chunk: (n_channels, n_samples) of all channels; returns EVENT_DTYPE records sorted by sample
+        data = chunk[self.channels]
+        n = data.shape[1]
+        if n == 0:
+            return np.empty(0, dtype=EVENT_DTYPE)
+        above, below = data > self.high, data < self.low
+        defined = above | below
+        above = np.where(self.invert, below, above) # the line is high
+
+        # Forward-fill the last decided state over the hysteresis band
+        last = np.where(defined, np.arange(n), -1)
+        np.maximum.accumulate(last, axis=1, out=last)
+        state = np.where(last >= 0, np.take_along_axis(above, np.maximum(last, 0), axis=1),
+                         self.state[:, np.newaxis]).astype(np.int8)
+
+        previous = np.concatenate((self.state[:, np.newaxis], state[:, :-1]), axis=1)
+        changed = (state != previous) & (previous >= 0)
+        self.state = state[:, -1].copy()
+
+        ch, idx = np.nonzero(changed)
+        events = np.empty(len(idx), dtype=EVENT_DTYPE)
+        events['sample'] = first_sample + idx
+        events['channel'] = self.channels[ch]
+        events['rising'] = state[ch, idx] == 1
+        return events[np.argsort(events['sample'], kind='stable')]
+
+
+def event_message(address:str, event, sample_rate:float):
+    # /<channel address>/event  rising (1) or falling (0), sample index, seconds since the first sample
+    builder = OscMessageBuilder(address=address + '/event')
+    builder.add_arg(int(event['rising']), OscMessageBuilder.ARG_TYPE_INT)
+    builder.add_arg(int(event['sample']), OscMessageBuilder.ARG_TYPE_INT64)
+    builder.add_arg(event['sample'] / sample_rate, OscMessageBuilder.ARG_TYPE_DOUBLE)
+    return builder.build()
+
+
+def read_events(path) -> np.ndarray:
+    # EVENT_DTYPE records of an event file written by DAQLogger
+    meta = read_header(path)
+    if meta is None or not meta.get('events'):
+        raise ValueError('{} is not a DAQLogger event file'.format(path))
+    events = np.fromfile(path, dtype=EVENT_DTYPE, offset=meta['data_offset'])
+    # Chunks of several cards are appended as their callbacks come
+    return events[np.argsort(events['sample'], kind='stable')]
@@ -1,11 +1,15 @@
 import numpy as np
 import matplotlib.pyplot as plt
+from recording import open_recording
 
 save_file_location_ai = './test_ai.bin'
 
-arr = np.fromfile(save_file_location_ai, dtype=np.float64) # Needs to be float64!
-plt.plot(arr)
+rec = open_recording(save_file_location_ai) # (n_samples, n_channels) memory map, nothing is loaded yet
+print('{} at {} Hz, started {}'.format(rec.channel_names, rec.sample_rate, rec.meta['start_time_iso']))
+t = np.arange(rec.shape[0]) / rec.sample_rate
+plt.plot(t, rec)
 plt.show()
 
 # If you want to save npy file...
-# np.save('./file.npy', arr)
\ No newline at end of file
+# np.save('./file.npy', rec)
+# or, for long recordings (block by block, in parallel, with summary stats): python convert.py --recordings test_ai.bin
@@ -0,0 +1,33 @@
+import time
+from daqmx_recorder import DAQLogger
+from recording import open_recording
+
+# DAQLogger without a DAQ card: synthetic signals from simdaq.py, real-time callbacks
+save_file_location_ai = './test_sim_ai.bin'
+save_file_location_ci = './test_sim_ci.bin'
+duration = 10 # sec
+
+Logger = DAQLogger(ai_channels=['ai0', 'ai1'],
+                    ci_channels = 'ctr0',
+                    sample_rate = 9000,
+                    sample_size = 1000,
+                    osc_ip = "127.0.0.1",
+                    osc_port = "59729",
+                    osc_address_ai = ['/ai0', '/ai1'],
+                    osc_address_ci = ['/ctr0'],
+                    save_file_location_ai = save_file_location_ai,
+                    save_file_location_ci = save_file_location_ci,
+                    backend = 'simulated',
+                    sim_signals = {'ai1': dict(kind='ttl', period=0.5, duty=0.2, high=5.0, noise=0.01)})
+Logger.start_acquisition()
+t_start = time.perf_counter()
+time.sleep(duration)
+Logger.stop_acquisition()
+elapsed = time.perf_counter() - t_start
+delays = [Logger.task_AIs.task.max_event_latency, Logger.task_CIs.task.max_event_latency]
+Logger.close_tasks()
+
+for path, delay in zip([save_file_location_ai, save_file_location_ci], delays):
+    rec = open_recording(path)
+    print('{}: {} samples in {:.2f} s ({:.0f} samples/s, expected {}), max callback delay {:.2f} ms'.format(
+        path, len(rec), elapsed, len(rec) / elapsed, Logger.sample_rate, delay * 1e3))
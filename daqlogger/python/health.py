@@ -0,0 +1,144 @@
+import time
+from bisect import bisect_right
+
+# Upper bin edges of the timing histograms, in ms; the last bin catches everything slower
+HISTOGRAM_EDGES_MS = [0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+
+class Histogram:
+    # Fixed log-spaced bins, cheap enough to update from a DAQmx callback
+
+    def __init__(self, edges_ms:list=HISTOGRAM_EDGES_MS):
+        self.edges = [e / 1e3 for e in edges_ms]
+        self.clear()
+
+    def clear(self):
+        self.counts = [0] * (len(self.edges) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value:float):
+        self.counts[bisect_right(self.edges, value)] += 1
+        self.n += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q:float) -> float:
+        # Upper edge (s) of the bin holding the q-th percentile, inf if it is the overflow bin
+        if self.n == 0:
+            return 0.0
+        rank = q / 100 * self.n
+        seen = 0
+        for edge, count in zip(self.edges + [float('inf')], self.counts):
+            seen += count
+            if seen >= rank:
+                return edge
+        return float('inf')
+
+    def as_dict(self) -> dict:
+        return dict(edges_ms=[e * 1e3 for e in self.edges], counts=list(self.counts), n=self.n,
+                    mean_ms=self.total / self.n * 1e3 if self.n else 0.0, max_ms=self.max * 1e3,
+                    p99_ms=self.percentile(99) * 1e3)
+
+
+class TaskStats:
+    # Health of one acquisition task, updated by its every-N-samples callback.
+    # Drops are detected by comparing the samples read plus those still waiting in the DAQmx
+    # input buffer with what the sample clock should have produced since it started (taken from
+    # the first callback, so the time the driver takes to start the task does not count); half a
+    # chunk or more of difference means samples were lost (or the clock is not running at the set rate).
+
+    def __init__(self, sample_rate:float, sample_size:int, buffer_size:int, bytes_per_chunk:int=0):
+        self.sample_rate = sample_rate
+        self.sample_size = sample_size
+        self.buffer_size = buffer_size # DAQmx input buffer, samples per channel
+        self.bytes_per_chunk = bytes_per_chunk # 0 when the callback does not write to disk
+        self.callback_time = Histogram()
+        self.callback_interval = Histogram()
+        self.reset()
+
+    def reset(self):
+        self.callback_time.clear()
+        self.callback_interval.clear()
+        self.t_start = None
+        self.t_last = None
+        self.callbacks = 0
+        self.samples_read = 0
+        self.bytes_written = 0
+        self.buffer_fill = 0 # samples per channel waiting in the DAQmx buffer at the last callback, before it read
+        self.start_latency = None # samples the clock was behind start() at the first callback
+        self.max_buffer_fill = 0
+        self.errors = 0
+        self.last_error = None
+
+    def start(self):
+        self.reset()
+        self.t_start = time.perf_counter()
+
+    def wrap(self, callback, in_stream, error_type):
+        # Time callback, sample the input buffer fill before it reads, count what it read and wrote
+        def timed_callback(*args):
+            t = time.perf_counter()
+            if self.t_last is not None:
+                self.callback_interval.add(t - self.t_last)
+            self.t_last = t
+            self.buffer_fill = in_stream.avail_samp_per_chan
+            if self.start_latency is None:
+                self.start_latency = max(0, self._expected(t) - self.buffer_fill)
+            if self.buffer_fill > self.max_buffer_fill:
+                self.max_buffer_fill = self.buffer_fill
+            try:
+                result = callback(*args)
+            except error_type as e:
+                self.errors += 1
+                self.last_error = str(e)
+                raise
+            finally:
+                self.callback_time.add(time.perf_counter() - t)
+            self.callbacks += 1
+            self.samples_read += self.sample_size
+            self.bytes_written += self.bytes_per_chunk
+            return result
+        return timed_callback
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.t_start if self.t_start is not None else 0.0
+
+    def _expected(self, t:float) -> int:
+        return int((t - self.t_start) * self.sample_rate)
+
+    @property
+    def missing_samples(self) -> int:
+        # Samples the clock should have produced by the last callback that were neither read before
+        # it nor waiting in the buffer then. buffer_fill was sampled before that callback's read,
+        # which samples_read already counts.
+        if self.t_last is None or self.callbacks == 0:
+            return 0
+        expected = self._expected(self.t_last) - self.start_latency
+        return max(0, expected - (self.samples_read - self.sample_size) - self.buffer_fill)
+
+    @property
+    def drops_suspected(self) -> bool:
+        return self.missing_samples >= self.sample_size // 2 or self.max_buffer_fill >= self.buffer_size
+
+    def snapshot(self) -> dict:
+        return dict(elapsed=self.elapsed, callbacks=self.callbacks, samples_read=self.samples_read,
+                    bytes_written=self.bytes_written, buffer_fill=self.buffer_fill,
+                    max_buffer_fill=self.max_buffer_fill, buffer_size=self.buffer_size,
+                    missing_samples=self.missing_samples, drops_suspected=self.drops_suspected,
+                    errors=self.errors, last_error=self.last_error,
+                    chunk_period_ms=self.sample_size / self.sample_rate * 1e3,
+                    callback_time=self.callback_time.as_dict(),
+                    callback_interval=self.callback_interval.as_dict())
+
+    def summary(self) -> str:
+        return ('{} callbacks, {} samples, {:.1f} MB written, callback mean {:.2f} ms / p99 < {:g} ms / max {:.2f} ms, '
+                'interval max {:.1f} ms (chunk {:.1f} ms), buffer fill max {}/{}, missing samples {}{}').format(
+            self.callbacks, self.samples_read, self.bytes_written / 1e6,
+            self.callback_time.as_dict()['mean_ms'], self.callback_time.percentile(99) * 1e3,
+            self.callback_time.max * 1e3, self.callback_interval.max * 1e3,
+            self.sample_size / self.sample_rate * 1e3, self.max_buffer_fill, self.buffer_size,
+            self.missing_samples, ' - DROPS SUSPECTED' if self.drops_suspected else '')
@@ -0,0 +1,128 @@
+import numpy as np
+
+# Acquisition over several DAQ cards sharing the first card's AI sample clock and start trigger.
+# Each card has its own AnalogInput task, callback and queued stream; AlignedMerger joins their
+# chunks by sample index into the rows of one recording on the writer thread.
+
+def split_channels(channels:list, default_device:str) -> tuple:
+    # ['ai0', 'Dev3/ai0', 'ai1'] -> ({'Dev2': ['ai0', 'ai1'], 'Dev3': ['ai0']}, [0, 2, 1])
+    # Unqualified channels are on default_device, which always comes first (it drives the clock).
+    # The merged rows hold the cards one after the other; order gives, for each column of a row,
+    # the index of its channel in `channels`.
+    devices = {default_device: []}
+    for i, channel in enumerate(channels):
+        device, _, name = channel.rpartition('/')
+        devices.setdefault(device or default_device, []).append((i, name))
+    devices = {device: channels for device, channels in devices.items() if channels}
+    order = [i for channels in devices.values() for i, _ in channels]
+    return {device: [name for _, name in channels] for device, channels in devices.items()}, order
+
+
+def clock_terminals(master:str) -> tuple:
+    # (sample clock, start trigger) the other cards are slaved to
+    return '/{}/ai/SampleClock'.format(master), '/{}/ai/StartTrigger'.format(master)
+
+
+class AlignedMerger:
+    # Writes (n_samples, sum of widths) rows once every device has delivered them. Chunks are
+    # copied into a pending block as they come, so the ring buffer views handed over by the
+    # callbacks are released immediately. A device running more than `capacity` samples ahead
+    # of another forces the oldest rows out with `fill` in the missing columns (padded_samples);
+    # the late samples of the lagging device are then skipped (dropped_samples).
+    # Only called from the writer thread.
+
+    def __init__(self, outfile, widths:list, dtype=np.float64, capacity:int=90000, fill=None):
+        self.outfile = outfile
+        self.widths = list(widths)
+        self.columns = np.concatenate(([0], np.cumsum(self.widths)))
+        self.capacity = int(capacity)
+        self.dtype = np.dtype(dtype)
+        if fill is None:
+            fill = np.nan if self.dtype.kind == 'f' else np.iinfo(self.dtype).min
+        self.fill = fill
+        self._pending = np.full((self.capacity, self.columns[-1]), fill, dtype=self.dtype)
+        self.written = 0 # rows written, i.e. absolute sample index of _pending[0]
+        self.received = [0] * len(self.widths) # samples received per device
+        self.max_skew = 0
+        self.padded_samples = 0
+        self.dropped_samples = 0
+        self.trimmed_samples = 0
+
+    def port(self, device:int):
+        # File-like input for one device, to be wrapped by AsyncWriter.stream()
+        return _MergerPort(self, device)
+
+    @property
+    def skew(self) -> int:
+        # Samples between the device furthest ahead and the one furthest behind
+        return max(self.received) - min(self.received)
+
+    def push(self, device:int, data:np.ndarray):
+        data = np.asarray(data)
+        if data.ndim == 1:
+            data = data[:, np.newaxis]
+        start = self.received[device]
+        self.received[device] += len(data)
+        self.max_skew = max(self.max_skew, self.skew)
+
+        overflow = self.received[device] - self.written - self.capacity
+        if overflow > 0:
+            self._emit(overflow, forced=True)
+        if start < self.written: # rows already forced out without this device
+            skip = min(self.written - start, len(data))
+            self.dropped_samples += skip
+            data = data[skip:]
+            start += skip
+        rows = slice(start - self.written, start - self.written + len(data))
+        self._pending[rows, self.columns[device]:self.columns[device + 1]] = data
+        complete = min(self.received) - self.written
+        if complete > 0:
+            self._emit(complete)
+
+    def _emit(self, n:int, forced:bool=False):
+        n = min(n, self.capacity)
+        if forced:
+            end = self.written + n
+            self.padded_samples += sum(min(max(end - max(received, self.written), 0), n)
+                                       for received in self.received)
+        self.outfile.write(self._pending[:n])
+        # Move the rows received beyond these to the front; everything after them is fill
+        ahead = min(max(max(self.received) - self.written - n, 0), self.capacity - n)
+        self._pending[:ahead] = self._pending[n:n + ahead]
+        self._pending[ahead:ahead + n] = self.fill
+        self.written += n
+
+    def finish(self):
+        # Rows only some devices delivered before the tasks were stopped are left out
+        self.trimmed_samples = max(self.received) - self.written
+
+    def flush(self):
+        self.outfile.flush()
+
+    def fileno(self):
+        return self.outfile.fileno()
+
+    def snapshot(self) -> dict:
+        return dict(samples=list(self.received), skew=self.skew, max_skew=self.max_skew,
+                    padded_samples=self.padded_samples, dropped_samples=self.dropped_samples,
+                    trimmed_samples=self.trimmed_samples)
+
+
+class _MergerPort:
+
+    def __init__(self, merger:AlignedMerger, device:int):
+        self.merger = merger
+        self.device = device
+
+    def write(self, data):
+        self.merger.push(self.device, data)
+
+    def writelines(self, chunks):
+        for data in chunks:
+            self.merger.push(self.device, data)
+
+    def flush(self):
+        self.merger.flush()
+
+    def fileno(self):
+        return self.merger.fileno()
@@ -1,28 +1,71 @@
 from __future__ import division, print_function
 from functools import partial
-
-import nidaqmx as daq
-from nidaqmx.constants import AcquisitionType, EncoderType, EncoderZIndexPhase, AngleUnits, \
-    AcquisitionType, Signal, TerminalConfiguration
+from types import SimpleNamespace
+
+try:
+    import nidaqmx as daq
+    from nidaqmx.constants import AcquisitionType, EncoderType, EncoderZIndexPhase, AngleUnits, \
+        AcquisitionType, Signal, TerminalConfiguration
+    from nidaqmx.stream_readers import AnalogMultiChannelReader, AnalogUnscaledReader, CounterReader
+except ImportError: # no NI-DAQmx on this machine, only the simulated backend is usable
+    daq = None
+    from simdaq import AcquisitionType, EncoderType, EncoderZIndexPhase, AngleUnits, \
+        Signal, TerminalConfiguration
 import numpy as np
-from nidaqmx.stream_readers import AnalogMultiChannelReader, CounterReader
 
 from pythonosc.udp_client import SimpleUDPClient
+
+import simdaq
+from ringbuffer import RingBuffer
+from oscframe import OSCFrame
+from health import TaskStats
+from events import ThresholdDetector, event_message
 # Adapted from exisitng works by Masahiro Nakano, Sandra Reinert in Mrsic-FLogel lab.
 # This script uses nidaqmx instead of pydaqmx
 
 
+def _new_task(backend, sim_signals:dict=None):
+    # sim_signals: synthetic signals of this task's channels, simulated backend only (see simdaq.set_signal)
+    if backend is simdaq:
+        return backend.Task(signals=sim_signals)
+    return backend.Task()
+
+
+def get_backend(name:str='nidaqmx'):
+    # Task, reader classes and DaqError of either the real driver or simdaq
+    if name == 'simulated':
+        return simdaq
+    if name != 'nidaqmx':
+        raise ValueError('Unknown DAQ backend: {}'.format(name))
+    if daq is None:
+        raise ImportError('nidaqmx is not installed, use backend="simulated" to run without a DAQ card')
+    return SimpleNamespace(Task=daq.Task, DaqError=daq.DaqError,
+                           AnalogMultiChannelReader=AnalogMultiChannelReader,
+                           AnalogUnscaledReader=AnalogUnscaledReader,
+                           CounterReader=CounterReader)
+
+
 class AnalogInput:
 
-    def __init__(self, chan:list, min_value:float, max_value:float, threshold=None):
-        self.data = []
+    def __init__(self, chan:list, min_value:float, max_value:float, threshold=None, raw:bool=False,
+                 backend:str='nidaqmx', hysteresis:float=0.2, sim_signals:dict=None):
+        self.buffer = None
+        self.stats = None
+        self.backend = get_backend(backend)
 
         self.chan = chan
         self.min_value = min_value
         self.max_value = max_value
+        # Volts, one value or one per channel (None to skip a channel): rising/falling crossings
+        # are detected in every chunk and sent/saved as events, see events.py
         self.threshold = threshold
+        self.hysteresis = hysteresis
+        self.detector = None
+        self.channel_offset = 0 # index of the first channel in the recording, for event channel numbers
+        self._client = None
+        self.raw = raw # read unscaled int16 ADC codes instead of float64 volts
         self.reader = None
-        self.task = daq.Task()
+        self.task = _new_task(self.backend, sim_signals)
         for aiX in self.chan:
             self.task.ai_channels.add_ai_voltage_chan(aiX,
                                                         min_val=self.min_value, 
@@ -30,37 +73,81 @@ class AnalogInput:
                                                         terminal_config=TerminalConfiguration.RSE)
 
     def set_datastream(self, sample_rate:int, source:str, clock_output:str='/Dev1/PFI0', sample_size:int=1000,
-                       task_callback='save_buffer', outfile=None):
+                       task_callback='save_buffer', outfile=None, history_size:int=None, event_file=None,
+                       start_trigger:str=None):
         # Configure the sampling rate and the number of samples
         task_callback = dict(read_buffer=self._read_buffer, 
                              save_buffer=self._save_buffer, 
                              osc_buffer=self._osc_buffer)[task_callback]
         self.outfile = outfile
+        self.event_file = event_file
         self.data_written = 0
+        self.sample_rate = sample_rate
+        self._frames = None
         
         self.task.timing.cfg_samp_clk_timing(sample_rate,
                                     source= source,
                                     samps_per_chan=sample_size,
                                     sample_mode=AcquisitionType.CONTINUOUS)
         
-        # Export the AI/SampleClock to PFI0 (default)
-        self.task.export_signals.export_signal(Signal.SAMPLE_CLOCK, clock_output)
-
-        self.reader = AnalogMultiChannelReader(self.task.in_stream)
+        # Export the AI/SampleClock to PFI0 (default); None on cards clocked by another card
+        if clock_output is not None:
+            self.task.export_signals.export_signal(Signal.SAMPLE_CLOCK, clock_output)
+        if start_trigger is not None:
+            # Armed until the card driving the shared sample clock starts, e.g. '/Dev1/ai/StartTrigger'
+            self.task.triggers.start_trigger.cfg_dig_edge_start_trig(start_trigger)
+
+        if self.raw:
+            self.reader = self.backend.AnalogUnscaledReader(self.task.in_stream)
+            self._read = self.reader.read_int16
+        else:
+            self.reader = self.backend.AnalogMultiChannelReader(self.task.in_stream)
+            self._read = self.reader.read_many_sample
         self.task.in_stream.input_buf_size = sample_size * 10
-        task_callback_selected = partial(task_callback, 
-                                          n_channels=len(self.chan), n_samples=sample_size)
+
+        # Preallocate everything the callbacks touch so that the hot path does not allocate
+        # DAQmx reads channel-major (n_channels, n_samples); the ring buffer stores (n_samples, n_channels)
+        self._chunk = np.zeros((len(self.chan), sample_size), dtype=self.dtype)
+        self._chunk_T = self._chunk.T
+        self.buffer = RingBuffer(max(history_size or sample_size * 10, sample_size), len(self.chan), dtype=self.dtype)
+        self.stats = TaskStats(sample_rate, sample_size, self.task.in_stream.input_buf_size,
+                               bytes_per_chunk=0 if task_callback == self._read_buffer else self._chunk.nbytes)
+        if self._thresholds() is not None:
+            coeffs = np.asarray(self.scaling_coeffs) if self.raw else None
+            self.detector = ThresholdDetector.from_thresholds(self.threshold, len(self.chan), self.hysteresis,
+                                                              gain=None if coeffs is None else coeffs[:, 1],
+                                                              offset=None if coeffs is None else coeffs[:, 0])
+        task_callback_selected = self.stats.wrap(partial(task_callback, 
+                                                         n_channels=len(self.chan), n_samples=sample_size),
+                                                 self.task.in_stream, self.backend.DaqError)
         self.task.register_every_n_samples_acquired_into_buffer_event(sample_size, task_callback_selected)
     
+    @property
+    def dtype(self):
+        return np.int16 if self.raw else np.float64
+
+    @property
+    def scaling_coeffs(self):
+        # Per-channel polynomial (c0 + c1*x + c2*x**2 + ...) converting raw ADC codes to volts
+        coeffs = [list(self.task.ai_channels[i].ai_dev_scaling_coeff) for i in range(len(self.chan))]
+        order = max(len(c) for c in coeffs)
+        return [c + [0.0] * (order - len(c)) for c in coeffs]
+
     def read_float(self):
         # deprecated
         value_box = daq.float64()
         self.task.ReadAnalogScalarF64(0, daq.byref(value_box), None)
         value = value_box.value
-        if self.threshold is not None:
-            value = value > self.threshold
+        threshold = self._thresholds()
+        if threshold is not None and threshold[0] is not None:
+            value = value > threshold[0] # the scalar read is of the first channel
         return value
 
+    def _thresholds(self):
+        # One threshold per channel, None when no channel has one (no detector, no events)
+        thresholds = self.threshold if isinstance(self.threshold, (list, tuple)) else [self.threshold] * len(self.chan)
+        return list(thresholds) if any(t is not None for t in thresholds) else None
+
     @property
     def client(self):
         return self._client
@@ -77,16 +164,41 @@ class AnalogInput:
     def osc_address(self, value:list):
         self._osc_address = value
 
+    def latest(self, n_samples:int=None):
+        # Most recent n_samples as a read-only (n_samples, n_channels) view of the ring buffer
+        return self.buffer.latest(n_samples)
+
+    def _make_frames(self, n_samples:int):
+        # One preallocated OSC blob per channel: float32 volts, or int16 codes with a linear
+        # gain/offset (first two scaling coefficients) in raw mode
+        if not self.raw:
+            return [OSCFrame(address, i, n_samples, self.sample_rate, dtype=np.float32)
+                    for i, address in enumerate(self.osc_address)]
+        coeffs = self.scaling_coeffs
+        return [OSCFrame(address, i, n_samples, self.sample_rate, dtype=np.int16,
+                         gain=coeffs[i][1], offset=coeffs[i][0])
+                for i, address in enumerate(self.osc_address)]
+
+    def _detect_events(self, n_samples:int):
+        # Threshold crossings of the chunk just read, to the event file and over OSC
+        events = self.detector.process(self._chunk, self.buffer.count - n_samples)
+        if len(events) == 0:
+            return
+        if self._client is not None:
+            for event in events:
+                self._client.send(event_message(self.osc_address[event['channel']], event, self.sample_rate))
+        if self.event_file is not None:
+            events['channel'] += self.channel_offset
+            self.event_file.write(events)
+
     # Callback functions
     def _read_buffer(self, taskHandle, eventType, samples, callbackData, 
                      n_channels:int, n_samples:int):
-        buffer = np.zeros((n_channels, n_samples), dtype=np.float64)
         try:
-            self.reader.read_many_sample(buffer, n_samples, timeout=0) 
+            self._read(self._chunk, n_samples, timeout=0) 
             # timeout = constants.WAIT_INFINITELY
-            data = buffer.T.astype(np.float64)
-            self.data.append(data)
-        except daq.DaqError:
+            self.buffer.write(self._chunk_T)
+        except self.backend.DaqError:
             self.stop()
             raise
 
@@ -94,16 +206,17 @@ class AnalogInput:
 
     def _save_buffer(self, taskHandle, eventType, samples, callbackData, 
                      n_channels:int, n_samples:int):
-        buffer = np.zeros((n_channels, n_samples), dtype=np.float64)
         try:
-            self.reader.read_many_sample(buffer, n_samples, timeout=0) 
+            self._read(self._chunk, n_samples, timeout=0) 
             # timeout = constants.WAIT_INFINITELY
-            data = buffer.T.astype(np.float64)
-            self.data.append(data)
+            self.buffer.write(self._chunk_T)
+            data = self.buffer.latest(n_samples)
 
-            self.outfile.write(data.tostring())
+            self.outfile.write(data)
             self.data_written += n_samples
-        except daq.DaqError:
+            if self.detector is not None:
+                self._detect_events(n_samples)
+        except self.backend.DaqError:
             self.stop()
             raise
 
@@ -113,25 +226,31 @@ class AnalogInput:
                      n_channels:int, n_samples:int):
         if self._client is None:
             raise ValueError('Set OSC client first!')
-        buffer = np.zeros((n_channels, n_samples), dtype=np.float64)
         try:
-            self.reader.read_many_sample(buffer, n_samples, timeout=0) 
+            self._read(self._chunk, n_samples, timeout=0) 
             # timeout = constants.WAIT_INFINITELY
-            data = buffer.T.astype(np.float64)
-            self.data.append(data)
+            self.buffer.write(self._chunk_T)
+            data = self.buffer.latest(n_samples)
 
-            self.outfile.write(data.tostring())
+            self.outfile.write(data)
             self.data_written += n_samples
-
-            for i, b in enumerate(buffer.tolist()):
-                self._client.send_message(self.osc_address[i], b)
-        except daq.DaqError:
+            if self.detector is not None:
+                self._detect_events(n_samples)
+
+            if self._frames is None:
+                self._frames = self._make_frames(n_samples)
+            first_sample = self.buffer.count - n_samples
+            for frame, samples in zip(self._frames, self._chunk):
+                self._client.send(frame.pack(samples, first_sample))
+        except self.backend.DaqError:
             self.stop()
             raise
 
         return 0 # always stop at 0 (reqiored DAQmx)
 
     def start(self):
+        if self.stats is not None:
+            self.stats.start()
         self.task.start()
 
     def stop(self):
@@ -141,21 +260,25 @@ class AnalogInput:
         if self.task is not None:
             self.task.close()
             self.task = None
-            self.data = []
+            if self.buffer is not None:
+                self.buffer.clear()
             self.data_written = 0
 
 
 class AngularEncoder:
 
     def __init__(self, chan, pulses_per_rev=1024, error_value=None,
-                 encoder_type=EncoderType.X_4, units=AngleUnits.DEGREES):
+                 encoder_type=EncoderType.X_4, units=AngleUnits.DEGREES, backend:str='nidaqmx',
+                 sim_signals:dict=None):
         # units=AngleUnits.TICKS
-        self.data = []
+        self.buffer = None
+        self.stats = None
+        self.backend = get_backend(backend)
 
         self.chan = chan
         self.error_value = error_value
         self.reader = None
-        self.task = daq.Task()
+        self.task = _new_task(self.backend, sim_signals)
         self.task.ci_channels.add_ci_ang_encoder_chan(chan,
                                                  "",
                                                  encoder_type,
@@ -165,23 +288,32 @@ class AngularEncoder:
                                                  pulses_per_rev, 0.0, "")
 
     def set_datastream(self, sample_rate:int, source:str, sample_size:int,
-                       task_callback='save_buffer', outfile=None):
+                       task_callback='save_buffer', outfile=None, history_size:int=None):
         # Configure the sampling rate and the number of samples
         task_callback = dict(read_buffer=self._read_buffer, 
                              save_buffer=self._save_buffer, 
                              osc_buffer=self._osc_buffer)[task_callback]
         self.outfile = outfile
         self.data_written = 0
+        self.sample_rate = sample_rate
+        self._frames = None
         self.task.timing.cfg_samp_clk_timing(sample_rate,
                                               source=source,
                                               samps_per_chan=sample_size,
                                               sample_mode=AcquisitionType.CONTINUOUS)
         # https://knowledge.ni.com/KnowledgeArticleDetails?id=kA00Z000000kEddSAE&l=en-GB
 
-        self.reader = CounterReader(self.task.in_stream)
+        self.reader = self.backend.CounterReader(self.task.in_stream)
         self.task.in_stream.input_buf_size = sample_size * 2
-        task_callback_selected = partial(task_callback, 
-                                          n_samples=sample_size)
+
+        self._chunk = np.zeros(sample_size, dtype=np.float64)
+        self._chunk_T = self._chunk[:, np.newaxis]
+        self.buffer = RingBuffer(max(history_size or sample_size * 10, sample_size), 1)
+        self.stats = TaskStats(sample_rate, sample_size, self.task.in_stream.input_buf_size,
+                               bytes_per_chunk=0 if task_callback == self._read_buffer else self._chunk.nbytes)
+        task_callback_selected = self.stats.wrap(partial(task_callback, 
+                                                         n_samples=sample_size),
+                                                 self.task.in_stream, self.backend.DaqError)
         self.task.register_every_n_samples_acquired_into_buffer_event(sample_size, task_callback_selected)
 
     def read_float(self):
@@ -206,16 +338,18 @@ class AngularEncoder:
     def osc_address(self, value:list):
         self._osc_address = value
 
+    def latest(self, n_samples:int=None):
+        # Most recent n_samples as a read-only (n_samples, n_channels) view of the ring buffer
+        return self.buffer.latest(n_samples)
+
     # Callback functions
     def _read_buffer(self, taskHandle, eventType, samples, callbackData, 
                      n_samples:int):
-        buffer = np.zeros(n_samples, dtype=np.float64)
         try:
-            self.reader.read_many_sample_double(buffer, n_samples, timeout=0) 
+            self.reader.read_many_sample_double(self._chunk, n_samples, timeout=0) 
             # timeout = constants.WAIT_INFINITELY
-            data = buffer.T.astype(np.float64)
-            self.data.append(data)
-        except daq.DaqError:
+            self.buffer.write(self._chunk_T)
+        except self.backend.DaqError:
             self.stop()
             raise
 
@@ -223,16 +357,15 @@ class AngularEncoder:
 
     def _save_buffer(self, taskHandle, eventType, samples, callbackData, 
                      n_samples:int):
-        buffer = np.zeros(n_samples, dtype=np.float64)
         try:
-            self.reader.read_many_sample_double(buffer, n_samples, timeout=0) 
+            self.reader.read_many_sample_double(self._chunk, n_samples, timeout=0) 
             # timeout = constants.WAIT_INFINITELY
-            data = buffer.T.astype(np.float64)
-            self.data.append(data)
+            self.buffer.write(self._chunk_T)
+            data = self.buffer.latest(n_samples)
 
-            self.outfile.write(data.tostring())
+            self.outfile.write(data)
             self.data_written += n_samples
-        except daq.DaqError:
+        except self.backend.DaqError:
             self.stop()
             raise
 
@@ -242,24 +375,28 @@ class AngularEncoder:
                      n_samples:int):
         if self._client is None:
             raise ValueError('Set OSC client first!')
-        buffer = np.zeros(n_samples, dtype=np.float64)
         try:
-            self.reader.read_many_sample_double(buffer, n_samples, timeout=0) 
+            self.reader.read_many_sample_double(self._chunk, n_samples, timeout=0) 
             # timeout = constants.WAIT_INFINITELY
-            data = buffer.T.astype(np.float64)
-            self.data.append(data)
+            self.buffer.write(self._chunk_T)
+            data = self.buffer.latest(n_samples)
 
-            self.outfile.write(data.tostring())
+            self.outfile.write(data)
             self.data_written += n_samples
 
-            self._client.send_message(self.osc_address[0], buffer) 
-        except daq.DaqError:
+            if self._frames is None:
+                # float64 keeps sub-degree resolution of the cumulative angle in long sessions
+                self._frames = [OSCFrame(self.osc_address[0], 0, n_samples, self.sample_rate, dtype=np.float64)]
+            self._client.send(self._frames[0].pack(self._chunk, self.buffer.count - n_samples))
+        except self.backend.DaqError:
             self.stop()
             raise
 
         return 0 # always stop at 0 (reqiored DAQmx)
     
     def start(self):
+        if self.stats is not None:
+            self.stats.start()
         self.task.start()
 
     def stop(self):
@@ -269,5 +406,6 @@ class AngularEncoder:
         if self.task is not None:
             self.task.close()
             self.task = None
-            self.data = []
+            if self.buffer is not None:
+                self.buffer.clear()
             self.data_written = 0
\ No newline at end of file
@@ -0,0 +1,66 @@
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+# Binary OSC transport for whole sample buffers.
+# Each chunk of each channel is one OSC message with a single blob argument:
+#   FRAME_HEADER (magic, dtype code, channel id, n_samples, first sample index, sample rate, gain, offset)
+#   followed by n_samples little-endian samples.
+# int16 samples are converted with value = raw * gain + offset on the receiving side.
+# DAQViewer decodes them with decode_frame below.
+FRAME_MAGIC = b'DQF1'
+FRAME_HEADER = struct.Struct('<4sBBxxIQdff')
+FRAME_DTYPES = {0: '<f4', 1: '<i2', 2: '<f8'}
+FRAME_DTYPE_CODES = {np.dtype(v): k for k, v in FRAME_DTYPES.items()}
+
+
+def _osc_string(value:str) -> bytes:
+    data = value.encode('utf-8') + b'\x00'
+    return data + b'\x00' * (-len(data) % 4)
+
+
+class OSCFrame:
+    # Preallocated OSC datagram for one channel. pack() writes the header and copies the
+    # samples straight into the datagram, so nothing is allocated per chunk.
+    # UDPClient.send() only needs the .dgram attribute.
+
+    def __init__(self, address:str, channel_id:int, n_samples:int, sample_rate:float,
+                 dtype=np.float32, gain:float=1.0, offset:float=0.0):
+        dtype = np.dtype(dtype).newbyteorder('<')
+        self.dtype_code = FRAME_DTYPE_CODES[dtype]
+        self.channel_id = channel_id
+        self.n_samples = n_samples
+        self.sample_rate = sample_rate
+        self.gain = gain
+        self.offset = offset
+
+        prefix = _osc_string(address) + _osc_string(',b')
+        blob_size = FRAME_HEADER.size + n_samples * dtype.itemsize
+        self.dgram = bytearray(len(prefix) + 4 + blob_size + (-blob_size % 4))
+        self.dgram[:len(prefix)] = prefix
+        struct.pack_into('>i', self.dgram, len(prefix), blob_size)
+        self._header_offset = len(prefix) + 4
+        self.samples = np.frombuffer(self.dgram, dtype=dtype, count=n_samples,
+                                     offset=self._header_offset + FRAME_HEADER.size)
+
+    def pack(self, samples:np.ndarray, first_sample:int):
+        FRAME_HEADER.pack_into(self.dgram, self._header_offset, FRAME_MAGIC, self.dtype_code, self.channel_id,
+                               self.n_samples, first_sample, self.sample_rate, self.gain, self.offset)
+        self.samples[...] = samples
+        return self
+
+
+Frame = namedtuple('Frame', ['channel', 'first_sample', 'sample_rate', 'samples'])
+
+
+def decode_frame(blob:bytes) -> Frame:
+    # Samples of a received frame as a read-only view of the blob, float32 volts for raw ADC codes
+    magic, dtype_code, channel, n_samples, first_sample, sample_rate, gain, offset = \
+        FRAME_HEADER.unpack_from(blob)
+    if magic != FRAME_MAGIC:
+        raise ValueError('Not a DAQLogger sample frame')
+    samples = np.frombuffer(blob, dtype=FRAME_DTYPES[dtype_code], count=n_samples, offset=FRAME_HEADER.size)
+    if dtype_code == 1: # raw ADC codes
+        samples = samples * np.float32(gain) + np.float32(offset)
+    return Frame(channel, first_sample, sample_rate, samples)
@@ -0,0 +1,147 @@
+import json
+import os
+import struct
+import time
+
+import numpy as np
+
+# On-disk layout of a DAQLogger recording (.bin)
+#   [0, HEADER_SIZE)  fixed header: magic, format version, JSON metadata length, JSON metadata (zero padded)
+#   [HEADER_SIZE, EOF) contiguous C-ordered (n_samples, n_channels) sample block
+# The number of samples is never stored; it follows from the file size, so a recording
+# that was cut short (crash, power loss) is still readable up to the last complete sample.
+# Recordings made with compression have the same header followed by compressed chunks (see chunkstore.py).
+MAGIC = b'DAQVREC\x00'
+FORMAT_VERSION = 1
+HEADER_SIZE = 4096
+_PREFIX = struct.Struct('<8sHI')
+
+
+def make_metadata(channel_names:list, sample_rate:float, dtype=np.float64, start_time:float=None, **kwargs) -> dict:
+    start_time = time.time() if start_time is None else start_time
+    meta = dict(version=FORMAT_VERSION,
+                dtype=np.dtype(dtype).str,
+                n_channels=len(channel_names),
+                channel_names=list(channel_names),
+                sample_rate=float(sample_rate),
+                start_time=start_time,
+                start_time_iso=time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(start_time)))
+    meta.update(kwargs)
+    return meta
+
+
+def write_header(outfile, meta:dict):
+    payload = json.dumps(meta).encode('utf-8')
+    if _PREFIX.size + len(payload) > HEADER_SIZE:
+        raise ValueError('Recording metadata is too large for the {} byte header'.format(HEADER_SIZE))
+    header = bytearray(HEADER_SIZE)
+    _PREFIX.pack_into(header, 0, MAGIC, FORMAT_VERSION, len(payload))
+    header[_PREFIX.size:_PREFIX.size + len(payload)] = payload
+    outfile.write(header)
+
+
+def read_header(path) -> dict:
+    # Returns None for legacy headerless files
+    with open(path, 'rb') as f:
+        prefix = f.read(_PREFIX.size)
+        if len(prefix) < _PREFIX.size:
+            return None
+        magic, version, length = _PREFIX.unpack(prefix)
+        if magic != MAGIC:
+            return None
+        if version > FORMAT_VERSION:
+            raise ValueError('{} uses recording format v{}, this reader supports up to v{}'.format(
+                path, version, FORMAT_VERSION))
+        meta = json.loads(f.read(length).decode('utf-8'))
+    meta['data_offset'] = HEADER_SIZE
+    return meta
+
+
+def scale_raw(raw:np.ndarray, coeffs, out:np.ndarray=None) -> np.ndarray:
+    # Apply per-channel scaling polynomials to raw ADC codes of shape (..., n_channels).
+    # coeffs: (n_channels, order + 1), lowest order first as reported by DAQmx
+    coeffs = np.asarray(coeffs, dtype=np.float64)
+    if out is None:
+        out = np.empty(raw.shape, dtype=np.float64)
+    out[...] = coeffs[:, -1]
+    for k in range(coeffs.shape[1] - 2, -1, -1): # Horner's scheme
+        out *= raw
+        out += coeffs[:, k]
+    return out
+
+
+class Recording(np.memmap):
+    # np.memmap that keeps the recording metadata through slicing
+
+    def __array_finalize__(self, obj):
+        super().__array_finalize__(obj)
+        self.meta = getattr(obj, 'meta', None)
+
+    @property
+    def sample_rate(self):
+        return self.meta['sample_rate']
+
+    @property
+    def channel_names(self):
+        return self.meta['channel_names']
+
+    @property
+    def scaled(self):
+        # Physical units, converted lazily for whatever is sliced. Recordings
+        # made in raw mode store int16 ADC codes plus 'scaling_coeffs' in the header.
+        if 'scaling_coeffs' not in self.meta:
+            return self
+        if self.ndim != 2 or self.shape[1] != self.meta['n_channels']:
+            # A column slice keeps the header, which no longer says which coefficients apply
+            raise ValueError('.scaled needs all {} channels, select them afterwards, e.g. rec.scaled[:, :2]'.format(
+                self.meta['n_channels']))
+        return _ScaledView(self)
+
+
+class _ScaledView:
+
+    def __init__(self, rec:Recording):
+        self.rec = rec
+        self.coeffs = np.asarray(rec.meta['scaling_coeffs'], dtype=np.float64)
+
+    @property
+    def shape(self):
+        return self.rec.shape
+
+    def __len__(self):
+        return len(self.rec)
+
+    def __getitem__(self, key):
+        # Scale all channels of the selected samples, then pick the requested channels
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        return scale_raw(np.asarray(self.rec[rows]), self.coeffs)[..., cols]
+
+    def __array__(self, dtype=None):
+        return self[:] if dtype is None else self[:].astype(dtype)
+
+
+def open_recording(path, mode:str='r', n_channels:int=None, sample_rate:float=None, dtype=np.float64) -> Recording:
+    # Memory-map a recording as (n_samples, n_channels) without reading it into memory.
+    # Compressed recordings are returned as a ChunkedRecording, which slices the same way.
+    # n_channels/sample_rate/dtype are only used for legacy headerless files (float64 samples).
+    meta = read_header(path)
+    if meta is None:
+        meta = make_metadata(['ch{}'.format(i) for i in range(n_channels or 1)],
+                             sample_rate or np.nan, dtype=dtype, start_time=os.path.getmtime(path), version=0)
+        meta['data_offset'] = 0
+
+    if 'compression' in meta:
+        from chunkstore import ChunkedRecording
+        return ChunkedRecording(path, meta)
+
+    dtype = np.dtype(meta['dtype'])
+    frame_size = dtype.itemsize * meta['n_channels']
+    n_samples = (os.path.getsize(path) - meta['data_offset']) // frame_size
+    if n_samples == 0:
+        # np.memmap cannot map an empty region
+        rec = np.zeros((0, meta['n_channels']), dtype=dtype).view(Recording)
+    else:
+        rec = Recording(path, dtype=dtype, mode=mode, offset=meta['data_offset'],
+                        shape=(n_samples, meta['n_channels']))
+    rec.meta = meta
+    return rec
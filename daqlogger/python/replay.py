@@ -0,0 +1,88 @@
+import time
+from typing import List
+
+import defopt
+import numpy as np
+from pythonosc.udp_client import SimpleUDPClient
+
+from oscframe import OSCFrame
+from recording import open_recording
+
+# Re-emit DAQLogger recordings to DAQViewer over OSC, exactly as AnalogInput/AngularEncoder._osc_buffer
+# would have sent them, so the viewer can be tested on machines without a DAQ card.
+
+
+class Replayer:
+
+    def __init__(self, paths:list, client:SimpleUDPClient, chunk_size:int=1000, speed:float=1.0):
+        self.client = client
+        self.chunk_size = chunk_size
+        self.speed = speed # 1 = real time, 0 = as fast as possible
+        self.recordings = [open_recording(path) for path in paths]
+        rates = {rec.sample_rate for rec in self.recordings}
+        if len(rates) != 1:
+            raise ValueError('Recordings have different sample rates: {}'.format(sorted(rates)))
+        self.sample_rate = rates.pop()
+        self.n_samples = min(len(rec) for rec in self.recordings)
+        self.frames = [self._make_frames(rec) for rec in self.recordings]
+        self.max_lateness = 0.0
+
+    def _make_frames(self, rec):
+        addresses = rec.meta.get('osc_address') or ['/{}'.format(name) for name in rec.channel_names]
+        if 'scaling_coeffs' in rec.meta: # raw mode, as AnalogInput._make_frames
+            return [OSCFrame(address, i, self.chunk_size, self.sample_rate, dtype=np.int16,
+                             gain=coeffs[1], offset=coeffs[0])
+                    for i, (address, coeffs) in enumerate(zip(addresses, rec.meta['scaling_coeffs']))]
+        # The encoder angle goes out as float64, analog inputs as float32
+        dtype = np.float64 if rec.meta.get('units') == 'deg' else np.float32
+        return [OSCFrame(address, i, self.chunk_size, self.sample_rate, dtype=dtype)
+                for i, address in enumerate(addresses)]
+
+    def run(self):
+        chunk_period = self.chunk_size / self.sample_rate
+        t_start = time.perf_counter()
+        n_chunks = self.n_samples // self.chunk_size
+        for k in range(n_chunks):
+            if self.speed > 0:
+                # A chunk is sent once it would have been fully acquired
+                self._wait_until(t_start + (k + 1) * chunk_period / self.speed)
+            first_sample = k * self.chunk_size
+            for rec, frames in zip(self.recordings, self.frames):
+                chunk = rec[first_sample:first_sample + self.chunk_size]
+                for i, frame in enumerate(frames):
+                    self.client.send(frame.pack(chunk[:, i], first_sample))
+        elapsed = time.perf_counter() - t_start
+        print('Replayed {} chunks ({:.1f} s of data) in {:.1f} s, max lateness {:.2f} ms'.format(
+            n_chunks, n_chunks * chunk_period, elapsed, self.max_lateness * 1e3))
+
+    def _wait_until(self, deadline:float):
+        # Sleep most of the way, then spin for the last millisecond to keep chunk timing accurate
+        remaining = deadline - time.perf_counter()
+        if remaining > 2e-3:
+            time.sleep(remaining - 1e-3)
+        while time.perf_counter() < deadline:
+            pass
+        self.max_lateness = max(self.max_lateness, time.perf_counter() - deadline)
+
+
+def main(recordings:List[str], *, ip:str='127.0.0.1', port:int=8888, chunk_size:int=1000,
+         speed:float=1.0, loop:bool=False):
+    """
+    Replay DAQLogger recordings to DAQViewer over OSC
+
+    :param recordings: .bin files written by DAQLogger (e.g. the AI and CI files of one session)
+    :param ip: DAQViewer IP address
+    :param port: DAQViewer port
+    :param chunk_size: samples per OSC message, as DAQLogger's sample_size
+    :param speed: playback speed, 1 for real time, 0 for as fast as possible
+    :param loop: start over at the end of the recordings
+    """
+    replayer = Replayer(recordings, SimpleUDPClient(ip, port), chunk_size=chunk_size, speed=speed)
+    while True:
+        replayer.run()
+        if not loop:
+            break
+
+
+if __name__ == '__main__':
+    defopt.run(main)
@@ -0,0 +1,53 @@
+import numpy as np
+
+
+class RingBuffer:
+    # Fixed-capacity sample history shared by the acquisition callbacks.
+    # Storage is mirrored (2 x capacity) so that the most recent N samples
+    # are always one contiguous (n_samples, n_channels) slice, i.e. a view
+    # that can be written to disk or sent over OSC without copying.
+
+    def __init__(self, capacity:int, n_channels:int, dtype=np.float64):
+        if capacity <= 0:
+            raise ValueError('capacity must be positive')
+        self.capacity = int(capacity)
+        self.n_channels = n_channels
+        self.dtype = np.dtype(dtype)
+        self._data = np.zeros((2 * self.capacity, n_channels), dtype=self.dtype)
+        self._head = 0 # next write position in [0, capacity)
+        self.count = 0 # total samples written since the last clear()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def write(self, chunk:np.ndarray):
+        # chunk: (n_samples, n_channels), e.g. the transposed DAQmx read buffer
+        n = chunk.shape[0]
+        if n > self.capacity:
+            raise ValueError('Chunk of {} samples does not fit in a ring buffer of {}'.format(n, self.capacity))
+        start = self._head
+        stop = start + n
+        self._data[start:stop] = chunk
+        if stop <= self.capacity:
+            self._data[start + self.capacity:stop + self.capacity] = chunk
+        else:
+            split = self.capacity - start
+            self._data[start + self.capacity:] = chunk[:split]
+            self._data[:stop - self.capacity] = chunk[split:]
+        self._head = stop % self.capacity
+        self.count += n
+
+    def latest(self, n_samples:int=None) -> np.ndarray:
+        # Return a read-only view of the most recent n_samples (oldest first)
+        available = len(self)
+        n_samples = available if n_samples is None else n_samples
+        if n_samples > available:
+            raise ValueError('Only {} samples available, {} requested'.format(available, n_samples))
+        stop = self._head + self.capacity
+        view = self._data[stop - n_samples:stop]
+        view.flags.writeable = False
+        return view
+
+    def clear(self):
+        self._head = 0
+        self.count = 0
@@ -0,0 +1,348 @@
+import threading
+import time
+from enum import Enum
+
+import numpy as np
+
+# Simulated stand-in for the parts of nidaqmx used by nidaq.py, for hardware-free runs.
+# Each task generates synthetic samples on a real-time clock thread into a bounded input
+# buffer and fires the every-N-samples callback from that thread, like DAQmx does, so
+# slow callbacks lead to the same buffer overflow errors as on a real card.
+# Select it with AnalogInput/AngularEncoder(..., backend='simulated') or DAQLogger(backend='simulated').
+
+
+class AcquisitionType(Enum):
+    CONTINUOUS = 10123
+    FINITE = 10178
+
+class EncoderType(Enum):
+    X_1 = 10090
+    X_2 = 10091
+    X_4 = 10092
+
+class EncoderZIndexPhase(Enum):
+    AHIGH_BHIGH = 10040
+
+class AngleUnits(Enum):
+    DEGREES = 10146
+    RADIANS = 10273
+    TICKS = 10304
+
+class Signal(Enum):
+    SAMPLE_CLOCK = 12487
+    START_TRIGGER = 12491
+
+class TerminalConfiguration(Enum):
+    RSE = 10083
+    DIFF = 10106
+
+
+class DaqError(Exception):
+
+    def __init__(self, message:str, error_code:int):
+        super().__init__('{} (error {})'.format(message, error_code))
+        self.error_code = error_code
+
+OVERWRITE_ERROR = -200279 # samples were overwritten before they were read
+TIMEOUT_ERROR = -200284 # requested samples not yet acquired
+
+
+_seed = None
+
+def set_seed(seed:int):
+    # Make the noise of tasks created afterwards repeatable
+    global _seed
+    _seed = seed
+
+
+# Synthetic signal per physical channel ('Dev1/ai0') or channel name ('ai0'), see set_signal().
+# Defaults for every task of the process; a Task's own `signals` take precedence.
+_signals = {}
+
+def set_signal(channel:str, kind:str='sine', **params):
+    """
+    kind and params:
+      sine     freq (Hz), amplitude, offset, phase (rad)
+      noise    offset, std
+      ttl      period (s), duty (0-1), high, low
+      ramp     rate (units/s), offset; e.g. a running wheel in degrees
+      constant offset
+    Any kind also accepts noise=<std> added on top.
+    """
+    _signals[channel] = dict(kind=kind, **params)
+
+def _signal_for(channel:str, default:dict, signals:dict=None) -> dict:
+    for table in (signals or {}, _signals):
+        for name in (channel, channel.split('/')[-1]):
+            if name in table:
+                return dict(table[name])
+    return default
+
+def _generate(spec:dict, t:np.ndarray, rng:np.random.Generator) -> np.ndarray:
+    kind = spec.get('kind', 'sine')
+    offset = spec.get('offset', 0.0)
+    if kind == 'sine':
+        y = offset + spec.get('amplitude', 1.0) * np.sin(2 * np.pi * spec.get('freq', 1.0) * t + spec.get('phase', 0.0))
+    elif kind == 'noise':
+        y = offset + rng.normal(0.0, spec.get('std', 1.0), len(t))
+    elif kind == 'ttl':
+        period = spec.get('period', 1.0)
+        high = (t % period) < spec.get('duty', 0.1) * period
+        y = np.where(high, spec.get('high', 5.0), spec.get('low', 0.0))
+    elif kind == 'ramp':
+        y = offset + spec.get('rate', 90.0) * t
+    elif kind == 'constant':
+        y = np.full(len(t), float(offset))
+    else:
+        raise ValueError('Unknown simulated signal kind: {}'.format(kind))
+    if spec.get('noise'):
+        y = y + rng.normal(0.0, spec['noise'], len(t))
+    return y
+
+
+class _Channel:
+
+    def __init__(self, name:str, default:dict, min_val:float=-10.0, max_val:float=10.0, signals:dict=None):
+        self.name = name
+        self.signal = _signal_for(name, default, signals)
+        self.min_val = min_val
+        self.max_val = max_val
+
+    @property
+    def ai_dev_scaling_coeff(self):
+        # Ideal 16-bit converter over the channel range
+        return [0.0, max(abs(self.min_val), abs(self.max_val)) / 32768.0]
+
+
+class _ChannelCollection(list):
+
+    def __init__(self, signals:dict=None):
+        super().__init__()
+        self.signals = signals
+
+    def add_ai_voltage_chan(self, physical_channel:str, name_to_assign_to_channel='', terminal_config=None,
+                            min_val=-5.0, max_val=5.0, **kwargs):
+        default = dict(kind='sine', freq=1.0 + len(self), amplitude=0.8 * max_val, noise=0.01 * max_val)
+        self.append(_Channel(physical_channel, default, min_val, max_val, self.signals))
+
+    def add_ci_ang_encoder_chan(self, counter:str, *args, **kwargs):
+        self.append(_Channel(counter, dict(kind='ramp', rate=90.0), signals=self.signals))
+
+
+class _Timing:
+
+    def __init__(self):
+        self.samp_clk_rate = 1000.0
+        self.samp_clk_src = ''
+
+    def cfg_samp_clk_timing(self, rate, source='', active_edge=None, sample_mode=None, samps_per_chan=1000):
+        self.samp_clk_rate = float(rate)
+        self.samp_clk_src = source
+
+
+# Start triggers of running tasks by terminal ('/Dev1/ai/StartTrigger'), for tasks slaved to another card
+_triggers = {}
+
+class _Trigger:
+
+    def __init__(self):
+        self.fired = threading.Event()
+        self.time = None # perf_counter() of the first sample clock tick
+
+
+class _StartTrigger:
+
+    def __init__(self):
+        self.source = None
+
+    def cfg_dig_edge_start_trig(self, trigger_source:str, trigger_edge=None):
+        self.source = trigger_source
+
+
+class _Triggers:
+
+    def __init__(self):
+        self.start_trigger = _StartTrigger()
+
+
+class _ExportSignals:
+
+    def export_signal(self, signal_id, output_terminal):
+        pass
+
+
+class _InStream:
+
+    def __init__(self, task):
+        self._task = task
+        self.input_buf_size = 10000
+
+    @property
+    def avail_samp_per_chan(self):
+        return self._task._written - self._task._read
+
+
+class Task:
+
+    def __init__(self, new_task_name='', signals:dict=None):
+        # signals: {channel: dict(kind=..., **params)} for this task only, as set_signal()
+        self.name = new_task_name
+        self.signals = dict(signals or {})
+        self.ai_channels = _ChannelCollection(self.signals)
+        self.ci_channels = _ChannelCollection(self.signals)
+        self.timing = _Timing()
+        self.export_signals = _ExportSignals()
+        self.triggers = _Triggers()
+        self.in_stream = _InStream(self)
+        self._callback = None
+        self._every_n = None
+        self._thread = None
+        self._running = False
+        self._rng = np.random.default_rng(_seed)
+        self._buffer = None
+        self._written = 0 # samples per channel generated since start
+        self._read = 0 # samples per channel read since start
+        self._overwritten = False
+        self._dropped = 0 # samples the clock produced that never reached the buffer, see drop_samples()
+        # Delay between the moment N samples were available and the callback being fired
+        self.event_latency = 0.0
+        self.max_event_latency = 0.0
+
+    @property
+    def channels(self):
+        return list(self.ai_channels) + list(self.ci_channels)
+
+    def register_every_n_samples_acquired_into_buffer_event(self, sample_interval:int, callback_method):
+        self._every_n = sample_interval
+        self._callback = callback_method
+
+    def start(self, realtime:bool=True):
+        # realtime=False leaves the clock to step(), for deterministic tests and benchmarks
+        if self._running:
+            return
+        self._buffer = np.zeros((len(self.channels), self.in_stream.input_buf_size), dtype=np.float64)
+        self._written = 0
+        self._read = 0
+        self._overwritten = False
+        self._dropped = 0
+        self._running = True
+        self._t_start = time.perf_counter()
+        if self.ai_channels and self.triggers.start_trigger.source is None:
+            # Other cards' tasks triggered by this one start on the same tick
+            trigger = _triggers.setdefault('/{}/ai/StartTrigger'.format(self.ai_channels[0].name.split('/')[0]),
+                                           _Trigger())
+            trigger.time = self._t_start
+            trigger.fired.set()
+        if realtime:
+            self._thread = threading.Thread(target=self._run, name='SimulatedDAQ', daemon=True)
+            self._thread.start()
+
+    def step(self):
+        # Acquire one callback's worth of samples and fire the callback on the calling thread
+        self._acquire(self._every_n)
+        if self._callback is not None:
+            self._callback(id(self), 0, self._every_n, None)
+
+    def drop_samples(self, n:int):
+        # Lose the next n samples of the clock before they reach the buffer, to test drop detection
+        self._dropped += n
+
+    def stop(self):
+        self._running = False
+        if self.ai_channels and self.triggers.start_trigger.source is None:
+            trigger = _triggers.get('/{}/ai/StartTrigger'.format(self.ai_channels[0].name.split('/')[0]))
+            if trigger is not None:
+                trigger.fired.clear()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def close(self):
+        self.stop()
+
+    def _run(self):
+        rate = self.timing.samp_clk_rate
+        n = self._every_n or int(rate / 10)
+        t_start = self._t_start
+        trigger = None
+        if self.triggers.start_trigger.source is not None:
+            # Armed: the shared clock starts with the task that exports the trigger, and stops with it
+            trigger = _triggers.setdefault(self.triggers.start_trigger.source, _Trigger())
+            while self._running and not trigger.fired.wait(0.05):
+                pass
+            t_start = trigger.time
+        fired = 0
+        while self._running and (trigger is None or trigger.fired.is_set()):
+            deadline = t_start + (fired + 1) * n / rate
+            remaining = deadline - time.perf_counter()
+            if remaining > 0:
+                time.sleep(remaining)
+            self._acquire(int((time.perf_counter() - t_start) * rate) - self._dropped - self._written)
+            while self._running and self._written >= (fired + 1) * n:
+                self.event_latency = time.perf_counter() - (t_start + (fired + 1) * n / rate)
+                self.max_event_latency = max(self.max_event_latency, self.event_latency)
+                fired += 1
+                if self._callback is not None:
+                    try:
+                        self._callback(id(self), 0, n, None)
+                    except Exception as e:
+                        print('Simulated task {} callback failed: {}'.format(self.name, e))
+                        self._running = False
+
+    def _acquire(self, n_new:int):
+        if n_new <= 0:
+            return
+        size = self._buffer.shape[1]
+        t = (self._written + np.arange(n_new)) / self.timing.samp_clk_rate
+        idx = (self._written + np.arange(n_new)) % size
+        for i, channel in enumerate(self.channels):
+            self._buffer[i, idx] = _generate(channel.signal, t, self._rng)
+        self._written += n_new
+        if self._written - self._read > size:
+            self._overwritten = True
+
+    def _read_into(self, data:np.ndarray, n:int):
+        # data: (n_channels, n) or (n,) for a single channel
+        if self._overwritten:
+            raise DaqError('Attempted to read samples that are no longer available. '
+                           'The requested sample was previously available, but has since been overwritten.',
+                           OVERWRITE_ERROR)
+        if self._written - self._read < n:
+            raise DaqError('Some or all of the samples requested have not yet been acquired.', TIMEOUT_ERROR)
+        idx = (self._read + np.arange(n)) % self._buffer.shape[1]
+        data[...] = self._buffer[:, idx].reshape(data.shape)
+        self._read += n
+
+
+class AnalogMultiChannelReader:
+
+    def __init__(self, task_in_stream:_InStream):
+        self._task = task_in_stream._task
+
+    def read_many_sample(self, data:np.ndarray, number_of_samples_per_channel:int, timeout:float=10.0):
+        self._task._read_into(data, number_of_samples_per_channel)
+        return number_of_samples_per_channel
+
+
+class AnalogUnscaledReader:
+
+    def __init__(self, task_in_stream:_InStream):
+        self._task = task_in_stream._task
+
+    def read_int16(self, data:np.ndarray, number_of_samples_per_channel:int, timeout:float=10.0):
+        volts = np.empty(data.shape, dtype=np.float64)
+        self._task._read_into(volts, number_of_samples_per_channel)
+        gains = np.array([c.ai_dev_scaling_coeff[1] for c in self._task.ai_channels])[:, np.newaxis]
+        np.clip(np.round(volts / gains), -32768, 32767, out=volts)
+        data[...] = volts
+        return number_of_samples_per_channel
+
+
+class CounterReader:
+
+    def __init__(self, task_in_stream:_InStream):
+        self._task = task_in_stream._task
+
+    def read_many_sample_double(self, data:np.ndarray, number_of_samples_per_channel:int, timeout:float=10.0):
+        self._task._read_into(data, number_of_samples_per_channel)
+        return number_of_samples_per_channel
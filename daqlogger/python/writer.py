@@ -0,0 +1,130 @@
+import os
+import queue
+import threading
+import time
+
+_FLUSH = object()
+_STOP = object()
+
+
+class AsyncWriter:
+    # Dedicated writer thread so that the DAQmx callbacks only ever enqueue.
+    # Queued items are ring buffer views (see ringbuffer.py) and are written without copying,
+    # so the ring buffer of each task must hold at least max_in_flight chunks.
+
+    def __init__(self, max_queue:int=64, batch_size:int=16, flush_interval:float=1.0, fsync:bool=False):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval # seconds, None to flush only on drain()
+        self.fsync = fsync
+
+        self.high_water_mark = 0 # largest queue size seen
+        self.stalls = 0 # number of times a callback found the queue full
+        self.bytes_written = 0
+        self.chunks_written = 0
+        self.error = None
+
+        self._files = []
+        self._thread = None
+        self._last_flush = time.perf_counter()
+
+    @property
+    def max_in_flight(self):
+        # queued + taken by the current batch + being written by a callback
+        return self.max_queue + self.batch_size + 1
+
+    def stream(self, outfile):
+        # File-like wrapper handed to the tasks in place of the real file
+        if outfile not in self._files:
+            self._files.append(outfile)
+        return _QueuedStream(self, outfile)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name='DAQLoggerWriter', daemon=True)
+        self._thread.start()
+
+    def put(self, outfile, data):
+        try:
+            self.queue.put_nowait((outfile, data))
+        except queue.Full:
+            # Disk cannot keep up: block rather than lose samples
+            self.stalls += 1
+            self.queue.put((outfile, data))
+        qsize = self.queue.qsize()
+        if qsize > self.high_water_mark:
+            self.high_water_mark = qsize
+
+    def drain(self):
+        # Block until everything queued so far is written and flushed
+        if self._thread is None or not self._thread.is_alive():
+            self._write_batch([]) # nothing running, just flush from here
+        else:
+            self.queue.put(_FLUSH)
+            self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.put(_FLUSH)
+            self.queue.put(_STOP)
+            self._thread.join()
+        self._thread = None
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = any(item is _STOP for item in batch)
+            flush = stop or any(item is _FLUSH for item in batch)
+            try:
+                self._write_batch([item for item in batch if item is not _FLUSH and item is not _STOP],
+                                  flush=flush)
+            except Exception as e:
+                print('DAQLogger writer failed: {}'.format(e))
+                self.error = e
+            for _ in batch:
+                self.queue.task_done()
+            if stop:
+                return
+
+    def _write_batch(self, items, flush=True):
+        # Consecutive chunks for the same file are handed over in one writelines() call
+        by_file = {}
+        for outfile, data in items:
+            by_file.setdefault(outfile, []).append(data)
+        for outfile, chunks in by_file.items():
+            outfile.writelines(chunks)
+            self.bytes_written += sum(chunk.nbytes for chunk in chunks)
+            self.chunks_written += len(chunks)
+
+        now = time.perf_counter()
+        if flush or (self.flush_interval is not None and now - self._last_flush >= self.flush_interval):
+            for outfile in self._files:
+                outfile.flush()
+                if self.fsync:
+                    os.fsync(outfile.fileno())
+            self._last_flush = now
+
+
+class _QueuedStream:
+
+    def __init__(self, writer:AsyncWriter, outfile):
+        self.writer = writer
+        self.outfile = outfile
+
+    def write(self, data):
+        self.writer.put(self.outfile, data)
@@ -0,0 +1,51 @@
+import math
+
+import numpy as np
+
+
+class EnvelopeDecimator:
+    # Incremental per-pixel min/max envelope of a streamed channel.
+    # Every bin of samples_per_bin samples is reduced to its minimum and maximum, emitted in
+    # the order they occurred with their own timestamps, so a single-sample spike or TTL
+    # edge always survives and the number of plotted points only depends on the pixel width.
+
+    def __init__(self, window_sec: float, sample_rate: float, pixel_width: int = 1000):
+        self.window_sec = window_sec
+        self.sample_rate = sample_rate
+        self.set_pixel_width(pixel_width)
+
+    def set_pixel_width(self, pixel_width: int) -> None:
+        self.pixel_width = max(int(pixel_width), 1)
+        self.samples_per_bin = max(1, math.ceil(self.window_sec * self.sample_rate / self.pixel_width))
+        self._t_rest = np.empty(0)
+        self._y_rest = np.empty(0)
+
+    @property
+    def max_points(self) -> int:
+        # Points needed to cover the whole window
+        return 2 * self.pixel_width
+
+    def push(self, t: np.ndarray, y: np.ndarray):
+        # Consume a chunk, return (t, y) of the envelope points completed by it
+        if self._y_rest.size:
+            t = np.concatenate((self._t_rest, t))
+            y = np.concatenate((self._y_rest, y))
+        full = len(y) // self.samples_per_bin * self.samples_per_bin
+        self._t_rest = t[full:].copy()
+        self._y_rest = y[full:].copy()
+        return minmax_envelope(t[:full], y[:full], self.samples_per_bin)
+
+
+def minmax_envelope(t: np.ndarray, y: np.ndarray, samples_per_bin: int):
+    # Min and max of each complete bin, in the order they occurred. A trailing partial bin is dropped.
+    n_bins = len(y) // samples_per_bin
+    if samples_per_bin == 1:
+        return t[:n_bins], y[:n_bins]
+    bins = y[:n_bins * samples_per_bin].reshape(n_bins, samples_per_bin)
+    i_min = bins.argmin(axis=1)
+    i_max = bins.argmax(axis=1)
+    start = np.arange(n_bins) * samples_per_bin
+    idx = np.empty(2 * n_bins, dtype=np.intp)
+    idx[0::2] = start + np.minimum(i_min, i_max)
+    idx[1::2] = start + np.maximum(i_min, i_max)
+    return t[idx], y[idx]
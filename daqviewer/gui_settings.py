@@ -30,5 +30,4 @@ class SettingsTab(QWidget):
             self.config_path = new_path
 
     def _apply_settings(self):
-        self.QtWindow.config = self.QtWindow.read_settings(self.config_path)
-        self.QtWindow.loadGUI(reload=True)
\ No newline at end of file
+        self.QtWindow.apply_settings(self.QtWindow.read_settings(self.config_path))
\ No newline at end of file
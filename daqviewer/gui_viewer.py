@@ -1,4 +1,7 @@
 import sys
+from collections import deque
+from math import inf
+from threading import Lock
 
 from PyQt5.QtWidgets import QWidget, QGridLayout, QLabel, QScrollArea
 from pglive.kwargs import Axis
@@ -8,6 +11,10 @@ from pglive.sources.live_plot import LiveLinePlot
 from pglive.sources.live_plot_widget import LivePlotWidget
 from pglive.sources.live_axis_range import LiveAxisRange
 
+from decimation import EnvelopeDecimator
+from staging import FrameStager
+from utils import input_rebuild_needed
+
 class ViewerTab(QWidget):
     def __init__(self, parent=None, config=None, plot_rate=60,**kwargs):
         super().__init__(parent=parent, **kwargs)
@@ -16,39 +23,96 @@ class ViewerTab(QWidget):
         self.layout.setContentsMargins(0,0,0,0)
         self.layout.setSpacing(0)
 
-        self.ndata = len(config['Inputs'].keys())
         self.update_rate = int(config['DAQSampleRate'] / config['DAQBufferSize'])
         self.plot_rate = plot_rate
-        self.x_points_range = int(self.update_rate * config['Xrange_sec'])
+        # Samples per x range; the connectors reduce these to a min/max envelope per pixel
+        self.x_points_range = int(config['DAQSampleRate'] * config['Xrange_sec'])
         self.max_points = self.x_points_range
+        self.sample_rate = config['DAQSampleRate']
+        self.xrange_sec = config['Xrange_sec']
+        self.inputs = dict(config['Inputs'])
         self.plot_widgets = []
         self._MultiDataConnector = {}
-        for i, (key, value) in enumerate(config['Inputs'].items()):
-            print('Setting plotting area for {}: {}'.format(key,value['Label']))
-            label_widget = QLabel(value['Label'])
-            label_widget.setFixedSize(100, 60)
-            # label_widget.setFont(QFont('Times', 10)) 
-            plot_curve = LiveLinePlot()
-            plot_widget = MiniLivePlotWidget(plot=plot_curve, 
-                                              # x_range_controller=LiveAxisRange(roll_on_tick=self.x_points_range)),
-                                              y_range=value['Yrange'] if "Yrange" in value else None)
+        self._rows = {} # input -> (label widget, plot widget), in display order
+        for key, value in config['Inputs'].items():
+            self._add_channel(key, value)
+        self._arrange()
+
+        # OSC handlers write to self.stager.channels; the connectors are fed from the GUI thread once per frame
+        self.stager = FrameStager(self._MultiDataConnector, self.plot_rate)
+
+        self.setLayout(self.layout)
+        # TODO: make this scrollable
+
+    def _add_channel(self, key, value):
+        print('Setting plotting area for {}: {}'.format(key,value['Label']))
+        label_widget = QLabel(value['Label'])
+        label_widget.setFixedSize(100, 60)
+        # label_widget.setFont(QFont('Times', 10)) 
+        plot_curve = LiveLinePlot()
+        plot_widget = MiniLivePlotWidget(plot=plot_curve, 
+                                          # x_range_controller=LiveAxisRange(roll_on_tick=self.x_points_range)),
+                                          y_range=value['Yrange'] if "Yrange" in value else None)
+        self._rows[key] = (label_widget, plot_widget)
+        # No update_rate throttling: a throttled append would silently drop a whole chunk
+        self._MultiDataConnector[key] = EnvelopeDataConnector(plot_curve, 
+                                                                EnvelopeDecimator(self.xrange_sec, self.sample_rate / value.get('Downsample', 1)),
+                                                                max_points=self.max_points, 
+                                                                update_rate=inf,
+                                                                plot_rate = self.plot_rate,
+                                                                ignore_auto_range=False)
+
+    def _remove_channel(self, key):
+        self._MultiDataConnector.pop(key).pause()
+        for widget in self._rows.pop(key):
+            self.layout.removeWidget(widget)
+            widget.deleteLater()
+
+    def _arrange(self):
+        # (Re)place the rows in settings order; only the bottom plot shows the time axis
+        for label_widget, plot_widget in self._rows.values():
+            self.layout.removeWidget(label_widget)
+            self.layout.removeWidget(plot_widget)
+        for i, (label_widget, plot_widget) in enumerate(self._rows.values()):
             self.layout.addWidget(label_widget,i,0)
             self.layout.addWidget(plot_widget,i,1)
-            self.plot_widgets.append(plot_widget)
-            self._MultiDataConnector[key] = DataConnector(plot_curve, 
-                                                            max_points=self.max_points, 
-                                                            update_rate=self.update_rate,
-                                                            plot_rate = self.plot_rate,
-                                                            ignore_auto_range=False)
+        self.plot_widgets = [plot_widget for _, plot_widget in self._rows.values()]
+        self.ndata = len(self.plot_widgets)
 
         for n in range(self.ndata)[:-1]:
             # self.plot_widgets[n].getPlotItem().hideAxis('bottom')
             self.plot_widgets[n].getAxis('bottom').setTextPen('#202124')
             self.plot_widgets[n].getAxis('bottom').setAxisPen('#202124')
             self.plot_widgets[n].setXLink(self.plot_widgets[-1])
+        if self.plot_widgets:
+            self.plot_widgets[-1].getAxis('bottom').setTextPen()
+            self.plot_widgets[-1].getAxis('bottom').setAxisPen()
+            self.plot_widgets[-1].setXLink(None)
 
-        self.setLayout(self.layout)
-        # TODO: make this scrollable
+    def update_inputs(self, inputs: dict) -> list:
+        # Apply a new Inputs section without touching unchanged channels. Label, Yrange and Wrap
+        # are changed in place and keep the buffered data; a channel whose other settings changed
+        # (Downsample, Source, kinematics) is rebuilt. Returns the inputs that got a new connector.
+        old = self.inputs
+        added = []
+        for key in list(self._rows):
+            if key not in inputs or input_rebuild_needed(old[key], inputs[key]):
+                self._remove_channel(key)
+                self.stager.remove_channel(key)
+        for key, value in inputs.items():
+            if key not in self._rows:
+                self._add_channel(key, value)
+                self.stager.add_channel(key, self._MultiDataConnector[key])
+                added.append(key)
+            elif value != old[key]:
+                label_widget, plot_widget = self._rows[key]
+                label_widget.setText(value['Label'])
+                plot_widget.set_y_range(value.get('Yrange'))
+        # Follow the order of the new settings file
+        self._rows = {key: self._rows[key] for key in inputs}
+        self._arrange()
+        self.inputs = dict(inputs)
+        return added
 
     @property
     def MultiDataConnector(self):
@@ -58,14 +122,58 @@ class ViewerTab(QWidget):
     def MultiDataConnector(self, value):
         self._MultiDataConnector = value
 
+class EnvelopeDataConnector(DataConnector):
+    # DataConnector that reduces full-rate chunks to a min/max envelope at the widget's
+    # pixel width before they reach pyqtgraph. Scalar points bypass the decimator.
+    def __init__(self, plot, decimator: EnvelopeDecimator, **kwargs):
+        super().__init__(plot, **kwargs)
+        self.decimator = decimator
+        self.decimator_lock = Lock()
+        self._resize_buffers(self.decimator.max_points)
+
+    def set_pixel_width(self, pixel_width: int) -> None:
+        if pixel_width == self.decimator.pixel_width:
+            return
+        with self.decimator_lock:
+            self.decimator.set_pixel_width(pixel_width)
+            self._resize_buffers(self.decimator.max_points)
+
+    def _resize_buffers(self, max_points: int) -> None:
+        with self.data_lock:
+            self.max_points = max_points
+            self.x = deque(self.x, maxlen=max_points)
+            self.y = deque(self.y, maxlen=max_points)
+
+    def cb_append_chunk(self, y, x) -> None:
+        # y, x: numpy arrays holding every sample of a chunk
+        if self.paused:
+            return
+        with self.decimator_lock:
+            t, v = self.decimator.push(x, y)
+        if len(v):
+            self.cb_append_data_array(v.tolist(), t.tolist())
+
 class MiniLivePlotWidget(LivePlotWidget):
     def __init__(self, parent=None, plot=None, y_range=None, **kwargs):
         bottom_axis = LiveAxis("bottom", **{Axis.TICK_FORMAT: Axis.TIME})
         super().__init__(parent=parent, plot=plot, background='#202124', axisItems={'bottom': bottom_axis},
                          **kwargs)
-        if y_range is not None:
-            self.y_range_controller=LiveAxisRange(fixed_range=y_range)
+        self.set_y_range(y_range)
         self.setFixedHeight(60)
 
         self.plot = plot
         self.addItem(self.plot)
+
+    def set_y_range(self, y_range=None):
+        # Fixed [min, max], or None to follow the data
+        if y_range is not None:
+            self.y_range_controller=LiveAxisRange(fixed_range=y_range)
+        else:
+            self.y_range_controller=LiveAxisRange()
+
+    def resizeEvent(self, ev):
+        super().resizeEvent(ev)
+        # Decimate to the number of pixels actually available
+        data_connector = getattr(self.plot, 'data_connector', None)
+        if isinstance(data_connector, EnvelopeDataConnector):
+            data_connector.set_pixel_width(self.width())
@@ -0,0 +1,108 @@
+import numpy as np
+
+# Running-wheel kinematics derived from the encoder angle, computed per OSC chunk.
+# Derived channels are ordinary entries of the settings Inputs with a Source, e.g.
+#   wheel_speed:
+#     Label: Speed
+#     Source: ctr0             # input carrying the encoder angle (degrees)
+#     Quantity: velocity       # position, velocity or acceleration
+#     Scale: 0.0436            # units per degree, e.g. cm for a 5 cm diameter wheel; default 1
+#     Smooth_sec: 0.05         # causal moving average applied to each stage; 0 to disable
+#     Smooth_passes: 2         # repeated moving averages, 2 gives a triangular kernel
+#     Downsample: 10           # keep every Nth sample after smoothing
+#     Unwrap: 360              # period of the incoming angle; null if it is already cumulative
+QUANTITIES = ('position', 'velocity', 'acceleration')
+
+
+class MovingAverage:
+    # Causal boxcar over n samples; the last n - 1 inputs are carried to the next chunk
+
+    def __init__(self, n: int):
+        self.n = max(int(n), 1)
+        self.history = None
+
+    def __call__(self, x: np.ndarray) -> np.ndarray:
+        if self.n == 1 or len(x) == 0:
+            return x
+        if self.history is None:
+            self.history = np.full(self.n - 1, x[0]) # start as if the line had been still
+        extended = np.concatenate((self.history, x))
+        csum = np.cumsum(extended)
+        y = csum[self.n - 1:].copy()
+        y[1:] -= csum[:-self.n]
+        y /= self.n
+        self.history = extended[-(self.n - 1):]
+        return y
+
+
+class _Smoother:
+
+    def __init__(self, n: int, passes: int):
+        self.stages = [MovingAverage(n) for _ in range(passes)]
+
+    def __call__(self, x: np.ndarray) -> np.ndarray:
+        for stage in self.stages:
+            x = stage(x)
+        return x
+
+
+class _Derivative:
+    # Backward difference; the last input is carried to the next chunk
+
+    def __init__(self, sample_rate: float):
+        self.sample_rate = sample_rate
+        self.last = None
+
+    def __call__(self, x: np.ndarray) -> np.ndarray:
+        if len(x) == 0:
+            return x
+        prev = x[0] if self.last is None else self.last
+        self.last = x[-1]
+        return np.diff(x, prepend=prev) * self.sample_rate
+
+
+class WheelKinematics:
+
+    def __init__(self, sample_rate: float, quantity: str = 'velocity', scale: float = 1.0,
+                 smooth_sec: float = 0.05, smooth_passes: int = 2, downsample: int = 1, unwrap: float = 360.0):
+        if quantity not in QUANTITIES:
+            raise ValueError('Unknown wheel quantity {}, use one of {}'.format(quantity, QUANTITIES))
+        self.quantity = quantity
+        self.scale = scale
+        self.downsample = max(int(downsample), 1)
+        self.unwrap_period = unwrap
+        n = int(round(smooth_sec * sample_rate)) if smooth_sec else 1
+        self.smooth = [_Smoother(n, smooth_passes) for _ in range(QUANTITIES.index(quantity) + 1)]
+        self.derivative = [_Derivative(sample_rate) for _ in range(QUANTITIES.index(quantity))]
+        self._last_angle = None
+        self._unwrap_offset = 0.0
+        self._phase = 0 # index of the next kept sample in the next chunk
+
+    @classmethod
+    def from_config(cls, spec: dict, sample_rate: float):
+        return cls(sample_rate, quantity=spec.get('Quantity', 'velocity'), scale=spec.get('Scale', 1.0),
+                   smooth_sec=spec.get('Smooth_sec', 0.05), smooth_passes=spec.get('Smooth_passes', 2),
+                   downsample=spec.get('Downsample', 1), unwrap=spec.get('Unwrap', 360.0))
+
+    def unwrap(self, angle: np.ndarray) -> np.ndarray:
+        # Continuous angle across chunks, removing jumps of one period
+        angle = np.asarray(angle, dtype=np.float64)
+        if not self.unwrap_period or len(angle) == 0:
+            return angle
+        prev = angle[0] if self._last_angle is None else self._last_angle
+        self._last_angle = angle[-1]
+        jumps = np.round(np.diff(angle, prepend=prev) / self.unwrap_period)
+        correction = self._unwrap_offset - self.unwrap_period * np.cumsum(jumps)
+        self._unwrap_offset = correction[-1]
+        return angle + correction
+
+    def process(self, t: np.ndarray, angle: np.ndarray):
+        # (t, angle) of one chunk -> (t, quantity) after smoothing and downsampling
+        y = self.smooth[0](self.unwrap(angle) * self.scale)
+        for derivative, smooth in zip(self.derivative, self.smooth[1:]):
+            y = smooth(derivative(y))
+        if self.downsample == 1:
+            return t, y
+        keep = slice(self._phase, None, self.downsample)
+        self._phase = (self._phase - len(y)) % self.downsample
+        return t[keep], y[keep]
@@ -1,52 +1,163 @@
+import time
+_START = time.perf_counter() # before the imports, for --profile-startup
+
 import os
 import sys
 import importlib
 import defopt
 import yaml
 
-from PyQt5 import QtGui, uic
-from PyQt5.QtCore import QThreadPool
+from PyQt5 import QtGui
+from PyQt5.QtCore import QThreadPool, QTimer
 from PyQt5.QtWidgets import QApplication, QMainWindow, QStyle
-import qdarktheme
 
-from gui_viewer import ViewerTab
 from gui_settings import SettingsTab
+from startup import StartupProfile, load_ui
 from utils import find_version
 from worker import Worker
-from osc_handler import OSCStreamer
+from osc_handler import OSCStreamer, open_socket
+# pglive/pyqtgraph (gui_viewer), qdarktheme and the add-on are imported when first needed
+
+# Settings that can change without restarting the OSC server or rebuilding the viewer
+_INCREMENTAL_KEYS = ('Inputs', 'Maintainer')
 
 class DAQViewer(QMainWindow):
-    def __init__(self, app=None, default_config=''):
+    def __init__(self, app=None, default_config='', recording='', config=None, osc_socket=None, profile=None):
         super().__init__()
 
         # Load default layout
         self.app = app
         self.default_config = default_config
-        uic.loadUi('QtGUI/qt5main.ui', self)
+        self.recording = recording # offline mode if set
+        self.worker = None
+        self.oscstream = None
+        self.peri_event = None
+        self.profile = StartupProfile() if profile is None else profile
+        load_ui('QtGUI/qt5main.ui', self)
         self.setWindowTitle("DAQViewer v{}".format(str(find_version('__init__.py'))))
         self.setWindowIcon(QtGui.QIcon('assets/mfh_logo.png'))
         self.app.aboutToQuit.connect(self.shutdown_task)
+        self.profile.mark('main window')
 
-        self.config = self.read_settings(self.default_config)
+        self.config = self.read_settings(self.default_config) if config is None else config
+        self._osc_socket = osc_socket # bound by main() before the window was built
         self.loadGUI(reload=False)
 
     def loadGUI(self, reload: bool):
         if reload:
             self.shutdown_task()
+            self._remove_peri_event()
+        if self.recording:
+            self._load_offline()
+            return
         self._initialize_info()
-        self._initialize_addon()
-        self.vt = ViewerTab(self.viewer, self.config)
+        if reload:
+            self._initialize_addon()
+        else:
+            # Add-on widgets are filled in once the window is up
+            QTimer.singleShot(0, self._initialize_addon)
+        if 'Sources' in self.config:
+            # Several loggers in one dashboard, one OSC server thread per port
+            from multi_source import MultiSourceDashboard, MultiSourceServer, port_inputs
+            port_inputs(self.config) # rejects clashing ports/addresses before any widget is built
+            self.vt = MultiSourceDashboard(self.viewer, self.config)
+        elif self.config.get('Layout', 'grid') == 'stacked':
+            # All channels in one scrollable plot, for configs with many channels
+            from stacked_viewer import StackedViewerTab
+            self.vt = StackedViewerTab(self.viewer, self.config)
+        else:
+            from gui_viewer import ViewerTab
+            self.vt = ViewerTab(self.viewer, self.config)
         self.st = SettingsTab(self.settings, self.config, self.default_config, self)
+        self.profile.mark('plots')
         self.multidata_connector = self.vt.MultiDataConnector # dict
 
-        # Initialize opensoundcontrol worker
-        self.threadpool = QThreadPool()
-        self.oscstream = OSCStreamer(config = self.config, 
-                                      multidata_connector=self.multidata_connector,
-                                      QtWindow=self)
-        self.worker = Worker(self.oscstream.run)
-        self.threadpool.start(self.worker)
+        if 'Sources' in self.config:
+            self.oscstream = MultiSourceServer(self.config, self.vt, sock=self._osc_socket)
+            self._osc_socket = None
+        elif self.config.get('IngestProcess', False):
+            # OSC ingest and decimation in a child process, handed over through shared memory
+            from shared_ingest import SharedMemoryIngest
+            self.oscstream = SharedMemoryIngest(self.config, self.vt, QtWindow=self)
+        else:
+            # Initialize opensoundcontrol worker
+            self.threadpool = QThreadPool()
+            self.oscstream = OSCStreamer(config = self.config, 
+                                          multidata_connector=self.vt.stager.channels,
+                                          QtWindow=self, sock=self._osc_socket)
+            self._osc_socket = None # owned by the server from now on
+            self.worker = Worker(self.oscstream.run)
+            self.threadpool.start(self.worker)
+        if 'PeriEvent' in self.config:
+            self._add_peri_event()
         self.pause_task() # halt for now
+        self.profile.mark('OSC server')
+
+    def apply_settings(self, config: dict):
+        # Reload the settings file. When only the Inputs changed, the OSC server keeps its
+        # socket and the channels that are still there keep their buffers; anything else
+        # (address, rates, layout, add-on, ingest mode) goes through a full loadGUI.
+        from gui_viewer import ViewerTab
+        incremental = (not self.recording
+                       and isinstance(self.oscstream, OSCStreamer)
+                       and isinstance(self.vt, ViewerTab)
+                       and all(config.get(key) == self.config.get(key)
+                               for key in set(config) | set(self.config) if key not in _INCREMENTAL_KEYS))
+        if not incremental:
+            self.config = config
+            self.loadGUI(reload=True)
+            return
+
+        running = self.StopButton.isEnabled()
+        added = self.vt.update_inputs(config['Inputs'])
+        for key in added:
+            if not running:
+                self.multidata_connector[key].pause()
+        self.oscstream.update_inputs(config['Inputs'])
+        peri_event = self.peri_event is not None and config['Inputs'] != self.config['Inputs']
+        self.config = config
+        self.st.config = config
+        if peri_event: # averaged channels follow the inputs, the averages start over
+            self._remove_peri_event()
+            self._add_peri_event()
+            if not running:
+                self.peri_event.pause()
+
+    def _add_peri_event(self):
+        # Event-locked averages in a tab next to the Viewer, fed the same staged data as the plots
+        if 'Sources' in self.config or self.config.get('IngestProcess', False):
+            print('PeriEvent needs the single-logger viewer without IngestProcess, skipped')
+            return
+        from peri_event import PeriEventTab
+        self.peri_event = PeriEventTab(config=self.config)
+        for key, tap in self.peri_event.taps():
+            self.vt.stager.add_tap(key, tap)
+        self.vt.stager.timer.timeout.connect(self.peri_event.refresh)
+        self.tabWidget.insertTab(1, self.peri_event, 'Peri-event')
+
+    def _remove_peri_event(self):
+        if self.peri_event is not None:
+            for key, tap in self.peri_event.taps():
+                self.vt.stager.remove_tap(key, tap)
+            self.vt.stager.timer.timeout.disconnect(self.peri_event.refresh)
+            self.tabWidget.removeTab(self.tabWidget.indexOf(self.peri_event))
+            self.peri_event.deleteLater()
+            self.peri_event = None
+
+    def _load_offline(self):
+        # Browse a DAQLogger recording with the same plot layout, no OSC server
+        from offline import LODPyramid, OfflineViewer
+        self.pyramid = LODPyramid(self.recording)
+        self.config = OfflineViewer.config_for(self.pyramid, self.config)
+        self._initialize_info()
+        self.StartButton.setEnabled(False)
+        self.UDP.setText(os.path.basename(self.recording))
+        self.AddOnInfo.setTitle(self.config['Protocol'])
+        from gui_viewer import ViewerTab
+        self.vt = ViewerTab(self.viewer, self.config)
+        self.st = SettingsTab(self.settings, self.config, self.default_config, self)
+        self.multidata_connector = {}
+        self.offline_viewer = OfflineViewer(self.vt, self.pyramid)
 
     def _initialize_info(self):
         # https://doc.qt.io/qt-6/qstyle.html#StandardPixmap-enum
@@ -73,10 +184,13 @@ class DAQViewer(QMainWindow):
             addon.DAQViewerAddOn(self.AddOnInfo, self.config)
         else:
             pass
+        self.profile.mark('add-on')
 
     def start_task(self):
         for dc in self.multidata_connector.values():
             dc.resume() 
+        if self.peri_event is not None:
+            self.peri_event.resume()
         self.StartButton.setEnabled(False)
         self.StopButton.setEnabled(True)
         if not self.LED.m_value:
@@ -85,18 +199,35 @@ class DAQViewer(QMainWindow):
     def pause_task(self):
         for dc in self.multidata_connector.values():
             dc.pause() 
+        if self.peri_event is not None:
+            self.peri_event.pause()
 
         self.StartButton.setEnabled(True)
         self.StopButton.setEnabled(False)
         if self.LED.m_value:
             self.LED.toggleValue()
 
+    def set_experiment_id(self, value: str):
+        # Called from the OSC thread; the label is updated by the GUI thread on the next frame
+        self.vt.stager.set_text(self.ExperimentID, value)
+
+    def set_trial_type(self, value, t: float):
+        # Called from the OSC thread
+        if self.peri_event is not None:
+            self.peri_event.set_trial_type(value, t)
+
     def shutdown_task(self):
         self.pause_task()
-        self.worker.kill()
-        self.oscstream.kill()
+        self.vt.stager.stop()
+        if self.worker is not None:
+            self.worker.kill()
+            self.worker = None
+        if self.oscstream is not None:
+            self.oscstream.kill()
+            self.oscstream = None
 
-    def read_settings(self, fpath:str):
+    @staticmethod
+    def read_settings(fpath:str):
         with open(fpath) as stream:
             try:
                 r = yaml.safe_load(stream)
@@ -106,18 +237,36 @@ class DAQViewer(QMainWindow):
         print('Loading {} settings...'.format(r['Protocol']))
         return r
 
-def main(default_config: str ='settings/dmdm.yaml'):
+def main(default_config: str ='settings/dmdm.yaml', *, recording: str = '', profile_startup: bool = False):
     """
     Launch DAQViewer GUI
     
     :param str default_config: path to default setting file
+    :param str recording: DAQLogger recording (.bin) to browse offline instead of streaming
+    :param bool profile_startup: print how long each startup stage took once the window is up
     """
+    profile = StartupProfile(profile_startup, _START)
+    profile.mark('imports')
+    default_config = os.path.abspath(default_config)
+    config = DAQViewer.read_settings(default_config)
+    osc_socket = None
+    if not recording and not config.get('IngestProcess', False):
+        # Listen before building the GUI; packets sent meanwhile wait in the socket buffer
+        osc_socket = open_socket((config['IPAddress'], int(config['Port'])))
+    profile.mark('settings, OSC socket')
+
+    import qdarktheme
     qdarktheme.enable_hi_dpi()
     app = QApplication(sys.argv)
     qdarktheme.setup_theme()
+    profile.mark('QApplication, theme')
 
-    win = DAQViewer(app, default_config = os.path.abspath(default_config))
+    win = DAQViewer(app, default_config = default_config,
+                    recording = os.path.abspath(recording) if recording else '',
+                    config = config, osc_socket = osc_socket, profile = profile)
     win.show()
+    if profile_startup:
+        QTimer.singleShot(0, profile.report)
     print('DAQViewer started successfully!')
     try:
         sys.exit(app.exec_())
@@ -125,4 +274,4 @@ def main(default_config: str ='settings/dmdm.yaml'):
         print('DAQViewer closed successfully!')
 
 if __name__ == '__main__':
-    defopt(main())
\ No newline at end of file
+    defopt.run(main)
@@ -0,0 +1,200 @@
+import time
+
+from PyQt5.QtCore import QThreadPool
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QGridLayout, QLabel, QScrollArea, QTabWidget
+
+from gui_viewer import ViewerTab
+from osc_handler import OSCStreamer
+from staging import FrameStager
+from worker import Worker
+
+# Multi-rig mode: one viewer monitoring several DAQLoggers (Sources in the settings), e.g.
+#   Port: 8888              # every source can send here with namespaced addresses, /rig3/achn1, /rig3/expid
+#   Dashboard: tabs         # or grid
+#   Columns: 2              # rigs per row of the grid
+#   HiddenPlotRate: 2       # Hz at which rigs that are not on screen are redrawn
+#   Sources:
+#     rig1:
+#       Port: 8881          # optional own port, with the usual bare addresses (/achn1, /expid)
+#     rig2:
+#       Inputs: {...}       # optional, defaults to the top-level Inputs
+# Each rig gets its own ViewerTab and buffers; all rigs are drawn by one timer on the GUI thread.
+
+def source_inputs(config: dict) -> dict:
+    # source -> its Inputs
+    return {source: (spec or {}).get('Inputs', config['Inputs']) for source, spec in config['Sources'].items()}
+
+
+def port_inputs(config: dict) -> dict:
+    # port -> Inputs for one OSCStreamer, keyed by '<source>/<input>' with the address to receive them on
+    ports = {}
+    for source, inputs in source_inputs(config).items():
+        own_port = (config['Sources'][source] or {}).get('Port')
+        if own_port is not None and int(own_port) == int(config['Port']):
+            raise ValueError('Source {} has the main Port {}; give it another Port or remove it, '
+                             'its namespaced addresses are received there anyway'.format(source, own_port))
+        for port, prefix in ((int(config['Port']), '/' + source), (own_port, '')):
+            if port is None:
+                continue
+            flat = ports.setdefault(int(port), {})
+            addresses = {value['Address']: key for key, value in flat.items() if 'Source' not in value}
+            for key, value in inputs.items():
+                value = dict(value, Address='{}/{}'.format(prefix, key))
+                if 'Source' in value:
+                    value['Source'] = '{}/{}'.format(source, value['Source'])
+                elif value['Address'] in addresses:
+                    raise ValueError('{} and {}/{} would both be received on {} at port {}'.format(
+                        addresses[value['Address']], source, key, value['Address'], port))
+                flat['{}/{}'.format(source, key)] = value
+    return ports
+
+
+class SourceStatus:
+    # Updated by the OSC threads, read by the dashboard
+
+    def __init__(self):
+        self.packets = 0
+        self.last_packet = None
+        self.experiment_id = ''
+
+
+class SourceStreamer(OSCStreamer):
+    # OSCStreamer for one port that tells the sources on it apart by address
+
+    def __init__(self, config: dict, port: int, inputs: dict, multidata_connector: dict, status: dict, sock=None):
+        self.status = status
+        self._sources = {} # address -> source
+        for key, value in inputs.items():
+            if 'Source' not in value:
+                self._sources[value['Address']] = key.split('/')[0]
+        super().__init__(config=dict(config, Port=port, Inputs=inputs),
+                         multidata_connector=multidata_connector, sock=sock)
+
+    def _initialize_dispatcher(self) -> None:
+        super()._initialize_dispatcher()
+        self.dispatcher.unmap("/expid", self._getExperimentID)
+        for address, source in list(self._sources.items()):
+            expid = address.rsplit('/', 1)[0] + '/expid'
+            self._sources[expid] = source
+            self.dispatcher.map(expid, self._getExperimentID)
+
+    def _connectTTLEvent(self, address: str, *args) -> None:
+        status = self.status[self._sources[address]]
+        status.packets += 1
+        status.last_packet = time.time()
+        super()._connectTTLEvent(address, *args)
+
+    def _getExperimentID(self, address: str, *args: str) -> None:
+        self.status[self._sources[address]].experiment_id = args[0]
+
+
+class MultiSourceServer:
+    # One SourceStreamer per port, each served by its own worker thread. Same kill() as OSCStreamer.
+
+    def __init__(self, config: dict, dashboard, sock=None):
+        self.streamers = []
+        for port, inputs in port_inputs(config).items():
+            connectors = {key: dashboard.panels[key.split('/')[0]].vt.stager.channels[key.split('/', 1)[1]]
+                          for key in inputs}
+            self.streamers.append(SourceStreamer(config, port, inputs, connectors, dashboard.status,
+                                                 sock=sock if port == int(config['Port']) else None))
+        self.threadpool = QThreadPool()
+        self.threadpool.setMaxThreadCount(max(self.threadpool.maxThreadCount(), len(self.streamers)))
+        self.workers = [Worker(streamer.run) for streamer in self.streamers]
+        for worker in self.workers:
+            self.threadpool.start(worker)
+
+    def kill(self) -> None:
+        for worker, streamer in zip(self.workers, self.streamers):
+            worker.kill()
+            streamer.kill()
+
+
+class RigPanel(QWidget):
+
+    def __init__(self, parent=None, source='', config=None, plot_rate=60, **kwargs):
+        super().__init__(parent=parent, **kwargs)
+        self.source = source
+        self.layout = QVBoxLayout()
+        self.layout.setContentsMargins(0,0,0,0)
+        self.header = QLabel(source)
+        self.layout.addWidget(self.header)
+        self.vt = ViewerTab(self, config, plot_rate=plot_rate)
+        self.vt.stager.stop() # drawn by the dashboard's timer
+        self.layout.addWidget(self.vt)
+        self.setLayout(self.layout)
+
+    def on_screen(self) -> bool:
+        return self.isVisible() and not self.visibleRegion().isEmpty()
+
+
+class MultiSourceDashboard(QWidget):
+    # Takes the place of ViewerTab when the settings have Sources. Rigs on screen are drained
+    # and redrawn at plot_rate, the others at HiddenPlotRate; the data keeps being staged meanwhile.
+
+    def __init__(self, parent=None, config=None, plot_rate=60, **kwargs):
+        super().__init__(parent=parent, **kwargs)
+        self.layout = QVBoxLayout()
+        self.layout.setContentsMargins(0,0,0,0)
+        self.plot_rate = plot_rate
+        self.hidden_every = max(1, round(plot_rate / config.get('HiddenPlotRate', 2)))
+        self.status = {source: SourceStatus() for source in config['Sources']}
+        self.panels = {source: RigPanel(source=source, config=dict(config, Inputs=inputs), plot_rate=plot_rate)
+                       for source, inputs in source_inputs(config).items()}
+        self.plot_widgets = [] # per-channel widgets of a single ViewerTab, see panels
+
+        if config.get('Dashboard', 'tabs') == 'grid':
+            grid_widget = QWidget()
+            grid = QGridLayout()
+            columns = config.get('Columns', 2)
+            for i, panel in enumerate(self.panels.values()):
+                grid.addWidget(panel, i // columns, i % columns)
+            grid_widget.setLayout(grid)
+            self.container = QScrollArea()
+            self.container.setWidgetResizable(True)
+            self.container.setWidget(grid_widget)
+        else:
+            self.container = QTabWidget()
+            for source, panel in self.panels.items():
+                self.container.addTab(panel, source)
+        self.layout.addWidget(self.container)
+        self.setLayout(self.layout)
+
+        # The one render loop: every tick drains the rigs on screen, every hidden_every-th tick the rest
+        self._tick = 0
+        self._last_status = (time.time(), {source: 0 for source in self.status})
+        self.stager = FrameStager({}, plot_rate)
+        self.stager.timer.timeout.connect(self.refresh)
+
+    @property
+    def MultiDataConnector(self):
+        # '<source>/<input>' -> connector of every rig, e.g. to pause and resume all of them
+        return {'{}/{}'.format(source, key): connector
+                for source, panel in self.panels.items()
+                for key, connector in panel.vt.MultiDataConnector.items()}
+
+    def refresh(self) -> None:
+        self._tick += 1
+        background = self._tick % self.hidden_every == 0
+        for panel in self.panels.values():
+            if background or panel.on_screen():
+                panel.vt.stager.drain()
+        if self._tick % self.plot_rate == 0:
+            self._update_status()
+
+    def _update_status(self) -> None:
+        # Once a second: packet rate, experiment ID and silence of each rig
+        now = time.time()
+        then, packets = self._last_status
+        for source, status in self.status.items():
+            rate = (status.packets - packets[source]) / (now - then)
+            if status.last_packet is None:
+                text = '{}  waiting for data'.format(source)
+            elif now - status.last_packet > 2:
+                text = '{}  {}  no data for {:.0f} s'.format(source, status.experiment_id, now - status.last_packet)
+            else:
+                text = '{}  {}  {:.0f} packets/s'.format(source, status.experiment_id, rate)
+            self.panels[source].header.setText(text)
+            if isinstance(self.container, QTabWidget):
+                self.container.setTabText(self.container.indexOf(self.panels[source]), text)
+        self._last_status = (now, {source: status.packets for source, status in self.status.items()})
@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import math
+
+import numpy as np
+from PyQt5.QtCore import QObject
+
+from decimation import minmax_envelope
+from utils import here
+
+# Recordings are written by DAQLogger; reuse its reader rather than duplicating the format
+sys.path.insert(0, os.path.abspath(os.path.join(here, '..', 'daqlogger', 'python')))
+from recording import open_recording
+
+
+class LODPyramid:
+    # Min/max level-of-detail pyramid of a recording.
+    # Level k holds, for every bin of 2**k samples, the per-channel minimum and maximum as
+    # float32 (n_bins, 2, n_channels). Levels start at 2**base_shift; anything finer is
+    # reduced on the fly from the memory-mapped samples. The pyramid is cached next to the
+    # recording in <file>.lod/ and rebuilt when the recording changes.
+
+    def __init__(self, path, base_shift: int = 4, min_bins: int = 1024, block_size: int = 2**20):
+        self.path = os.path.abspath(path)
+        self.rec = open_recording(self.path)
+        self.data = self.rec.scaled
+        self.n_samples, self.n_channels = self.rec.shape
+        if self.n_samples == 0:
+            raise ValueError('{} has no samples'.format(self.path))
+        self.base_shift = base_shift
+        self.min_bins = min_bins
+        self.block_size = block_size >> base_shift << base_shift
+        self.cache_dir = self.path + '.lod'
+        self.levels = {}
+        if not self._load_cache():
+            self._build()
+
+    def _source_info(self) -> dict:
+        stat = os.stat(self.path)
+        return dict(size=stat.st_size, mtime=stat.st_mtime, base_shift=self.base_shift)
+
+    def _level_path(self, k: int) -> str:
+        return os.path.join(self.cache_dir, 'level{:02d}.npy'.format(k))
+
+    def _load_cache(self) -> bool:
+        info_path = os.path.join(self.cache_dir, 'source.json')
+        if not os.path.exists(info_path):
+            return False
+        with open(info_path) as f:
+            info = json.load(f)
+        if info['source'] != self._source_info():
+            return False
+        for k in info['levels']:
+            self.levels[k] = np.load(self._level_path(k), mmap_mode='r')
+        return True
+
+    def _build(self) -> None:
+        print('Building level-of-detail pyramid for {}...'.format(self.path))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        k = self.base_shift
+        n_bins = math.ceil(self.n_samples / 2**k)
+        level = np.lib.format.open_memmap(self._level_path(k), mode='w+', dtype=np.float32,
+                                          shape=(n_bins, 2, self.n_channels))
+        # Base level streamed from the recording, one block at a time
+        for start in range(0, self.n_samples, self.block_size):
+            block = np.asarray(self.data[start:start + self.block_size], dtype=np.float32)
+            b0 = start >> k
+            level[b0:b0 + math.ceil(len(block) / 2**k)] = _reduce(block, 2**k)
+        self.levels[k] = level
+
+        # Each coarser level pairs up the bins of the previous one
+        while n_bins > self.min_bins:
+            prev = self.levels[k]
+            k += 1
+            n_bins = math.ceil(n_bins / 2)
+            level = np.lib.format.open_memmap(self._level_path(k), mode='w+', dtype=np.float32,
+                                              shape=(n_bins, 2, self.n_channels))
+            for start in range(0, len(prev), self.block_size):
+                block = prev[start:start + self.block_size]
+                b0 = start // 2
+                level[b0:b0 + math.ceil(len(block) / 2), 0] = _reduce(block[:, 0], 2)[:, 0]
+                level[b0:b0 + math.ceil(len(block) / 2), 1] = _reduce(block[:, 1], 2)[:, 1]
+            self.levels[k] = level
+
+        for level in self.levels.values():
+            level.flush()
+        with open(os.path.join(self.cache_dir, 'source.json'), 'w') as f:
+            json.dump(dict(source=self._source_info(), levels=sorted(self.levels)), f)
+
+    def value_range(self):
+        # Per-channel (min, max) over the whole recording, from the coarsest level
+        top = self.levels[max(self.levels)]
+        return np.min(top[:, 0], axis=0), np.max(top[:, 1], axis=0)
+
+    def window(self, i0: int, i1: int, pixel_width: int):
+        # Per channel (sample positions, values) for samples [i0, i1), at most ~2 points per pixel
+        i0 = max(0, int(i0))
+        i1 = min(self.n_samples, int(i1))
+        pixel_width = max(int(pixel_width), 1)
+        if i1 <= i0:
+            return [(np.empty(0), np.empty(0))] * self.n_channels
+
+        samples_per_pixel = (i1 - i0) / pixel_width
+        if samples_per_pixel <= 2**self.base_shift:
+            # Fine enough to reduce straight from the recording
+            spb = max(1, math.ceil(samples_per_pixel))
+            i0 -= i0 % spb
+            y = np.asarray(self.data[i0:i1])
+            x = np.arange(i0, i0 + len(y), dtype=np.float64)
+            return [minmax_envelope(x, y[:, c], spb) if spb > 1 else (x, y[:, c])
+                    for c in range(self.n_channels)]
+
+        k = min(max(self.base_shift, math.ceil(math.log2(samples_per_pixel))), max(self.levels))
+        b0 = i0 >> k
+        b1 = -(-i1 >> k)
+        bins = np.asarray(self.levels[k][b0:b1])
+        x = np.empty(2 * len(bins))
+        x[0::2] = np.arange(b0, b1) * 2**k
+        x[1::2] = x[0::2] + 2**(k - 1)
+        y = np.empty((2 * len(bins), self.n_channels), dtype=np.float32)
+        y[0::2] = bins[:, 0]
+        y[1::2] = bins[:, 1]
+        return [(x, y[:, c]) for c in range(self.n_channels)]
+
+
+def _reduce(block: np.ndarray, factor: int) -> np.ndarray:
+    # (n, ...) -> (ceil(n / factor), 2, ...) of [min, max] over consecutive groups of factor rows
+    n = len(block)
+    pad = -n % factor
+    if pad:
+        block = np.concatenate((block, np.repeat(block[-1:], pad, axis=0)))
+    groups = block.reshape((len(block) // factor, factor) + block.shape[1:])
+    return np.stack((groups.min(axis=1), groups.max(axis=1)), axis=1)
+
+
+class OfflineViewer(QObject):
+    # Drives the ViewerTab plots from a recording instead of OSC: every change of the
+    # (linked) x range re-queries the pyramid, so the cost of a frame depends on the
+    # widget width only, whatever the zoom level.
+
+    def __init__(self, viewer_tab, pyramid: LODPyramid):
+        super().__init__()
+        self.pyramid = pyramid
+        self.t0 = pyramid.rec.meta['start_time']
+        self.sample_rate = pyramid.rec.sample_rate
+        self.curves = [widget.plot for widget in viewer_tab.plot_widgets]
+        for widget, y_min, y_max in zip(viewer_tab.plot_widgets, *pyramid.value_range()):
+            widget.setYRange(float(y_min), float(y_max))
+        self.viewbox = viewer_tab.plot_widgets[-1].getPlotItem().getViewBox()
+        self.viewbox.sigXRangeChanged.connect(self.refresh)
+        self.viewbox.setXRange(self.t0, self.t0 + pyramid.n_samples / self.sample_rate, padding=0)
+
+    @staticmethod
+    def config_for(pyramid: LODPyramid, config: dict) -> dict:
+        # Same layout settings as the live viewer, one input per recorded channel
+        config = dict(config)
+        config['Protocol'] = os.path.basename(pyramid.path)
+        config['DAQSampleRate'] = pyramid.rec.sample_rate
+        config['Inputs'] = {name: dict(Label=name) for name in pyramid.rec.channel_names}
+        return config
+
+    def refresh(self, *args) -> None:
+        x0, x1 = self.viewbox.viewRange()[0]
+        i0 = math.floor((x0 - self.t0) * self.sample_rate)
+        i1 = math.ceil((x1 - self.t0) * self.sample_rate) + 1
+        for curve, (x, y) in zip(self.curves, self.pyramid.window(i0, i1, self.viewbox.width())):
+            curve.setData(self.t0 + x / self.sample_rate, y)
@@ -1,31 +1,167 @@
+import os
+import sys
 import time
+import errno
+import select
+import socket
+import threading
 from typing import Any
-from utils import normalize_angle_np
+
+import numpy as np
+from kinematics import WheelKinematics
+from utils import here, input_rebuild_needed, input_wrap
 
 from pythonosc.dispatcher import Dispatcher
 from pythonosc.osc_server import ThreadingOSCUDPServer
 
+# Binary sample frames sent as a single OSC blob by DAQLogger, decoded by its oscframe.py
+sys.path.insert(0, os.path.abspath(os.path.join(here, '..', 'daqlogger', 'python')))
+from oscframe import Frame, decode_frame
+
+
+def open_socket(server_address, receive_buffer: int = 4 * 1024 * 1024) -> socket.socket:
+    # Non-blocking UDP socket for BatchedOSCUDPServer. Datagrams arriving before the server
+    # runs wait in the kernel buffer (receive_buffer bytes, absorbs bursts).
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+    except OSError:
+        pass # keep the OS default
+    sock.bind(server_address)
+    sock.setblocking(False)
+    return sock
+
+class BatchedOSCUDPServer:
+    # OSC server on a single non-blocking UDP socket, served by one thread.
+    # Every wakeup drains all pending datagrams before going back to select(), so a burst of
+    # frames from dozens of channels costs one wakeup instead of one new thread per datagram.
+    # Same dispatcher and serve_forever()/shutdown()/server_close() as the pythonosc servers.
+
+    max_datagram = 65536
+    receive_buffer = 4 * 1024 * 1024 # kernel buffer, absorbs bursts while a batch is dispatched
+
+    def __init__(self, server_address, dispatcher, poll_interval: float = 0.5, sock=None):
+        self.server_address = server_address
+        self.dispatcher = dispatcher
+        self.poll_interval = poll_interval
+        # sock: a socket from open_socket(), bound earlier so that packets sent meanwhile are kept
+        self.socket = open_socket(server_address, self.receive_buffer) if sock is None else sock
+        self.packets = 0
+        self.batches = 0
+        self.max_batch = 0
+        self.errors = 0 # datagrams dropped because a handler raised, e.g. a malformed frame
+        self.last_error = None
+        self._running = False
+        self._stopped = threading.Event()
+        self._stopped.set()
+
+    def serve_forever(self) -> None:
+        self._running = True
+        self._stopped.clear()
+        try:
+            while self._running:
+                ready, _, _ = select.select([self.socket], [], [], self.poll_interval)
+                if ready:
+                    self._drain()
+        finally:
+            self._stopped.set()
+
+    def _drain(self) -> None:
+        n = 0
+        while True:
+            try:
+                data, client_address = self.socket.recvfrom(self.max_datagram)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                if e.errno in (errno.ECONNRESET, errno.EAGAIN):
+                    continue # Windows reports ICMP port unreachable on UDP sockets
+                raise
+            try:
+                self.dispatcher.call_handlers_for_packet(data, client_address)
+            except Exception as e:
+                # Only this datagram is lost, as with the thread-per-datagram server; the receive thread carries on
+                self.errors += 1
+                self.last_error = '{}: {}'.format(type(e).__name__, e)
+                if self.errors == 1 or self.errors % 1000 == 0:
+                    print('Dropped OSC packet from {} ({} so far): {}'.format(client_address, self.errors, self.last_error))
+            n += 1
+        self.packets += n
+        self.batches += 1
+        if n > self.max_batch:
+            self.max_batch = n
+
+    def shutdown(self) -> None:
+        self._running = False
+        self._stopped.wait()
+
+    def server_close(self) -> None:
+        self.socket.close()
+
+
 def print_handler(address, *args):
     print(f"{address}: {args}")
 
 class OSCStreamer(object):
-    def __init__(self, config=None, multidata_connector=None, QtWindow=None, **kwargs):
+    def __init__(self, config=None, multidata_connector=None, QtWindow=None, server_type='batched', sock=None, **kwargs):
         super().__init__()
 
         self.config = config
         self.server_address = (self.config['IPAddress'],int(self.config['Port']))
         self.multidata_connector = multidata_connector
         self.QtWindow = QtWindow
+        self.resync_tolerance = 0.5 # sec of drift between DAQ and host clock before re-anchoring
+        self._time_anchor = {} # address -> host time of sample 0
         self._initialize_dispatcher()
-        self.server = ThreadingOSCUDPServer(self.server_address,self.dispatcher)
+        # 'threading' is the former thread-per-datagram pythonosc server, kept for comparison
+        if sock is not None: # already bound by open_socket()
+            self.server = BatchedOSCUDPServer(self.server_address,self.dispatcher,sock=sock)
+        else:
+            server_class = dict(batched=BatchedOSCUDPServer, threading=ThreadingOSCUDPServer)[server_type]
+            self.server = server_class(self.server_address,self.dispatcher)
 
     def _initialize_dispatcher(self) -> None:
         self.dispatcher = Dispatcher()
-        for k,v in  self.config['Inputs'].items():
-            # self.dispatcher.map("/{}".format(k), print_handler)
-            self.dispatcher.map("/{}".format(k), self._connectTTLEvent)
+        self._keys = {} # address -> input
+        self._wrap = {} # input -> display period, e.g. Wrap: 360 shows an encoder angle modulo one turn
+        self._derived = {} # source input -> [(derived input, WheelKinematics)]
+        self._map_inputs({}, self.config['Inputs'])
         self.dispatcher.map("/expid", self._getExperimentID)
         # self.dispatcher.map("/expid", print_handler)
+        trial_type = self.config.get('PeriEvent', {}).get('TrialType')
+        if trial_type: # label of the upcoming trial for the peri-event averages, e.g. /trialtype left
+            self.dispatcher.map(trial_type, self._getTrialType)
+
+    def _map_inputs(self, old: dict, new: dict) -> None:
+        # Map the received inputs of `new` that are not mapped for `old` and unmap the others.
+        # Derived inputs whose kinematics settings are unchanged keep their filter state.
+        # An input is received on /<input> unless it sets another Address (e.g. /rig3/achn1)
+        received = lambda inputs: {v.get('Address', "/{}".format(k)): k
+                                   for k, v in inputs.items() if 'Source' not in v}
+        old_keys, keys = received(old), received(new)
+        for address in old_keys.keys() - keys.keys():
+            self.dispatcher.unmap(address, self._connectTTLEvent)
+            self._time_anchor.pop(address, None)
+        for address in keys.keys() - old_keys.keys():
+            # self.dispatcher.map(address, print_handler)
+            self.dispatcher.map(address, self._connectTTLEvent)
+
+        previous = {k: kinematics for entries in self._derived.values() for k, kinematics in entries}
+        wrap, derived = {}, {}
+        for k,v in new.items():
+            if 'Source' in v: # computed from another input (see kinematics.py), not received
+                kinematics = None if k not in old or input_rebuild_needed(old[k], v) else previous.get(k)
+                derived.setdefault(v['Source'], []).append(
+                    (k, kinematics or WheelKinematics.from_config(v, self.config['DAQSampleRate'])))
+            elif input_wrap(k, v):
+                wrap[k] = input_wrap(k, v)
+        # Swapped whole, the server thread sees either the old or the new tables
+        self._keys, self._wrap, self._derived = keys, wrap, derived
+
+    def update_inputs(self, inputs: dict) -> None:
+        # New Inputs section for the same address and port; the socket stays open
+        self._map_inputs(self.config['Inputs'], inputs)
+        self.config = dict(self.config, Inputs=inputs)
 
     def _connectTTLEvent(self, address: str, *args: Any) -> None:
         # TODO check float or int
@@ -33,13 +169,43 @@ class OSCStreamer(object):
         if not address[0] == "/":  # Check syntax
             return
 
+        arrival = time.time()
         value = args[0]
-        if 'ctr0' in address: # because ctr0 will be running wheel
-            value = normalize_angle_np(value)
+        if isinstance(value, bytes): # binary frame carrying a whole chunk
+            frame = decode_frame(value)
+            value = frame.samples
+        else:
+            frame = None
+
+        key = self._keys.get(address, address[1:])
+        wrap = self._wrap
+        connector = self.multidata_connector.get(key) # None while a settings reload removes it
+        if frame is None:
+            t = arrival
+            if connector is not None:
+                connector.cb_append_data_point(value % wrap[key] if key in wrap else value, t)
         else:
-            pass
+            t = self._frame_times(address, frame, arrival)
+            if connector is not None:
+                connector.cb_append_chunk(np.mod(value, wrap[key]) if key in wrap else value, t)
 
-        self.multidata_connector[address[1:]].cb_append_data_point(value, time.time())
+        for derived_key, kinematics in self._derived.get(key, ()):
+            t_derived, y_derived = kinematics.process(np.atleast_1d(t), np.atleast_1d(value))
+            derived_connector = self.multidata_connector.get(derived_key)
+            if len(y_derived) and derived_connector is not None:
+                derived_connector.cb_append_chunk(y_derived, t_derived)
+
+    def _frame_times(self, address: str, frame: Frame, arrival: float) -> np.ndarray:
+        # Per-sample host timestamps from the sample index and rate. The last sample of the
+        # chunk is taken to arrive now; the anchor is kept until the logger restarts or
+        # the two clocks drift apart, so that chunk boundaries stay seamless.
+        n = len(frame.samples)
+        end = frame.first_sample + n
+        anchor = self._time_anchor.get(address)
+        if anchor is None or abs(anchor + end / frame.sample_rate - arrival) > self.resync_tolerance:
+            anchor = arrival - end / frame.sample_rate
+            self._time_anchor[address] = anchor
+        return anchor + (frame.first_sample + np.arange(n)) / frame.sample_rate
 
     def _getExperimentID(self, address: str, *args: str) -> None:
         # Check that address starts with filter
@@ -47,7 +213,11 @@ class OSCStreamer(object):
             return
 
         value = args[0]
-        self.QtWindow.ExperimentID.setText(value)
+        self.QtWindow.set_experiment_id(value)
+
+    def _getTrialType(self, address: str, *args: Any) -> None:
+        if self.QtWindow is not None and args:
+            self.QtWindow.set_trial_type(args[0], time.time())
 
     def run(self):
         print('Launching python-osc server...')
@@ -0,0 +1,302 @@
+import os
+import sys
+from collections import deque
+
+import numpy as np
+import pyqtgraph as pg
+from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QLabel, QPushButton
+
+from utils import here
+
+# Triggers use the same hysteresis edge detector as DAQLogger's live events (ai_thresholds)
+sys.path.insert(0, os.path.abspath(os.path.join(here, '..', 'daqlogger', 'python')))
+from events import ThresholdDetector
+
+# Event-locked averages during the session (PeriEvent in the settings), e.g. lick sensor and
+# wheel speed around a stimulus TTL:
+#   PeriEvent:
+#     Trigger: achn2              # input whose rising edges are the events, or {achn2: left, achn3: right}
+#     Threshold: 2.5
+#     Hysteresis: 0.2
+#     Window_sec: [-1, 2]         # around each event
+#     Channels: [achn1, wheel_speed] # default: every other input
+#     TrialType: /trialtype       # optional OSC address, the last label received before an event is its trial type
+# Each channel keeps the last few seconds of samples. Once the window after an event has arrived it is
+# resampled onto a fixed grid and folded into the running mean and variance of its trial type;
+# trials are not kept, so an average costs the same after 10 or 10000 events.
+
+MAX_POINTS = 2000 # per window, whatever the sample rate
+COLORS = ['#8ab4f8', '#f28b82', '#81c995', '#fdd663', '#c58af9', '#78d9ec', '#fcad70', '#ff8bcb']
+
+
+class SampleBuffer:
+    # The last `capacity` samples of one channel, oldest first, in t and y. Appends go to the end
+    # of storage twice that size; when it is full the newest samples move to the front, so every
+    # sample is copied at most twice and windows are contiguous slices found by searchsorted.
+
+    def __init__(self, capacity: int):
+        self.capacity = int(capacity)
+        self._t = np.empty(2 * self.capacity)
+        self._y = np.empty(2 * self.capacity)
+        self.start = 0
+        self.end = 0
+
+    @property
+    def t(self) -> np.ndarray:
+        return self._t[self.start:self.end]
+
+    @property
+    def y(self) -> np.ndarray:
+        return self._y[self.start:self.end]
+
+    @property
+    def latest(self) -> float:
+        return self._t[self.end - 1] if self.end > self.start else -np.inf
+
+    def append(self, t, y) -> None:
+        t = np.asarray(t, dtype=np.float64)[-self.capacity:]
+        y = np.asarray(y, dtype=np.float64)[-self.capacity:]
+        n = len(t)
+        if n == 0:
+            return
+        if t[0] < self.latest: # the logger restarted, its clock with it
+            self.start = self.end
+        if self.end + n > len(self._t):
+            keep = min(self.end - self.start, self.capacity - n)
+            self._t[:keep] = self._t[self.end - keep:self.end]
+            self._y[:keep] = self._y[self.end - keep:self.end]
+            self.start, self.end = 0, keep
+        self._t[self.end:self.end + n] = t
+        self._y[self.end:self.end + n] = y
+        self.end += n
+        self.start = max(self.start, self.end - self.capacity)
+
+    def window(self, times: np.ndarray):
+        # Values at the (increasing) times, linearly interpolated, or None if they are no longer buffered
+        t = self.t
+        if not len(t) or t[0] > times[0]:
+            return None
+        i0 = max(int(np.searchsorted(t, times[0], side='right')) - 1, 0)
+        i1 = int(np.searchsorted(t, times[-1], side='left')) + 1
+        return np.interp(times, t[i0:i1], self.y[i0:i1])
+
+
+class RunningAverage:
+    # Welford's running mean and variance of equally long windows, per point: O(window) per
+    # trial, nothing per trial is kept. NaN points (gaps in the data) are left out of their point only.
+
+    def __init__(self, n_points: int):
+        self.trials = 0
+        self.count = np.zeros(n_points)
+        self.mean = np.zeros(n_points)
+        self.m2 = np.zeros(n_points)
+
+    def add(self, x: np.ndarray) -> None:
+        finite = ~np.isnan(x)
+        self.trials += 1
+        self.count += finite
+        delta = np.where(finite, x - self.mean, 0)
+        self.mean += delta / np.maximum(self.count, 1)
+        self.m2 += delta * np.where(finite, x - self.mean, 0)
+
+    @property
+    def sem(self) -> np.ndarray:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, np.sqrt(self.m2 / (self.count - 1) / self.count), np.nan)
+
+
+class PeriEventChannel:
+    # One averaged channel. Fed the same staged data as its plot (see FrameStager.add_tap);
+    # the events wait in `pending` until the data after them has arrived.
+
+    def __init__(self, lags: np.ndarray, capacity: int):
+        self.lags = lags
+        self.buffer = SampleBuffer(capacity)
+        self.pending = deque(maxlen=1024) # events waiting for their window, dropped if no data comes
+        self.averages = {} # trial type -> RunningAverage
+        self.missed = 0 # events whose window had left the buffer
+        self.paused = False
+        self.dirty = False
+
+    def cb_append_chunk(self, y, x) -> None:
+        if not self.paused:
+            self.buffer.append(x, y)
+
+    def cb_append_data_array(self, y, x) -> None:
+        if not self.paused:
+            self.buffer.append(x, y)
+
+    def add_event(self, t: float, trial_type: str) -> None:
+        self.pending.append((t, trial_type))
+
+    def update(self) -> None:
+        while self.pending and self.pending[0][0] + self.lags[-1] <= self.buffer.latest:
+            t, trial_type = self.pending.popleft()
+            window = self.buffer.window(t + self.lags)
+            if window is None:
+                self.missed += 1
+                continue
+            if trial_type not in self.averages:
+                self.averages[trial_type] = RunningAverage(len(self.lags))
+            self.averages[trial_type].add(window)
+            self.dirty = True
+
+    def reset(self) -> None:
+        self.pending.clear()
+        self.averages = {}
+        self.missed = 0
+        self.dirty = True
+
+
+class TriggerChannel:
+    # Tap on the trigger input: every rising edge becomes an event of all averaged channels
+
+    def __init__(self, tab, threshold: float, hysteresis: float = 0.0, label: str = ''):
+        self.tab = tab
+        # One line, high above threshold + hysteresis/2 and low below threshold - hysteresis/2;
+        # the state carries over between chunks, so an edge split across two is found once
+        self.detector = ThresholdDetector.from_thresholds(threshold, 1, hysteresis)
+        self.label = label
+        self.paused = False
+
+    def cb_append_chunk(self, y, x) -> None:
+        if self.paused:
+            return
+        x = np.atleast_1d(x)
+        events = self.detector.process(np.asarray(y, dtype=np.float64).reshape(1, -1), 0)
+        for i in events['sample'][events['rising'] == 1]:
+            self.tab.add_event(float(x[i]), self.label)
+
+    def cb_append_data_array(self, y, x) -> None:
+        self.cb_append_chunk(y, x)
+
+
+class PeriEventTab(QWidget):
+    # Peri-event tab next to the Viewer: one plot per averaged channel with the mean and
+    # standard error of every trial type, redrawn on the viewer's frame timer when a trial was added.
+
+    def __init__(self, parent=None, config=None, **kwargs):
+        super().__init__(parent=parent, **kwargs)
+        settings = config['PeriEvent']
+        pre, post = settings.get('Window_sec', [-1, 2])
+        triggers = settings['Trigger']
+        if not isinstance(triggers, dict):
+            triggers = {triggers: ''}
+        keys = settings.get('Channels') or [key for key in config['Inputs'] if key not in triggers]
+        self.keys = [key for key in keys if key in config['Inputs']]
+        self.trial_types = [] # in order of appearance, for the colors
+        self._trial_type_labels = deque(maxlen=64) # (host time, label) from the OSC thread
+
+        self.channels = {}
+        for key in self.keys:
+            rate = config['DAQSampleRate'] / config['Inputs'][key].get('Downsample', 1)
+            lags = np.linspace(pre, post, int(min((post - pre) * rate + 1, MAX_POINTS)))
+            # Room for the window plus the time the other inputs may lag behind the trigger
+            self.channels[key] = PeriEventChannel(lags, int(rate * (2 * (post - pre) + 2)))
+        self.triggers = {key: TriggerChannel(self, settings.get('Threshold', 2.5), settings.get('Hysteresis', 0.2), label)
+                         for key, label in triggers.items()}
+
+        self.layout = QVBoxLayout()
+        self.layout.setContentsMargins(0,0,0,0)
+        header = QHBoxLayout()
+        self.status = QLabel('waiting for events on {}'.format(', '.join(triggers)))
+        header.addWidget(self.status, 1)
+        self.reset_button = QPushButton('Reset')
+        self.reset_button.clicked.connect(self.reset)
+        header.addWidget(self.reset_button)
+        self.layout.addLayout(header)
+
+        self.plots = {}
+        self._curves = {} # (input, trial type) -> (mean, upper, lower)
+        for key in self.keys:
+            plot = pg.PlotWidget(background='#202124', title=config['Inputs'][key]['Label'])
+            plot.addLegend(offset=(-10, 10))
+            plot.addItem(pg.InfiniteLine(pos=0, angle=90, pen=pg.mkPen('#9aa0a6', style=Qt.DashLine)))
+            plot.setXRange(pre, post, padding=0)
+            if 'Yrange' in config['Inputs'][key]:
+                plot.setYRange(*config['Inputs'][key]['Yrange'])
+            self.plots[key] = plot
+            self.layout.addWidget(plot)
+        self.setLayout(self.layout)
+
+    def taps(self):
+        # (input, connector) pairs to be fed by the viewer's FrameStager
+        return list(self.triggers.items()) + list(self.channels.items())
+
+    def set_trial_type(self, label, t: float) -> None:
+        # Callable from any thread
+        self._trial_type_labels.append((t, str(label)))
+
+    def add_event(self, t: float, label: str) -> None:
+        labels = [label] if label else []
+        for t_label, trial_type in reversed(list(self._trial_type_labels)):
+            if t_label <= t:
+                labels.append(trial_type)
+                break
+        trial_type = ' / '.join(labels) or 'all'
+        for channel in self.channels.values():
+            channel.add_event(t, trial_type)
+
+    def refresh(self) -> None:
+        # After the stager has drained this frame's data
+        for channel in self.channels.values():
+            channel.update()
+        if not any(channel.dirty for channel in self.channels.values()):
+            return
+        for key, channel in self.channels.items():
+            if channel.dirty:
+                channel.dirty = False
+                self._draw(key, channel)
+        self._update_status()
+
+    def _draw(self, key: str, channel: PeriEventChannel) -> None:
+        for trial_type, average in channel.averages.items():
+            if (key, trial_type) not in self._curves:
+                self._add_curves(key, trial_type)
+            mean, upper, lower = self._curves[key, trial_type]
+            sem = np.nan_to_num(average.sem)
+            mean.setData(channel.lags, average.mean)
+            upper.setData(channel.lags, average.mean + sem)
+            lower.setData(channel.lags, average.mean - sem)
+
+    def _add_curves(self, key: str, trial_type: str) -> None:
+        if trial_type not in self.trial_types:
+            self.trial_types.append(trial_type)
+        color = pg.mkColor(COLORS[self.trial_types.index(trial_type) % len(COLORS)])
+        plot = self.plots[key]
+        mean = plot.plot(pen=pg.mkPen(color, width=2), name=trial_type)
+        upper = pg.PlotDataItem(pen=None)
+        lower = pg.PlotDataItem(pen=None)
+        color.setAlpha(60)
+        plot.addItem(pg.FillBetweenItem(upper, lower, brush=pg.mkBrush(color)))
+        self._curves[key, trial_type] = (mean, upper, lower)
+
+    def _update_status(self) -> None:
+        # Trials per type; every channel sees the same events, the first one is representative
+        if not self.channels:
+            return
+        channel = next(iter(self.channels.values()))
+        text = '   '.join('{}: {} trials'.format(trial_type, average.trials)
+                          for trial_type, average in channel.averages.items())
+        missed = sum(channel.missed for channel in self.channels.values())
+        if missed:
+            text += '   ({} windows missed)'.format(missed)
+        self.status.setText(text or 'waiting for events')
+
+    def reset(self) -> None:
+        # Start the averages over, e.g. for a new block of trials
+        for channel in self.channels.values():
+            channel.reset()
+        for mean, upper, lower in self._curves.values():
+            for curve in (mean, upper, lower):
+                curve.setData([], [])
+        self._update_status()
+
+    def pause(self) -> None:
+        for connector in list(self.channels.values()) + list(self.triggers.values()):
+            connector.paused = True
+
+    def resume(self) -> None:
+        for connector in list(self.channels.values()) + list(self.triggers.values()):
+            connector.paused = False
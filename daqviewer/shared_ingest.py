@@ -0,0 +1,193 @@
+import queue
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+from PyQt5.QtCore import QObject, QTimer, Qt
+
+from decimation import EnvelopeDecimator
+
+# Optional ingest mode (IngestProcess: true in the settings): OSCStreamer and the envelope
+# decimation run in a child process with its own GIL, and write the envelope points of each
+# channel into a shared-memory ring. The GUI process only copies the latest window out of
+# shared memory once per frame, so heavy rendering cannot make the receiver drop packets.
+
+_COUNT, _PIXEL_WIDTH, _GENERATION = range(3) # int64 header slots
+_HEADER_SLOTS = 8
+
+
+class SharedEnvelopeRing:
+    # (t, y) float64 ring of one channel in shared memory. Single writer (ingest process),
+    # any number of readers. The writer stores the points before publishing the new count,
+    # readers check afterwards that the points they copied were not overwritten meanwhile.
+
+    def __init__(self, capacity: int, name: str = None, create: bool = False):
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(name=name, create=create,
+                                              size=8 * (_HEADER_SLOTS + 2 * capacity))
+        self.header = np.ndarray(_HEADER_SLOTS, dtype=np.int64, buffer=self.shm.buf)
+        self.t = np.ndarray(capacity, dtype=np.float64, buffer=self.shm.buf, offset=8 * _HEADER_SLOTS)
+        self.y = np.ndarray(capacity, dtype=np.float64, buffer=self.shm.buf, offset=8 * (_HEADER_SLOTS + capacity))
+        if create:
+            self.header[:] = 0
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    @property
+    def count(self) -> int:
+        return int(self.header[_COUNT])
+
+    @property
+    def generation(self) -> int:
+        # Bumped whenever the writer starts over, e.g. after a pixel width change
+        return int(self.header[_GENERATION])
+
+    @property
+    def pixel_width(self) -> int:
+        return int(self.header[_PIXEL_WIDTH])
+
+    @pixel_width.setter
+    def pixel_width(self, value: int) -> None:
+        self.header[_PIXEL_WIDTH] = min(int(value), self.capacity // 2)
+
+    def write(self, t: np.ndarray, y: np.ndarray) -> None:
+        count = self.count
+        n = len(y)
+        if n > self.capacity:
+            t = t[-self.capacity:]
+            y = y[-self.capacity:]
+        k = len(y)
+        start = (count + n - k) % self.capacity
+        first = min(k, self.capacity - start)
+        self.t[start:start + first] = t[:first]
+        self.y[start:start + first] = y[:first]
+        self.t[:k - first] = t[first:]
+        self.y[:k - first] = y[first:]
+        self.header[_COUNT] = count + n
+
+    def reset(self) -> None:
+        self.header[_COUNT] = 0
+        self.header[_GENERATION] += 1
+
+    def read_latest(self, n: int):
+        # Copy of the latest (at most) n points
+        for _ in range(3):
+            count, generation = self.count, self.generation
+            n = min(n, count, self.capacity)
+            idx = (count - n + np.arange(n)) % self.capacity
+            t = self.t[idx]
+            y = self.y[idx]
+            if self.generation == generation and self.count - count <= self.capacity - n:
+                break
+        return t, y
+
+    def close(self, unlink: bool = False) -> None:
+        del self.header, self.t, self.y # release the views before the mapping
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class _SharedChannel:
+    # Stands in for the EnvelopeDataConnector inside the ingest process
+
+    def __init__(self, ring: SharedEnvelopeRing, window_sec: float, sample_rate: float):
+        self.ring = ring
+        self.decimator = EnvelopeDecimator(window_sec, sample_rate, pixel_width=ring.pixel_width or 1000)
+
+    def cb_append_chunk(self, y, x) -> None:
+        width = self.ring.pixel_width
+        if width and width != self.decimator.pixel_width:
+            self.decimator.set_pixel_width(width)
+            self.ring.reset()
+        t, v = self.decimator.push(x, y)
+        if len(v):
+            self.ring.write(t, v)
+
+    def cb_append_data_point(self, y, x) -> None:
+        self.ring.write(np.array([x], dtype=np.float64), np.array([y], dtype=np.float64))
+
+
+class _ExperimentIDForwarder:
+    # Stands in for the main window inside the ingest process
+
+    def __init__(self, experiment_ids):
+        self.experiment_ids = experiment_ids
+
+    def set_experiment_id(self, value: str) -> None:
+        self.experiment_ids.put(value)
+
+
+def _ingest_main(config: dict, ring_names: dict, capacity: int, experiment_ids, stop) -> None:
+    # Entry point of the ingest process
+    from osc_handler import OSCStreamer
+
+    rings = {key: SharedEnvelopeRing(capacity, name=name) for key, name in ring_names.items()}
+    channels = {key: _SharedChannel(ring, config['Xrange_sec'],
+                                    config['DAQSampleRate'] / config['Inputs'][key].get('Downsample', 1))
+                for key, ring in rings.items()}
+    streamer = OSCStreamer(config=config, multidata_connector=channels,
+                           QtWindow=_ExperimentIDForwarder(experiment_ids))
+    server = threading.Thread(target=streamer.run, name='DAQViewerIngest', daemon=True)
+    server.start()
+    stop.wait()
+    streamer.kill()
+    for ring in rings.values():
+        ring.close()
+
+
+class SharedMemoryIngest(QObject):
+    # GUI-process side: starts the ingest process and, once per frame, replaces each curve
+    # with the latest envelope window from shared memory. Has the same kill() as OSCStreamer.
+
+    def __init__(self, config: dict, viewer_tab, QtWindow, capacity: int = 16384):
+        super().__init__()
+        self.connectors = viewer_tab.MultiDataConnector
+        self.QtWindow = QtWindow
+        self.rings = {key: SharedEnvelopeRing(capacity, create=True) for key in self.connectors}
+        for key, ring in self.rings.items():
+            ring.pixel_width = self.connectors[key].decimator.pixel_width
+        self._shown = {key: None for key in self.rings} # (generation, count) on screen
+
+        # spawn, as on Windows, so that the child does not inherit the Qt state
+        ctx = mp.get_context('spawn')
+        self.experiment_ids = ctx.Queue()
+        self.stop_event = ctx.Event()
+        self.process = ctx.Process(target=_ingest_main, name='DAQViewerIngest', daemon=True,
+                                   args=(config, {key: ring.name for key, ring in self.rings.items()},
+                                         capacity, self.experiment_ids, self.stop_event))
+        self.process.start()
+
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(max(1, int(1000 / viewer_tab.plot_rate)))
+
+    def refresh(self) -> None:
+        for key, ring in self.rings.items():
+            connector = self.connectors[key]
+            ring.pixel_width = connector.decimator.pixel_width
+            state = (ring.generation, ring.count)
+            if state == self._shown[key] or connector.paused:
+                continue
+            self._shown[key] = state
+            t, y = ring.read_latest(connector.decimator.max_points)
+            connector.cb_set_data(y.tolist(), t.tolist())
+        try:
+            while True:
+                self.QtWindow.ExperimentID.setText(self.experiment_ids.get_nowait())
+        except queue.Empty:
+            pass
+
+    def kill(self) -> None:
+        self.timer.stop()
+        self.stop_event.set()
+        self.process.join(timeout=2)
+        if self.process.is_alive():
+            self.process.terminate()
+        for ring in self.rings.values():
+            ring.close(unlink=True)
+        self.rings = {}
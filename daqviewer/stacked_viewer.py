@@ -0,0 +1,170 @@
+import numpy as np
+import pyqtgraph as pg
+from PyQt5.QtWidgets import QWidget, QHBoxLayout, QScrollBar
+from PyQt5.QtCore import Qt
+
+from decimation import EnvelopeDecimator
+from staging import FrameStager
+
+_BREAK = np.array([np.nan])
+
+class StackedChannel:
+    # Envelope buffer of one channel of the stacked view. Same callbacks as the
+    # DataConnectors of ViewerTab, called on the GUI thread by the FrameStager.
+
+    def __init__(self, decimator: EnvelopeDecimator):
+        self.decimator = decimator
+        self.paused = False
+        self._resize(decimator.max_points)
+
+    def _resize(self, max_points: int) -> None:
+        # Oldest to newest, NaN where nothing was received yet
+        self.t = np.full(max_points, np.nan)
+        self.y = np.full(max_points, np.nan)
+        self.dirty = True
+
+    def set_pixel_width(self, pixel_width: int) -> None:
+        if pixel_width != self.decimator.pixel_width:
+            self.decimator.set_pixel_width(pixel_width)
+            self._resize(self.decimator.max_points)
+
+    def _append(self, t, y) -> None:
+        n = min(len(y), len(self.y))
+        if n == 0:
+            return
+        self.t[:-n] = self.t[n:]
+        self.y[:-n] = self.y[n:]
+        self.t[-n:] = t[-n:]
+        self.y[-n:] = y[-n:]
+        self.dirty = True
+
+    def cb_append_chunk(self, y, x) -> None:
+        if self.paused:
+            return
+        t, v = self.decimator.push(x, y)
+        self._append(t, v)
+
+    def cb_append_data_point(self, y, x) -> None:
+        if not self.paused:
+            self._append(np.array([x], dtype=np.float64), np.array([y], dtype=np.float64))
+
+    def cb_append_data_array(self, y, x) -> None:
+        if not self.paused:
+            self._append(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+
+    def cb_set_data(self, y, x) -> None:
+        if not self.paused:
+            self._resize(len(self.y))
+            self._append(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+
+    def pause(self) -> None:
+        self.paused = True
+
+    def resume(self) -> None:
+        self.paused = False
+
+
+class StackedViewerTab(QWidget):
+    # Alternative to ViewerTab for many channels (Layout: stacked in the settings).
+    # All channels are offset traces of one curve in one plot with a shared time axis.
+    # Only the lanes scrolled into view are copied into the curve, once per frame from the
+    # stager's timer, so the frame time depends on visible_channels, not on the channel count.
+
+    def __init__(self, parent=None, config=None, plot_rate=60, visible_channels=16, **kwargs):
+        super().__init__(parent=parent, **kwargs)
+        self.layout = QHBoxLayout()
+        self.layout.setContentsMargins(0,0,0,0)
+        self.layout.setSpacing(0)
+
+        self.ndata = len(config['Inputs'].keys())
+        self.plot_rate = plot_rate
+        self.sample_rate = config['DAQSampleRate']
+        self.xrange_sec = config['Xrange_sec']
+        self.visible_channels = min(visible_channels, self.ndata)
+        self.first_lane = 0
+        self.keys = list(config['Inputs'].keys())
+        self.labels = [value['Label'] for value in config['Inputs'].values()]
+        # Fixed value range per lane if Yrange is set, otherwise the range of the data on screen
+        self.yranges = [value.get('Yrange') for value in config['Inputs'].values()]
+        self.plot_widgets = [] # per-channel widgets of ViewerTab, none here
+        self._MultiDataConnector = {
+            key: StackedChannel(EnvelopeDecimator(self.xrange_sec, self.sample_rate / value.get('Downsample', 1)))
+            for key, value in config['Inputs'].items()}
+
+        self.plot_widget = pg.PlotWidget(background='#202124', axisItems={'bottom': pg.DateAxisItem()})
+        self.plot_item = self.plot_widget.getPlotItem()
+        self.plot_item.setMouseEnabled(x=False, y=False)
+        self.plot_item.hideButtons()
+        self.plot_item.setMenuEnabled(False)
+        self.plot_item.getViewBox().wheelEvent = self._wheel_lanes
+        self.curve = pg.PlotCurveItem(connect='finite', pen=pg.mkPen('#8ab4f8', width=1))
+        self.plot_item.addItem(self.curve)
+        self.layout.addWidget(self.plot_widget)
+
+        self.scrollbar = QScrollBar(Qt.Vertical)
+        self.scrollbar.setRange(0, self.ndata - self.visible_channels)
+        self.scrollbar.setPageStep(self.visible_channels)
+        self.scrollbar.valueChanged.connect(self.scroll_to)
+        self.scrollbar.setVisible(self.ndata > self.visible_channels)
+        self.layout.addWidget(self.scrollbar)
+        self.setLayout(self.layout)
+        self.scroll_to(0)
+
+        # One timer for everything: drain the network staging, then draw
+        self.stager = FrameStager(self._MultiDataConnector, self.plot_rate)
+        self.stager.timer.timeout.connect(self.refresh)
+
+    @property
+    def MultiDataConnector(self):
+        return self._MultiDataConnector
+
+    @MultiDataConnector.setter
+    def MultiDataConnector(self, value):
+        self._MultiDataConnector = value
+
+    def scroll_to(self, first_lane: int) -> None:
+        self.first_lane = first_lane
+        lanes = range(first_lane, first_lane + self.visible_channels)
+        if not lanes:
+            return
+        self.plot_item.setYRange(-lanes[-1] - 0.5, -lanes[0] + 0.5, padding=0)
+        self.plot_item.getAxis('left').setTicks([[(-i, self.labels[i]) for i in lanes], []])
+        for key in self.keys[first_lane:first_lane + self.visible_channels]:
+            self._MultiDataConnector[key].dirty = True
+
+    def _wheel_lanes(self, ev, axis=None):
+        # The mouse wheel over the plot scrolls through the lanes instead of zooming
+        self.scrollbar.setValue(self.scrollbar.value() - int(np.sign(ev.delta())))
+        ev.accept()
+
+    def resizeEvent(self, ev):
+        super().resizeEvent(ev)
+        width = int(self.plot_item.getViewBox().width()) or self.width()
+        for channel in self._MultiDataConnector.values():
+            channel.set_pixel_width(width)
+
+    def refresh(self) -> None:
+        visible = range(self.first_lane, self.first_lane + self.visible_channels)
+        channels = [self._MultiDataConnector[self.keys[i]] for i in visible]
+        if not any(channel.dirty for channel in channels):
+            return
+        xs, ys = [], []
+        for lane, channel in zip(visible, channels):
+            channel.dirty = False
+            y = channel.y
+            if self.yranges[lane] is not None:
+                lo, hi = self.yranges[lane]
+            else:
+                if np.isnan(y[-1]):
+                    continue
+                lo, hi = np.nanmin(y), np.nanmax(y)
+            scale = 0.8 / (hi - lo) if hi > lo else 0.0
+            # NaN between lanes so that they are not joined
+            xs += [channel.t, _BREAK]
+            ys += [(y - lo) * scale - 0.4 - lane, _BREAK]
+        if not xs:
+            return
+        self.curve.setData(np.concatenate(xs), np.concatenate(ys))
+        t_end = np.nanmax([x[-1] for x in xs[0::2]])
+        if np.isfinite(t_end):
+            self.plot_item.setXRange(t_end - self.xrange_sec, t_end, padding=0)
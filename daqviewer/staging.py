@@ -0,0 +1,91 @@
+from collections import deque
+
+import numpy as np
+from PyQt5.QtCore import QObject, QTimer, Qt
+
+
+class ChannelStaging:
+    # Network-thread side of a DataConnector. The OSC handlers append here (deque appends are
+    # atomic, so no lock is taken per packet) and the GUI thread hands everything that arrived
+    # since the last frame to the connector in one call. If the GUI stalls, the oldest
+    # entries beyond maxlen are dropped rather than growing without bound.
+    # Taps get the same data after the connector, e.g. the peri-event averages.
+
+    def __init__(self, connector, maxlen: int = 1024, taps: list = None):
+        self.connector = connector
+        self.taps = [] if taps is None else taps
+        self._chunks = deque(maxlen=maxlen)
+        self._points = deque(maxlen=maxlen)
+
+    def cb_append_chunk(self, y, x) -> None:
+        self._chunks.append((y, x))
+
+    def cb_append_data_point(self, y, x) -> None:
+        self._points.append((y, x))
+
+    def drain(self) -> None:
+        # GUI thread only
+        n = len(self._chunks)
+        if n:
+            chunks = [self._chunks.popleft() for _ in range(n)]
+            if n == 1:
+                y, x = chunks[0]
+            else:
+                y = np.concatenate([y for y, _ in chunks])
+                x = np.concatenate([x for _, x in chunks])
+            self.connector.cb_append_chunk(y, x)
+            for tap in self.taps:
+                tap.cb_append_chunk(y, x)
+        n = len(self._points)
+        if n:
+            points = [self._points.popleft() for _ in range(n)]
+            y, x = [float(y) for y, _ in points], [x for _, x in points]
+            self.connector.cb_append_data_array(y, x)
+            for tap in self.taps:
+                tap.cb_append_data_array(y, x)
+
+
+class FrameStager(QObject):
+    # Applies everything staged by the network thread once per frame, from a GUI-thread timer
+    # running at the plot rate, so that the connectors and widgets are only touched by the GUI thread.
+
+    def __init__(self, connectors: dict, plot_rate: float, maxlen: int = 1024):
+        super().__init__()
+        self._maxlen = maxlen
+        self._taps = {} # input -> taps, kept when the channel is rebuilt
+        self.channels = {key: ChannelStaging(connector, maxlen, self._taps.setdefault(key, []))
+                         for key, connector in connectors.items()}
+        self._text = {} # widget -> latest text
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.drain)
+        self.timer.start(max(1, int(1000 / plot_rate)))
+
+    def add_channel(self, key, connector) -> None:
+        # GUI thread; the OSC handlers look the channel up per packet and skip unknown inputs
+        self.channels[key] = ChannelStaging(connector, self._maxlen, self._taps.setdefault(key, []))
+
+    def add_tap(self, key, connector) -> None:
+        # GUI thread; `connector` also gets every drained chunk of the input `key`
+        self._taps.setdefault(key, []).append(connector)
+
+    def remove_tap(self, key, connector) -> None:
+        taps = self._taps.get(key, [])
+        if connector in taps:
+            taps.remove(connector)
+
+    def remove_channel(self, key) -> None:
+        self.channels.pop(key, None)
+
+    def set_text(self, widget, text: str) -> None:
+        # Callable from any thread; only the latest text of a frame is shown
+        self._text[widget] = text
+
+    def drain(self) -> None:
+        for channel in self.channels.values():
+            channel.drain()
+        for widget in list(self._text):
+            widget.setText(self._text.pop(widget))
+
+    def stop(self) -> None:
+        self.timer.stop()
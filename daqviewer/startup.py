@@ -0,0 +1,83 @@
+import hashlib
+import importlib.util
+import os
+import time
+
+# Startup helpers: the main window from a precompiled Designer file, and the --profile-startup report.
+
+def load_ui(ui_path: str, window) -> None:
+    # Same result as uic.loadUi(ui_path, window), without parsing the XML on every start.
+    # The .ui is compiled once to a Python module in .uicache/ next to it and recompiled
+    # whenever the .ui content changes; the module's bytecode is cached by Python as usual.
+    with open(ui_path, 'rb') as f:
+        stamp = '# compiled from sha1 {}\n'.format(hashlib.sha1(f.read()).hexdigest())
+    name = os.path.splitext(os.path.basename(ui_path))[0] + '_ui'
+    py_path = os.path.join(os.path.dirname(ui_path), '.uicache', name + '.py')
+    try:
+        if not _is_current(py_path, stamp):
+            _compile_ui(ui_path, py_path, stamp)
+    except OSError:
+        # Read-only install: parse at runtime as before
+        from PyQt5 import uic
+        uic.loadUi(ui_path, window)
+        return
+
+    spec = importlib.util.spec_from_file_location(name, py_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    ui_class = next(getattr(module, attr) for attr in dir(module) if attr.startswith('Ui_'))
+    ui = ui_class()
+    ui.setupUi(window)
+    # loadUi puts the widgets on the window itself
+    for attr, value in vars(ui).items():
+        setattr(window, attr, value)
+
+
+def _is_current(py_path: str, stamp: str) -> bool:
+    try:
+        with open(py_path) as f:
+            return f.readline() == stamp
+    except OSError:
+        return False
+
+
+def _compile_ui(ui_path: str, py_path: str, stamp: str) -> None:
+    from io import StringIO
+    from PyQt5 import uic # only needed when the .ui changed
+    code = StringIO()
+    uic.compileUi(ui_path, code)
+    os.makedirs(os.path.dirname(py_path), exist_ok=True)
+    tmp_path = py_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(stamp + code.getvalue())
+    os.replace(tmp_path, py_path) # a concurrently starting viewer never sees half a file
+    try:
+        # The bytecode cache only checks mtime and size, which a quick edit can leave unchanged
+        os.remove(importlib.util.cache_from_source(py_path))
+    except OSError:
+        pass
+
+
+class StartupProfile:
+    # Wall-clock time of each startup stage. Stages are marked when they end; the report is
+    # printed once the event loop has shown the first frame (--profile-startup).
+
+    def __init__(self, enabled: bool = False, t0: float = None):
+        self.enabled = enabled
+        self.t0 = time.perf_counter() if t0 is None else t0
+        self._last = self.t0
+        self.stages = []
+
+    def mark(self, stage: str) -> None:
+        now = time.perf_counter()
+        self.stages.append((stage, now - self._last))
+        self._last = now
+
+    def report(self) -> None:
+        self.mark('event loop, first frame')
+        if not self.enabled:
+            return
+        total = self._last - self.t0
+        print('Startup took {:.0f} ms'.format(total * 1e3))
+        for stage, duration in self.stages:
+            print('  {:<36s}{:8.1f} ms {:5.1f}%'.format(stage, duration * 1e3, 100 * duration / total))
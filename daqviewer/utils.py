@@ -14,7 +14,17 @@ def find_version(*file_paths):
         return version_match.group(1)
     raise RuntimeError("Unable to find version string.")
 
-def normalize_angle_np(angles):
-    # Normalize angles using modulo 360
-    normalized_angles = angles % 360
-    return normalized_angles
\ No newline at end of file
+def input_wrap(key: str, value: dict):
+    # Display period of an input, or None. The encoder angle ctr0 is shown modulo one turn unless
+    # it sets Wrap itself (Wrap: 0 for the cumulative angle), as before Wrap existed.
+    if key.split('/')[-1] == 'ctr0' and 'Wrap' not in value and 'Source' not in value:
+        return 360
+    return value.get('Wrap') or None
+
+# Input settings that only change how a channel is displayed
+DISPLAY_KEYS = ('Label', 'Yrange', 'Wrap')
+
+def input_rebuild_needed(old: dict, new: dict) -> bool:
+    # True if an input changed in a way that invalidates its buffered or filtered data
+    keys = (set(old) | set(new)) - set(DISPLAY_KEYS)
+    return any(old.get(key) != new.get(key) for key in keys)
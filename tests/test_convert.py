@@ -0,0 +1,19 @@
+import os
+import sys
+
+import numpy as np
+
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'daqlogger', 'python'))
+
+from convert import convert
+
+
+def test_headerless_recording(tmp_path):
+    # Legacy float64 .bin without a header: skipped unless its layout is given
+    data = np.arange(2 * 9000, dtype=np.float64).reshape(-1, 2)
+    data.tofile(tmp_path / 'old.bin')
+    assert convert([str(tmp_path / 'old.bin')], str(tmp_path / 'out'), workers=1) == []
+
+    out, = convert([str(tmp_path / 'old.bin')], str(tmp_path / 'out'), workers=1, n_channels=2, sample_rate=9000)
+    np.testing.assert_array_equal(np.load(out), data)
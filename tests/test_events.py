@@ -0,0 +1,24 @@
+import os
+import sys
+
+import numpy as np
+
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'daqlogger', 'python'))
+
+from events import ThresholdDetector
+
+
+def test_no_thresholds():
+    detector = ThresholdDetector.from_thresholds([None, None], 2, 0.2)
+    assert len(detector.process(np.zeros((2, 100)), 0)) == 0
+
+
+def test_edges_across_chunks():
+    y = np.zeros((2, 300))
+    y[1, 150:] = 5.0
+    detector = ThresholdDetector.from_thresholds([None, 2.5], 2, 0.2)
+    events = np.concatenate([detector.process(y[:, :100], 0), detector.process(y[:, 100:], 100)])
+    assert events['sample'].tolist() == [150]
+    assert events['channel'].tolist() == [1]
+    assert events['rising'].tolist() == [1]
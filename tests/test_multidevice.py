@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+
+import numpy as np
+
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'daqlogger', 'python'))
+
+from daqmx_recorder import DAQLogger
+from events import read_events
+from multidevice import split_channels
+from recording import open_recording
+
+
+def test_split_channels_order():
+    devices, order = split_channels(['ai0', 'Dev3/ai0', 'ai1'], 'Dev2')
+    assert devices == {'Dev2': ['ai0', 'ai1'], 'Dev3': ['ai0']}
+    assert order == [0, 2, 1]
+
+
+def test_mixed_device_order(tmp_path):
+    # Dev3/ai0 listed between Dev2's channels: every column keeps its name, address and threshold
+    signals = {'Dev2/ai0': dict(kind='constant', offset=1.0), 'Dev2/ai1': dict(kind='constant', offset=3.0),
+               'Dev3/ai0': dict(kind='constant', offset=2.0)}
+    logger = DAQLogger(dev_name='Dev2', ai_channels=['ai0', 'Dev3/ai0', 'ai1'], ci_channels='',
+                       sample_rate=9000, sample_size=1000, osc_port='59799', stats_interval=None,
+                       osc_address_ai=['/ai0', '/dev3ai0', '/ai1'], ai_thresholds=[0.5, 1.5, 2.5],
+                       save_file_location_ai=str(tmp_path / 'ai.bin'), backend='simulated', sim_signals=signals)
+    dev2, dev3 = logger.device_AIs
+    assert dev2.osc_address == ['/ai0', '/ai1'] and dev3.osc_address == ['/dev3ai0']
+    assert list(dev2.detector.high + dev2.detector.low) == [1.0, 5.0]
+    assert list(dev3.detector.high + dev3.detector.low) == [3.0]
+
+    logger.start_acquisition()
+    time.sleep(0.5)
+    logger.stop_acquisition()
+    logger.close_tasks()
+
+    rec = open_recording(tmp_path / 'ai.bin')
+    assert rec.channel_names == ['ai0', 'ai1', 'Dev3/ai0']
+    assert rec.meta['osc_address'] == ['/ai0', '/ai1', '/dev3ai0']
+    assert len(rec) > 0
+    np.testing.assert_allclose(np.asarray(rec).mean(axis=0), [1.0, 3.0, 2.0])
+
+
+def test_card_without_thresholds(tmp_path):
+    # Dev2 has no threshold on any of its channels; its callbacks still run and Dev3's events land on its column
+    signals = {'Dev3/ai0': dict(kind='ttl', period=0.2, duty=0.5, high=5.0)}
+    logger = DAQLogger(dev_name='Dev2', ai_channels=['ai0', 'Dev3/ai0', 'ai1'], ci_channels='',
+                       sample_rate=9000, sample_size=1000, osc_port='59799', stats_interval=None,
+                       osc_address_ai=['/ai0', '/dev3ai0', '/ai1'], ai_thresholds=[None, 2.5, None],
+                       save_file_location_ai=str(tmp_path / 'ai.bin'),
+                       save_file_location_events=str(tmp_path / 'events.bin'),
+                       backend='simulated', sim_signals=signals)
+    assert logger.device_AIs[0].detector is None
+    logger.start_acquisition()
+    time.sleep(0.6)
+    logger.stop_acquisition()
+    logger.close_tasks()
+
+    rec = open_recording(tmp_path / 'ai.bin')
+    assert len(rec) >= 3000
+    events = read_events(tmp_path / 'events.bin')
+    assert len(events) > 0
+    assert set(events['channel'].tolist()) == {2}
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import numpy as np
+
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'daqlogger', 'python'))
+sys.path.insert(0, os.path.join(here, '..', 'daqviewer'))
+
+from osc_handler import decode_frame
+from oscframe import OSCFrame
+from pythonosc.osc_message import OscMessage
+
+
+def test_float_round_trip():
+    samples = np.linspace(-5, 5, 100)
+    frame = OSCFrame('/ai0', 3, 100, 9000.0).pack(samples, 4500)
+    decoded = decode_frame(OscMessage(bytes(frame.dgram)).params[0])
+    assert (decoded.channel, decoded.first_sample, decoded.sample_rate) == (3, 4500, 9000.0)
+    np.testing.assert_array_equal(decoded.samples, samples.astype(np.float32))
+
+
+def test_raw_round_trip():
+    codes = np.arange(-50, 50, dtype=np.int16)
+    frame = OSCFrame('/ai1', 0, 100, 9000.0, dtype=np.int16, gain=0.5, offset=-1.0).pack(codes, 0)
+    decoded = decode_frame(OscMessage(bytes(frame.dgram)).params[0])
+    np.testing.assert_allclose(decoded.samples, codes * 0.5 - 1.0)